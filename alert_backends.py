@@ -0,0 +1,180 @@
+"""Alert backends of the controller, selected by "alert_type" in config.json.
+
+A backend is a class taking (config, controller), with a
+`send(door, title, message)` method that the alert dispatcher runs on its
+worker threads, and optionally a `close()` method, called on the same
+threads when a config reload replaces the backend. The built-in backends import smtplib, email and
+http.client in their constructor, so a controller without alerts never
+loads them.
+
+    "smtp"        an email through SMTPTransport
+    "pushbullet"  a note pushed to every access token
+    "pushover"    a Pushover message
+
+The openHAB item updates of "use_openhab" go through the same registry
+as "openhab", with `send_state(door, state)` instead of `send`.
+
+Other packages add backends with an entry point in the
+"garage_door_controller.alerts" group, named after the alert_type:
+
+    [project.entry-points."garage_door_controller.alerts"]
+    telegram = "garage_telegram:TelegramBackend"
+"""
+
+import syslog
+
+ENTRY_POINT_GROUP = 'garage_door_controller.alerts'
+
+
+def check_status(service, status, body):
+    """Raise IOError for an error response, the dispatcher logs and counts it as failed."""
+    if status >= 300:
+        raise IOError("%s answered %d: %s" % (
+            service, status, body[:200].decode('utf-8', 'replace')))
+
+
+class SMTPBackend(object):
+    def __init__(self, config, controller):
+        from email.mime.text import MIMEText
+        from email.utils import formatdate, make_msgid
+        from smtp_transport import SMTPTransport
+        self.MIMEText = MIMEText
+        self.formatdate = formatdate
+        self.make_msgid = make_msgid
+        self.config = config['alerts'].get('smtp', {})
+        params = ("smtphost", "smtpport", "smtp_tls", "username",
+                  "password", "to_email", "time_to_wait")
+        self.enabled = set(params) <= set(self.config)
+        if self.enabled:
+            self.transport = SMTPTransport(
+                self.config["smtphost"], self.config["smtpport"], self.config["username"],
+                self.config["password"], self.config["smtp_tls"] == "True")
+        else:
+            syslog.syslog("SMTP settings incomplete, no email will be sent")
+
+    def send(self, door, title, message):
+        if not self.enabled:
+            return
+        syslog.syslog("Sending email message")
+        message = self.MIMEText(message)
+        message['Date'] = self.formatdate()
+        message['From'] = self.config["username"]
+        message['To'] = self.config["to_email"]
+        message['Subject'] = self.config["subject"]
+        message['Message-ID'] = self.make_msgid()
+        latency = self.transport.send(
+            self.config["username"], self.config["to_email"], message.as_string())
+        syslog.syslog("Email sent in %.3f s" % latency)
+
+    def close(self):
+        if self.enabled:
+            with self.transport.lock:
+                self.transport.close()
+
+
+class PushbulletBackend(object):
+    def __init__(self, config, controller):
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+        self.json = json
+        tokens = config['alerts']['pushbullet']['access_token']
+        self.tokens = tokens if isinstance(tokens, list) else [tokens]
+        self.http_pool = controller.get_http_pool()
+        self.fanout = ThreadPoolExecutor(max_workers=4)
+
+    def send(self, door, title, message):
+        syslog.syslog("Sending pushbullet message")
+        # Reraises the first failure once every token has been attempted
+        list(self.fanout.map(
+            lambda token: self.push(door, token, title, message), self.tokens))
+
+    def push(self, door, token, title, message):
+        headers = {'Authorization': 'Bearer ' + token,
+                   'Content-Type': 'application/json'}
+        iden = door.pb_idens.pop(token, None)
+        if iden is not None:
+            status, response = self.http_pool.request(
+                "https", "api.pushbullet.com:443", "DELETE", '/v2/pushes/' + iden, "", headers)
+            if status >= 300 and status != 404:
+                # The new push still goes out, the old one stays on the devices
+                syslog.syslog("Pushbullet delete of %s answered %d" % (iden, status))
+
+        status, response = self.http_pool.request(
+            "https", "api.pushbullet.com:443", "POST", "/v2/pushes",
+            self.json.dumps({
+                "type": "note",
+                "title": title,
+                "body": message,
+            }), headers)
+        check_status("Pushbullet", status, response)
+        door.pb_idens[token] = self.json.loads(response.decode('utf-8'))['iden']
+
+    def close(self):
+        self.fanout.shutdown()
+
+
+class PushoverBackend(object):
+    def __init__(self, config, controller):
+        from urllib.parse import urlencode
+        self.urlencode = urlencode
+        self.config = config['alerts']['pushover']
+        self.http_pool = controller.get_http_pool()
+
+    def send(self, door, title, message):
+        syslog.syslog("Sending Pushover message")
+        status, response = self.http_pool.request(
+            "https", "api.pushover.net:443", "POST", "/1/messages.json",
+            self.urlencode({
+                "token": self.config['api_key'],
+                "user": self.config['user_key'],
+                "title": title,
+                "message": message,
+            }), {"Content-type": "application/x-www-form-urlencoded"})
+        check_status("Pushover", status, response)
+
+
+class OpenHABBackend(object):
+    def __init__(self, config, controller):
+        self.config = config['openhab']
+        self.http_pool = controller.get_http_pool()
+
+    def send_state(self, door, state):
+        syslog.syslog("Updating openhab")
+        status, response = self.http_pool.request(
+            "http", "%s:%s" % (self.config['server'], self.config['port']),
+            "PUT", "/rest/items/%s/state" % door.openhab_name, state)
+        check_status("openHAB", status, response)
+
+
+BUILTIN = {
+    'smtp': SMTPBackend,
+    'pushbullet': PushbulletBackend,
+    'pushover': PushoverBackend,
+    'openhab': OpenHABBackend,
+}
+
+
+def find(name):
+    """The backend class registered as `name`, None if there is none."""
+    if name in BUILTIN:
+        return BUILTIN[name]
+    # Only scanned for names that are not built in, the lookup reads every
+    # installed distribution's metadata
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name == name:
+            return entry_point.load()
+    return None
+
+
+def create(name, config, controller):
+    """Build the backend `name` for `controller`, None if it is unknown or fails to load."""
+    try:
+        backend_class = find(name)
+    except ImportError as inst:
+        syslog.syslog("Alert backend %s failed to load: %s" % (name, inst))
+        return None
+    if backend_class is None:
+        syslog.syslog("Unknown alert backend %s" % name)
+        return None
+    return backend_class(config, controller)
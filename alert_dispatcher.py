@@ -0,0 +1,133 @@
+import syslog
+import threading
+
+import metrics
+
+import sys
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
+
+OUTBOUND_SECONDS = metrics.Histogram(
+    'garage_outbound_seconds', 'Duration of outbound alert and openHAB calls',
+    ['backend'])
+OUTBOUND = metrics.Counter(
+    'garage_outbound_total', 'Outbound alert and openHAB deliveries',
+    ['backend', 'outcome'])
+
+
+class AlertDispatcher(object):
+    """Run alert and openHAB deliveries on worker threads.
+
+    Each backend has its own bounded queue and its own workers, so a slow
+    or unreachable server never holds up the status loop, nor the
+    deliveries of the other backends. A backend gets one worker, which
+    keeps its deliveries in order, unless `concurrency` gives it more.
+    The outcome of every delivery is counted in `results` and passed to
+    the optional result handler."""
+
+    def __init__(self, queue_size=32, concurrency=None):
+        self.queue_size = queue_size
+        self.concurrency = concurrency or {}
+        self.queues = {}  # backend => queue of (func, args, delivery)
+        self.threads = {}  # backend => worker threads
+        self.results = {}
+        self.result_handler = None
+        self.lock = threading.Lock()
+
+    def set_result_handler(self, result_handler):
+        """`result_handler(backend, success, error)` is called from the
+        worker thread after every delivery."""
+        self.result_handler = result_handler
+
+    def submit(self, backend, func, *args):
+        """Queue `func(*args)` for delivery. Returns False if the backend's queue is full."""
+        try:
+            self.get_queue(backend).put_nowait((func, args, True))
+        except queue.Full:
+            syslog.syslog("Alert queue full, dropping %s delivery" % backend)
+            self.count(backend, 'dropped')
+            return False
+        return True
+
+    def submit_cleanup(self, backend, func):
+        """Queue `func()` behind the deliveries already queued for `backend`,
+        e.g. to close a backend instance replaced by a config reload. It is
+        not counted as a delivery. Returns False if the queue is full."""
+        try:
+            self.get_queue(backend).put_nowait((func, (), False))
+        except queue.Full:
+            syslog.syslog("Alert queue full, skipping %s cleanup" % backend)
+            return False
+        return True
+
+    def get_queue(self, backend):
+        """The queue of `backend`, starting its workers on first use."""
+        with self.lock:
+            if backend not in self.queues:
+                backend_queue = queue.Queue(self.queue_size)
+                threads = []
+                for _ in range(self.concurrency.get(backend, 1)):
+                    thread = threading.Thread(target=self.run, args=(backend, backend_queue),
+                                              name='alert-dispatcher-%s' % backend)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                self.queues[backend] = backend_queue
+                self.threads[backend] = threads
+            return self.queues[backend]
+
+    def stop(self):
+        with self.lock:
+            queues, self.queues = self.queues, {}
+            threads, self.threads = self.threads, {}
+        for backend, backend_queue in queues.items():
+            for _ in threads[backend]:
+                backend_queue.put((None, None, False))
+        for backend_threads in threads.values():
+            for thread in backend_threads:
+                thread.join()
+
+    def join(self):
+        """Block until every queued delivery has been attempted."""
+        with self.lock:
+            queues = list(self.queues.values())
+        for backend_queue in queues:
+            backend_queue.join()
+
+    def count(self, backend, outcome):
+        with self.lock:
+            results = self.results.setdefault(
+                backend, {'sent': 0, 'failed': 0, 'dropped': 0})
+            results[outcome] += 1
+        OUTBOUND.inc(backend, outcome)
+
+    def run(self, backend, backend_queue):
+        while True:
+            func, args, delivery = backend_queue.get()
+            if func is None:
+                backend_queue.task_done()
+                return
+            if not delivery:
+                try:
+                    func(*args)
+                except Exception as inst:
+                    syslog.syslog("Error cleaning up %s: %s" % (backend, inst))
+                backend_queue.task_done()
+                continue
+            error = None
+            start = metrics.timer()
+            try:
+                func(*args)
+            except Exception as inst:
+                error = inst
+                syslog.syslog("Error sending to %s: %s" % (backend, inst))
+            OUTBOUND_SECONDS.observe(metrics.timer() - start, backend)
+            self.count(backend, 'sent' if error is None else 'failed')
+            if self.result_handler is not None:
+                try:
+                    self.result_handler(backend, error is None, error)
+                except Exception as inst:
+                    syslog.syslog("Error in alert result handler: " + str(inst))
+            backend_queue.task_done()
@@ -0,0 +1,97 @@
+# Build the web UI for serving: bundle the scripts, give the assets
+# content hashed names and write precompressed variants.
+#
+#   python3 build_assets.py [source_dir] [output_dir]
+#
+# The server serves output_dir (www-dist by default) instead of www when it
+# has been built.
+
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Scripts bundled in this order into a single js/app.<hash>.js
+BUNDLE = ['js/date.format.js', 'js/client.js']
+
+# Referenced from index.html, renamed with their content hash
+HASHED = ['js/jquery-1.8.3.min.js', 'js/jquery.mobile-1.2.1.min.js',
+          'css/jquery.mobile-1.2.1.min.css']
+
+COMPRESSED_EXTENSIONS = ('.html', '.js', '.css')
+
+
+def hashed_name(name, content):
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha256(content).hexdigest()[:10], ext)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def compress(path):
+    content = read(path)
+    with open(path + '.gz', 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+            gz.write(content)
+    if brotli is not None:
+        write(path + '.br', brotli.compress(content))
+
+
+def build(source, output):
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+
+    # Images keep their names, client.js and the CSS build their paths
+    for directory in ['img', 'css/images']:
+        shutil.copytree(os.path.join(source, directory), os.path.join(output, directory))
+
+    renames = {}
+    for name in HASHED:
+        content = read(os.path.join(source, name))
+        renames[name] = hashed_name(name, content)
+        write(os.path.join(output, renames[name]), content)
+
+    bundle = b';\n'.join(read(os.path.join(source, name)) for name in BUNDLE)
+    bundle_name = hashed_name('js/app.js', bundle)
+    write(os.path.join(output, bundle_name), bundle)
+
+    index = read(os.path.join(source, 'index.html')).decode('utf-8')
+    for name, renamed in renames.items():
+        index = index.replace('"/%s"' % name, '"/%s"' % renamed)
+    lines = []
+    for line in index.splitlines(True):
+        if '"/%s"' % BUNDLE[-1] in line:
+            lines.append(line.replace('"/%s"' % BUNDLE[-1], '"/%s"' % bundle_name))
+        elif not any('"/%s"' % name in line for name in BUNDLE):
+            lines.append(line)
+    write(os.path.join(output, 'index.html'), ''.join(lines).encode('utf-8'))
+
+    for root, _, files in os.walk(output):
+        for name in files:
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                compress(os.path.join(root, name))
+    return bundle_name
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else 'www'
+    output = sys.argv[2] if len(sys.argv) > 2 else 'www-dist'
+    build(source, output)
+    print('Built %s from %s' % (output, source))
@@ -1,20 +1,69 @@
+import copy
 import datetime
-import time
+import heapq
 import syslog
-import smtplib
-import RPi.GPIO as gpio
-import json
-import urllib
 
-from email.mime.text import MIMEText
-from email.utils import formatdate
-from email.utils import make_msgid
-
-import sys
-if sys.version_info < (3,):
-    import httplib as httpclient
-else:
-    import http.client as httpclient
+from bisect import bisect_left, insort
+from collections import deque
+
+import alert_backends
+import gpio_backends
+import metrics
+from alert_dispatcher import AlertDispatcher
+from clock import SystemClock
+
+STATUS_CHECK_SECONDS = metrics.Histogram(
+    'garage_status_check_seconds', 'Duration of a status check')
+GPIO_READ_SECONDS = metrics.Histogram(
+    'garage_gpio_read_seconds',
+    'Duration of a GPIO read: every state pin in one bulk read per status check, '
+    'or a single pin on a toggle',
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+TRANSITIONS = metrics.Counter(
+    'garage_door_transitions_total', 'Door state transitions', ['door', 'state'])
+ALERTS = metrics.Counter(
+    'garage_door_alerts_total', 'Alerts sent', ['door'])
+
+
+class PinFilter(object):
+    """Debounce a state pin.
+
+    A new level is only accepted once it has been read `samples` times in a
+    row and has held for `settle_time` seconds, so reed switch chatter
+    never reaches the state machine."""
+    recheck_interval = 0.5
+
+    def __init__(self, samples=1, settle_time=0):
+        self.samples = samples
+        self.settle_time = settle_time
+        self.value = None
+        self.candidate = None
+        self.count = 0
+        self.since = None
+
+    def update(self, raw, now):
+        if self.value is None or raw == self.value:
+            self.value = raw
+            self.candidate = None
+            return self.value
+        if raw != self.candidate:
+            self.candidate = raw
+            self.count = 0
+            self.since = now
+        self.count += 1
+        if self.count >= self.samples and now - self.since >= self.settle_time:
+            self.value = raw
+            self.candidate = None
+        return self.value
+
+    def pending_deadline(self, now):
+        """When the candidate level should be read again, None if there is none."""
+        if self.candidate is None:
+            return None
+        deadline = self.since + self.settle_time
+        if self.count < self.samples:
+            deadline = max(deadline, now + self.recheck_interval)
+        return deadline
 
 
 class Door(object):
@@ -22,34 +71,66 @@ class Door(object):
     last_action_time = None
     alert_sent = False
     confirm_close = False
-    pb_iden = None
-
-    def __init__(self, doorId, config):
+    relay_active = False
+    relay_pulse_time = 0.2
+    registry = None
+    relay_pin = None
+    state_pin = None
+    pin_filter = None
+
+    def __init__(self, doorId, config, backend, clock=None):
         self.id = doorId
+        self.backend = backend
+        self.clock = clock or SystemClock()
+        self.pb_idens = {}  # Last Pushbullet push of this door, per token
+        self.open_time = self.clock.seconds()
+        self.alert_sent_time = self.clock.seconds()
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply the door's section of the config, setting up only the pins that changed."""
         self.name = config['name']
         self.in_sentence = config['in_sentence']
-        self.relay_pin = config['relay_pin']
-        self.state_pin = config['state_pin']
         self.state_pin_closed_value = config.get('state_pin_closed_value', 0)
         self.time_to_close = config.get('approx_time_to_close', 10)
         self.time_to_open = config.get('approx_time_to_open', 10)
         self.openhab_name = config.get('openhab_name')
-        self.open_time = time.time()
-        self.alert_sent_time = time.time()
-        gpio.setup(self.relay_pin, gpio.OUT)
-        gpio.setup(self.state_pin, gpio.IN, pull_up_down=gpio.PUD_UP)
-        gpio.output(self.relay_pin, True)
-
-    def get_state(self):
-        if gpio.input(self.state_pin) == self.state_pin_closed_value:
+        if config['relay_pin'] != self.relay_pin:
+            self.relay_pin = config['relay_pin']
+            self.backend.setup_output(self.relay_pin, True)
+        samples = config.get('debounce_samples', 1)
+        settle_time = config.get('debounce_time', 0)
+        if config['state_pin'] != self.state_pin or self.pin_filter is None or \
+                (self.pin_filter.samples, self.pin_filter.settle_time) != (samples, settle_time):
+            self.pin_filter = PinFilter(samples, settle_time)
+        if config['state_pin'] != self.state_pin:
+            self.state_pin = config['state_pin']
+            self.backend.setup_input(self.state_pin)
+
+    @property
+    def last_state(self):
+        return self.registry.get_state(self.id)[0]
+
+    @property
+    def last_state_time(self):
+        return self.registry.get_state(self.id)[1]
+
+    def get_state(self, value=None):
+        """State of the door from its state pin, read unless `value` was read in bulk."""
+        if value is None:
+            start = metrics.timer()
+            value = self.backend.read(self.state_pin)
+            GPIO_READ_SECONDS.observe(metrics.timer() - start)
+        value = self.pin_filter.update(value, self.clock.seconds())
+        if value == self.state_pin_closed_value:
             return 'closed'
         elif self.last_action == 'open':
-            if time.time() - self.last_action_time >= self.time_to_open:
+            if self.clock.seconds() - self.last_action_time >= self.time_to_open:
                 return 'open'
             else:
                 return 'opening'
         elif self.last_action == 'close':
-            if time.time() - self.last_action_time >= self.time_to_close:
+            if self.clock.seconds() - self.last_action_time >= self.time_to_close:
                 return 'open'  # This state indicates a problem
             else:
                 return 'closing'
@@ -57,215 +138,704 @@ class Door(object):
             return 'open'
 
     def toggle_relay(self):
+        """Pulse the relay to press the door button.
+
+        The relay is released from a call scheduled on the clock, so with
+        the reactor as clock nothing blocks during the pulse. Returns False
+        if a pulse is already in progress on this relay."""
+        if self.relay_active:
+            return False
+
         state = self.get_state()
         if (state == 'open'):
             self.last_action = 'close'
-            self.last_action_time = time.time()
+            self.last_action_time = self.clock.seconds()
         elif state == 'closed':
             self.last_action = 'open'
-            self.last_action_time = time.time()
+            self.last_action_time = self.clock.seconds()
         else:
             self.last_action = None
             self.last_action_time = None
 
-        gpio.output(self.relay_pin, False)
-        time.sleep(0.2)
-        gpio.output(self.relay_pin, True)
+        self.relay_active = True
+        self.backend.write(self.relay_pin, False)
+        self.clock.callLater(self.relay_pulse_time, self.release_relay)
+        return True
+
+    def release_relay(self):
+        self.backend.write(self.relay_pin, True)
+        self.relay_active = False
+
+
+class DoorRegistry(object):
+    """Doors by id, and the last state of each door.
+
+    The (last_state_time, id) pairs are kept sorted so the doors changed
+    since a given time are found with a bisection instead of a scan."""
+
+    def __init__(self):
+        self.doors = []
+        self.by_id = {}
+        self.states = {}
+        self.time_index = []
+
+    def __iter__(self):
+        return iter(self.doors)
+
+    def __len__(self):
+        return len(self.doors)
+
+    def add(self, door, state, state_time):
+        door.registry = self
+        self.doors.append(door)
+        self.by_id[door.id] = door
+        self.states[door.id] = (state, state_time)
+        insort(self.time_index, (state_time, door.id))
+
+    def remove(self, doorId):
+        door = self.by_id.pop(doorId)
+        self.doors.remove(door)
+        self.unindex(doorId)
+        del self.states[doorId]
+        return door
+
+    def get(self, doorId):
+        return self.by_id.get(doorId)
+
+    def get_state(self, doorId):
+        return self.states[doorId]
+
+    def set_state(self, doorId, state, state_time):
+        self.unindex(doorId)
+        self.states[doorId] = (state, state_time)
+        insort(self.time_index, (state_time, doorId))
+
+    def unindex(self, doorId):
+        key = (self.states[doorId][1], doorId)
+        del self.time_index[bisect_left(self.time_index, key)]
+
+    def changed_since(self, since):
+        """Return the doors whose state changed at or after `since`, oldest first."""
+        start = bisect_left(self.time_index, (since,))
+        return [self.by_id[doorId] for _, doorId in self.time_index[start:]]
+
+
+class ChangeLog(object):
+    """Numbered log of the recent door state changes.
+
+    Every state change gets the next version, so a client that has seen
+    version v only needs the entries after it."""
+
+    def __init__(self, size=256):
+        self.version = 0
+        self.changes = deque(maxlen=size)
+        self.command_changes = deque(maxlen=size)
+        self.dropped_command_version = 0  # last command change pushed out of the log
+
+    def append(self, doorId, state, state_time):
+        self.version += 1
+        self.changes.append((self.version, doorId, state, state_time))
+
+    def touch(self):
+        """Start a new version without a door change, e.g. after a config reload."""
+        self.version += 1
+
+    def append_command(self, update):
+        """Log the [id, door, action, status, requests] of a command that changed."""
+        self.version += 1
+        if len(self.command_changes) == self.command_changes.maxlen:
+            self.dropped_command_version = self.command_changes[0][0]
+        self.command_changes.append((self.version, update))
+
+    def get_changes(self, version, doors):
+        """Return (current version, updates) for the changes after `version`.
+
+        Updates hold the latest (id, state, time) of each changed door. A
+        version older than the log, or from before a restart, gets the
+        state of every door in `doors`."""
+        if version == self.version:
+            return self.version, []
+        if version > self.version or not self.changes or \
+                version < self.changes[0][0] - 1:
+            return self.version, [(d.id, d.last_state, d.last_state_time)
+                                  for d in doors]
+        latest = {}
+        for change_version, door_id, state, state_time in reversed(self.changes):
+            if change_version <= version:
+                break
+            if door_id not in latest:
+                latest[door_id] = (change_version, (door_id, state, state_time))
+        return self.version, [update for _, update in sorted(latest.values())]
+
+    def get_command_changes(self, version, pending=()):
+        """Return the latest status of each command changed after `version`.
+
+        A version older than the log, or from before a restart, may have
+        missed changes: it also gets the status of every `pending` command."""
+        if version == self.version:
+            return []
+        latest = {}
+        if version > self.version or version < self.dropped_command_version:
+            for command in pending:
+                latest[command.id] = command.as_update()
+        for change_version, update in self.command_changes:
+            if change_version > version:
+                latest[update[0]] = update
+        return [latest[commandId] for commandId in sorted(latest)]
+
+
+class Command(object):
+    """A toggle asked for by clients, followed until the door gets there."""
+
+    def __init__(self, commandId, door, action, issued, grace):
+        self.id = commandId
+        self.door_id = door.id
+        self.action = action  # 'open', 'close', or None when stopping a moving door
+        self.issued = issued
+        self.door_state = (door.last_state, door.last_state_time)
+        self.status = 'pending'
+        self.requests = 1
+        travel_time = door.time_to_open if action == 'open' else door.time_to_close
+        self.deadline = issued + travel_time + grace
+
+    def as_update(self):
+        return [self.id, self.door_id, self.action, self.status, self.requests]
+
+
+class DeadlineQueue(object):
+    """Due times of the timed door events, earliest first.
+
+    Each (door, kind) has at most one live deadline: scheduling it again
+    or cancelling it leaves the old heap entry behind, skipped when it
+    comes up. The heap is rebuilt when stale entries pile up."""
+
+    def __init__(self):
+        self.heap = []
+        self.live = {}  # (door id, kind) => sequence of the live entry
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    def schedule(self, doorId, kind, due):
+        self.sequence += 1
+        self.live[(doorId, kind)] = self.sequence
+        heapq.heappush(self.heap, (due, self.sequence, doorId, kind))
+        if len(self.heap) > 2 * len(self.live) + 64:
+            self.heap = [entry for entry in self.heap
+                         if self.live.get((entry[2], entry[3])) == entry[1]]
+            heapq.heapify(self.heap)
+
+    def cancel(self, doorId, kind):
+        self.live.pop((doorId, kind), None)
+
+    def is_stale(self, entry):
+        return self.live.get((entry[2], entry[3])) != entry[1]
+
+    def next_due(self):
+        while self.heap and self.is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return the (door id, kind) of the deadlines due at `now`."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self.is_stale(entry):
+                del self.live[(entry[2], entry[3])]
+                due.append((entry[2], entry[3]))
+        return due
+
+
+class CommandQueue(object):
+    """The pending toggle command of each door.
+
+    Toggles of a door within `coalesce_window` seconds of its pending
+    command are merged into it instead of pulsing the relay again, so a
+    double tap does not reverse the door. A later toggle still pulses the
+    relay at once, it replaces the pending command. A command is done when
+    the door reaches the target state (closed, or open once the opening
+    time has passed) and failed when it has not by its deadline. A stop
+    is done on the next state change of the door."""
+
+    def __init__(self, coalesce_window=3, grace=5):
+        self.coalesce_window = coalesce_window
+        self.grace = grace
+        self.next_id = 1
+        self.pending = {}  # door id => Command
+
+    def get_pending(self, doorId, now):
+        """The pending command a new toggle should be merged into, or None."""
+        command = self.pending.get(doorId)
+        if command is not None and now - command.issued < self.coalesce_window:
+            return command
+        return None
+
+    def add(self, door, action, now):
+        """Start the command for a toggle that pulsed the relay, return (command, replaced)."""
+        command = Command(self.next_id, door, action, now, self.grace)
+        self.next_id += 1
+        replaced = self.pending.get(door.id)
+        if replaced is not None:
+            replaced.status = 'replaced'
+        self.pending[door.id] = command
+        return command, replaced
+
+    def check(self, door, now):
+        """Finish the pending command of `door` if it completed or timed out, return it."""
+        command = self.pending.get(door.id)
+        if command is None:
+            return None
+        state = door.last_state
+        if command.action == 'close':
+            done = state == 'closed'
+        elif command.action == 'open':
+            done = state == 'open'
+        else:
+            done = state in ('open', 'closed') and \
+                (state, door.last_state_time) != command.door_state
+        if done:
+            command.status = 'done'
+        elif now >= command.deadline:
+            command.status = 'failed'
+        else:
+            return None
+        del self.pending[door.id]
+        return command
+
+    def next_deadline(self):
+        if not self.pending:
+            return None
+        return min(command.deadline for command in self.pending.values())
 
 
 class Controller(object):
-    def __init__(self, config):
-        self.init_gpio()
-        self.updateHandler = None
+    def __init__(self, config, clock=None, backend=None):
+        """`clock` provides seconds() and callLater(), like the Twisted reactor.
+        Defaults to the wall clock. `backend` defaults to the one named in
+        the config, see gpio_backends."""
+        self.clock = clock or SystemClock()
+        self.backend = backend or gpio_backends.create(config)
+        self.updateHandlers = []
+        self.wakeupHandler = None
+        self.history = None
         self.config = config
-        self.doors = [Door(n, c) for (n, c) in list(config['doors'].items())]
-        for door in self.doors:
-            door.last_state = 'unknown'
-            door.last_state_time = time.time()
-
+        self.registry = DoorRegistry()
+        for (n, c) in list(config['doors'].items()):
+            self.registry.add(Door(n, c, self.backend, self.clock), 'unknown',
+                              self.clock.seconds())
+
+        self.change_log = ChangeLog(config['config'].get('change_log_size', 256))
+        self.commands = CommandQueue(config['config'].get('command_coalesce_window', 3),
+                                     config['config'].get('command_grace_time', 5))
+        self.deadlines = DeadlineQueue()
+        self.toggle_count = 0
+        self.edge_callback = None
+
+        self.dispatcher = AlertDispatcher(
+            config['alerts'].get('dispatch_queue_size', 32),
+            config['alerts'].get('dispatch_concurrency'))
+        self.http_pool = None
+        self.alert_type = self.alert_backend = self.alert_settings = None
+        self.openhab = self.openhab_settings = None
+        self.configure_alerts(config)
+
+    def configure_alerts(self, config):
+        """Apply the alert settings of `config`. A backend whose settings did
+        not change is kept, a replaced one is closed once its queued
+        deliveries are done."""
+        self.apply_alerts(config, self.prepare_alerts(config))
+
+    def prepare_alerts(self, config):
+        """Build the backends of `config` that changed, without applying them."""
+        alert_type = config['alerts']['alert_type']
+        # Copied, the config dicts may be changed in place
+        alert_settings = copy.deepcopy((alert_type, config['alerts'].get(alert_type)))
+        alert_backend = self.alert_backend
+        if alert_type is None:
+            alert_backend = None
+        elif alert_settings != self.alert_settings or alert_backend is None:
+            alert_backend = alert_backends.create(alert_type, config, self)
+        openhab_settings = None
+        if config['config'].get('use_openhab', False):
+            openhab_settings = copy.deepcopy(config.get('openhab'))
+        openhab = self.openhab
+        if openhab_settings is None:
+            openhab = None
+        elif openhab_settings != self.openhab_settings or openhab is None:
+            openhab = alert_backends.create('openhab', config, self)
+        return alert_type, alert_settings, alert_backend, openhab_settings, openhab
+
+    def discard_alerts(self, alerts):
+        """Close the backends `prepare_alerts` built when they are not applied."""
+        alert_type, _, alert_backend, _, openhab = alerts
+        if alert_backend is not None and alert_backend is not self.alert_backend:
+            self.close_backend(alert_type, alert_backend)
+        if openhab is not None and openhab is not self.openhab:
+            self.close_backend('openhab', openhab)
+
+    def apply_alerts(self, config, alerts):
+        alert_type, alert_settings, alert_backend, openhab_settings, openhab = alerts
         self.use_alerts = config['config']['use_alerts']
-        self.alert_type = config['alerts']['alert_type']
         self.time_to_wait = config['alerts']['time_to_wait']
         self.time_btw_alert_repeat = config['alerts']['time_btw_alert_repeat']
         self.open_time_to_alert = config.get('open_time_to_alert', 30)
-        if self.alert_type == 'smtp':
-            self.use_smtp = False
-            smtp_params = ("smtphost", "smtpport", "smtp_tls", "username",
-                           "password", "to_email", "time_to_wait")
-            self.use_smtp = ('smtp' in config['alerts']) and set(
-                smtp_params) <= set(config['alerts']['smtp'])
-            syslog.syslog("we are using SMTP")
-        elif self.alert_type == 'pushbullet':
-            self.pushbullet_access_token = config['alerts']['pushbullet']['access_token']
-            syslog.syslog("we are using Pushbullet")
-        elif self.alert_type == 'pushover':
-            self.pushover_user_key = config['alerts']['pushover']['user_key']
-            syslog.syslog("we are using Pushover")
+        if self.alert_backend is not None and alert_backend is not self.alert_backend:
+            self.close_backend(self.alert_type, self.alert_backend)
+        if self.openhab is not None and openhab is not self.openhab:
+            self.close_backend('openhab', self.openhab)
+        self.alert_settings, self.openhab_settings = alert_settings, openhab_settings
+        self.alert_type, self.alert_backend, self.openhab = alert_type, alert_backend, openhab
+        if self.alert_backend is not None:
+            syslog.syslog("we are using %s alerts" % self.alert_type)
         else:
             self.alert_type = None
             syslog.syslog("No alerts configured")
 
-    def init_gpio(self):
-        gpio.setwarnings(False)
-        gpio.cleanup()
-        gpio.setmode(gpio.BCM)
+    def close_backend(self, name, backend):
+        # Backends from other packages may have nothing to close
+        if hasattr(backend, 'close'):
+            self.dispatcher.submit_cleanup(name, backend.close)
+
+    def get_http_pool(self):
+        """The keep-alive connections shared by the backends, created on first use."""
+        if self.http_pool is None:
+            from http_pool import ConnectionPool
+            self.http_pool = ConnectionPool()
+        return self.http_pool
+
+    @property
+    def doors(self):
+        return self.registry.doors
+
+    @property
+    def version(self):
+        return self.change_log.version
 
     def set_update_handler(self, update_handler):
-        self.updateHandler = update_handler
+        self.updateHandlers = [update_handler]
 
-    def status_check(self):
+    def add_update_handler(self, update_handler):
+        self.updateHandlers.append(update_handler)
+
+    def set_history(self, history):
+        """Record every state transition in `history` (an EventHistory)."""
+        self.history = history
+
+    def set_wakeup_handler(self, wakeup_handler):
+        """Called whenever the controller needs a status_check outside of a
+        state pin edge, e.g. right after a toggle."""
+        self.wakeupHandler = wakeup_handler
+
+    def enable_edge_detection(self, callback):
+        """Call `callback(channel)` from the GPIO layer on every state pin edge.
+
+        Returns False when edge detection is not available, in which case
+        the caller should keep polling status_check."""
+        try:
+            for door in self.doors:
+                self.backend.add_edge_callback(door.state_pin, callback)
+        except (RuntimeError, NotImplementedError) as inst:
+            syslog.syslog("Edge detection unavailable: " + str(inst))
+            self.disable_edge_detection()
+            return False
+        self.edge_callback = callback
+        return True
+
+    def disable_edge_detection(self):
+        self.edge_callback = None
         for door in self.doors:
-            new_state = door.get_state()
+            self.remove_edge_callback(door)
+
+    def remove_edge_callback(self, door):
+        try:
+            self.backend.remove_edge_callback(door.state_pin)
+        except (RuntimeError, NotImplementedError):
+            pass
+
+    def reload(self, config):
+        """Apply a new config without losing the door states or the clients.
+
+        Doors are added, removed or reconfigured in place, only the pins that
+        changed are set up again, and the alert settings are replaced. Door
+        states, pending commands and alert times carry over; the alert and
+        travel deadlines are rescheduled with the new timings. Returns the
+        (added, removed, changed) door ids. A config that cannot be applied,
+        e.g. with a bad pin, raises and leaves the controller as it was."""
+        now = self.clock.seconds()
+        old_doors = self.config['doors']
+        new_doors = config['doors']
+        # Diffed against the registry, the doors actually running
+        added = [n for n in new_doors if self.registry.get(n) is None]
+        removed = [d.id for d in self.doors if d.id not in new_doors]
+        changed = [n for n in new_doors
+                   if self.registry.get(n) is not None and new_doors[n] != old_doors.get(n)]
+
+        # Everything that can fail is built first, a bad config changes nothing
+        alerts = self.prepare_alerts(config)
+        try:
+            new = [Door(doorId, new_doors[doorId], self.backend, self.clock)
+                   for doorId in added]
+            configured = []
+            for doorId in changed:
+                door = copy.copy(self.registry.get(doorId))
+                door.configure(new_doors[doorId])
+                configured.append(door)
+        except Exception:
+            self.discard_alerts(alerts)
+            raise
+
+        self.apply_alerts(config, alerts)
+        for doorId in removed:
+            door = self.registry.remove(doorId)
+            if self.edge_callback is not None:
+                self.remove_edge_callback(door)
+            self.deadlines.cancel(doorId, 'alert')
+            self.deadlines.cancel(doorId, 'travel')
+            self.commands.pending.pop(doorId, None)
+        for prepared in configured:
+            door = self.registry.get(prepared.id)
+            state_pin = door.state_pin
+            if self.edge_callback is not None and prepared.state_pin != state_pin:
+                self.remove_edge_callback(door)
+            vars(door).update(vars(prepared))
+            if self.edge_callback is not None and door.state_pin != state_pin:
+                self.backend.add_edge_callback(door.state_pin, self.edge_callback)
+        for door in new:
+            self.registry.add(door, 'unknown', now)
+            if self.edge_callback is not None:
+                self.backend.add_edge_callback(door.state_pin, self.edge_callback)
+
+        self.config = config
+        self.commands.coalesce_window = config['config'].get('command_coalesce_window', 3)
+        self.commands.grace = config['config'].get('command_grace_time', 5)
+        for door in self.doors:
+            self.reschedule_deadlines(door, now)
+
+        syslog.syslog('Config reloaded: %d doors added, %d removed, %d changed' % (
+            len(added), len(removed), len(changed)))
+        # New version, so the cached views and their ETags are refreshed
+        self.change_log.touch()
+        for update_handler in self.updateHandlers:
+            update_handler.handle_updates()
+        if self.wakeupHandler is not None:
+            self.wakeupHandler()
+        return added, removed, changed
+
+    def next_check_delay(self):
+        """Seconds until the next timed transition or alert is due.
+
+        Pin edges are reported by the GPIO layer, but opening => open,
+        closing => open, the open alerts and the end of a debounce only
+        depend on time. Returns None when no such deadline is pending."""
+        now = self.clock.seconds()
+        deadlines = []
+        for door in self.doors:
+            debounce_deadline = door.pin_filter.pending_deadline(now)
+            if debounce_deadline is not None:
+                deadlines.append(debounce_deadline)
+        for deadline in (self.deadlines.next_due(), self.commands.next_deadline()):
+            if deadline is not None:
+                deadlines.append(deadline)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    def status_check(self):
+        """Read every door, then handle the alert and timeout deadlines that are due."""
+        start = metrics.timer()
+        now = self.clock.seconds()
+        doors = self.doors
+        values = self.backend.read_all([door.state_pin for door in doors])
+        GPIO_READ_SECONDS.observe(metrics.timer() - start)
+        for door, value in zip(doors, values):
+            new_state = door.get_state(value)
             if (door.last_state != new_state):
-                door.last_state = new_state
-                door.last_state_time = time.time()
+                old_state = door.last_state
+                self.registry.set_state(door.id, new_state, now)
                 door.alert_sent = False
+                self.change_log.append(door.id, new_state, door.last_state_time)
+                TRANSITIONS.inc(door.id, new_state)
+                if self.history is not None:
+                    self.history.record(door.id, new_state, door.last_state_time)
                 self.notify_state_change(door, new_state)
-
-            send_open_alert = False
-            if (new_state == 'open') and door.alert_sent and (
-                    time.time() - door.alert_sent_time >= self.time_btw_alert_repeat):
-                send_open_alert = True
-            if (new_state == 'open' and not door.alert_sent and time.time(
-            ) - door.open_time >= self.time_to_wait + door.time_to_open):
-                send_open_alert = True
-
-            if send_open_alert:
-                if self.use_alerts:
-                    elapsed_time = int(time.time() - door.open_time)
-                    title = "%s%s%s" % (door.name, door.in_sentence, new_state)
-                    message = "%s%shas been open for %s" % (
-                        door.name, door.in_sentence, format_seconds(elapsed_time))
-                    self.send_alert(door, title, message)
-                    door.alert_sent = True
-                    door.confirm_close = True
-                    door.alert_sent_time = time.time()
-
-            if new_state == 'closed':
-                if self.use_alerts:
-                    if door.confirm_close is True:
-                        elapsed_time = int(time.time() - door.open_time)
-                        title = "%s%s%s" % (
-                            door.name, door.in_sentence, new_state)
-                        message = "%s%sis now closed being open for %s " % (
-                            door.name, door.in_sentence, format_seconds(elapsed_time))
-                        self.send_alert(door, title, message)
-                door.open_time = time.time()
-                door.confirm_close = False
-                door.alert_sent = False
+                if old_state == 'closed':
+                    door.open_time = now
+                self.schedule_deadlines(door, new_state, now)
+
+        for doorId, kind in self.deadlines.pop_due(now):
+            door = self.registry.get(doorId)
+            if door is not None and kind == 'alert' and door.last_state == 'open':
+                self.send_open_alert(door, now)
+            # 'travel' deadlines only wake the status check, the state was read above
+
+        for doorId in list(self.commands.pending):
+            door = self.registry.get(doorId)
+            if door is None:
+                del self.commands.pending[doorId]
+                continue
+            command = self.commands.check(door, now)
+            if command is not None:
+                self.notify_command(command)
+        STATUS_CHECK_SECONDS.observe(metrics.timer() - start)
+
+    def schedule_deadlines(self, door, new_state, now):
+        self.deadlines.cancel(door.id, 'alert')
+        if new_state == 'opening':
+            self.deadlines.schedule(door.id, 'travel', door.last_action_time + door.time_to_open)
+        elif new_state == 'closing':
+            self.deadlines.schedule(door.id, 'travel', door.last_action_time + door.time_to_close)
+        else:
+            self.deadlines.cancel(door.id, 'travel')
+
+        if new_state == 'open' and self.use_alerts:
+            self.deadlines.schedule(
+                door.id, 'alert', door.open_time + self.time_to_wait + door.time_to_open)
+        elif new_state == 'closed':
+            if self.use_alerts and door.confirm_close is True:
+                elapsed_time = int(now - door.open_time)
+                title = "%s%s%s" % (door.name, door.in_sentence, new_state)
+                message = "%s%sis now closed being open for %s " % (
+                    door.name, door.in_sentence, format_seconds(elapsed_time))
+                self.send_alert(door, title, message)
+            door.open_time = now
+            door.confirm_close = False
+            door.alert_sent = False
+
+    def get_snapshot(self):
+        """The state of each door worth keeping across a restart, see snapshot.py."""
+        return dict((door.id, {
+            'state': door.last_state,
+            'state_time': door.last_state_time,
+            'last_action': door.last_action,
+            'last_action_time': door.last_action_time,
+            'open_time': door.open_time,
+            'alert_sent': door.alert_sent,
+            'alert_sent_time': door.alert_sent_time,
+            'confirm_close': door.confirm_close,
+        }) for door in self.doors if door.last_state != 'unknown')
+
+    def restore_snapshot(self, doors):
+        """Resume the doors of a snapshot taken before a restart, return how many.
+
+        Must run before the first status_check, which then compares the
+        restored states with the pins: only the doors that moved while the
+        controller was stopped are announced. The alert and travel
+        deadlines keep their original due times."""
+        now = self.clock.seconds()
+        restored = 0
+        for doorId, saved in doors.items():
+            door = self.registry.get(doorId)
+            if door is None or door.last_state != 'unknown':
+                continue
+            try:
+                state, state_time = saved['state'], float(saved['state_time'])
+                fields = dict((name, saved[name]) for name in (
+                    'last_action', 'last_action_time', 'open_time',
+                    'alert_sent', 'alert_sent_time', 'confirm_close'))
+            except (KeyError, TypeError, ValueError) as e:
+                syslog.syslog('%s: skipping malformed snapshot entry: %r' % (door.name, e))
+                continue
+            for name, value in fields.items():
+                setattr(door, name, value)
+            self.registry.set_state(doorId, state, state_time)
+            self.reschedule_deadlines(door, now)
+            restored += 1
+        return restored
+
+    def reschedule_deadlines(self, door, now):
+        """Schedule the deadlines of the current state of `door` from its saved times."""
+        if door.last_state in ('opening', 'closing', 'open'):
+            self.schedule_deadlines(door, door.last_state, now)
+        else:
+            self.deadlines.cancel(door.id, 'alert')
+            self.deadlines.cancel(door.id, 'travel')
+        if door.last_state == 'open' and door.alert_sent and self.use_alerts:
+            self.deadlines.schedule(
+                door.id, 'alert', door.alert_sent_time + self.time_btw_alert_repeat)
+
+    def send_open_alert(self, door, now):
+        elapsed_time = int(now - door.open_time)
+        title = "%s%s%s" % (door.name, door.in_sentence, door.last_state)
+        message = "%s%shas been open for %s" % (
+            door.name, door.in_sentence, format_seconds(elapsed_time))
+        self.send_alert(door, title, message)
+        door.alert_sent = True
+        door.confirm_close = True
+        door.alert_sent_time = now
+        self.deadlines.schedule(door.id, 'alert', now + self.time_btw_alert_repeat)
 
     def notify_state_change(self, door, new_state):
         syslog.syslog('%s: %s => %s' % (door.name, door.last_state, new_state))
-        if self.updateHandler is not None:
-            self.updateHandler.handle_updates()
-        if self.config['config']['use_openhab'] and (
+        for update_handler in self.updateHandlers:
+            update_handler.handle_updates()
+        if self.openhab is not None and (
                 new_state == "open" or new_state == "closed"):
-            self.update_openhab(door.openhab_name, new_state)
+            self.dispatcher.submit('openhab', self.openhab.send_state, door, new_state)
+
+    def notify_command(self, command):
+        syslog.syslog('Command %d on %s: %s' % (command.id, command.door_id, command.status))
+        self.change_log.append_command(command.as_update())
+        for update_handler in self.updateHandlers:
+            update_handler.handle_updates()
 
     def send_alert(self, door, title, message):
-        if self.alert_type == 'smtp':
-            self.send_email(title, message)
-        elif self.alert_type == 'pushbullet':
-            self.send_pushbullet(door, title, message)
-        elif self.alert_type == 'pushover':
-            self.send_pushover(door, title, message)
-
-    def send_email(self, title, message):
-        try:
-            if self.use_smtp:
-                syslog.syslog("Sending email message")
-                config = self.config['alerts']['smtp']
-
-                message = MIMEText(message)
-                message['Date'] = formatdate()
-                message['From'] = config["username"]
-                message['To'] = config["to_email"]
-                message['Subject'] = config["subject"]
-                message['Message-ID'] = make_msgid()
-
-                server = smtplib.SMTP(config["smtphost"], config["smtpport"])
-                if (config["smtp_tls"] == "True"):
-                    server.starttls()
-                server.login(config["username"], config["password"])
-                server.sendmail(config["username"],
-                                config["to_email"], message.as_string())
-                server.close()
-        except Exception as inst:
-            syslog.syslog("Error sending email: " + str(inst))
-
-    def send_pushbullet(self, door, title, message):
-        try:
-            syslog.syslog("Sending pushbutton message")
-            config = self.config['alerts']['pushbullet']
-
-            if door.pb_iden is not None:
-                for token in config['access_token']:
-                    conn = httpclient.HTTPSConnection("api.pushbullet.com:443")
-                    conn.request("DELETE", '/v2/pushes/' + door.pb_iden, "",
-                                 {'Authorization': 'Bearer ' + token,
-                                  'Content-Type': 'application/json'})
-                    conn.getresponse()
-                    conn.close()
-                door.pb_iden = None
-
-            for token in config['access_token']:
-                conn = httpclient.HTTPSConnection("api.pushbullet.com:443")
-                conn.request("POST", "/v2/pushes",
-                             json.dumps({
-                                 "type": "note",
-                                 "title": title,
-                                 "body": message,
-                             }), {'Authorization': 'Bearer ' + token,
-                                  'Content-Type': 'application/json'})
-                response = conn.getresponse().read()
-                door.pb_iden = json.loads(response.decode('utf-8'))['iden']
-                conn.close()
-
-        except Exception as inst:
-            syslog.syslog("Error sending to pushbullet: " + str(inst))
-
-    def send_pushover(self, door, title, message):
-        try:
-            syslog.syslog("Sending Pushover message")
-            config = self.config['alerts']['pushover']
-            conn = httpclient.HTTPSConnection("api.pushover.net:443")
-            conn.request("POST", "/1/messages.json",
-                         urllib.urlencode({
-                             "token": config['api_key'],
-                             "user": config['user_key'],
-                             "title": title,
-                             "message": message,
-                         }), {"Content-type": "application/x-www-form-urlencoded"})
-            conn.getresponse()
-            conn.close()
-        except Exception as inst:
-            syslog.syslog("Error sending to pushover: " + str(inst))
-
-    def update_openhab(self, item, state):
-        try:
-            syslog.syslog("Updating openhab")
-            config = self.config['openhab']
-            conn = httpclient.HTTPConnection(
-                "%s:%s" % (config['server'], config['port']))
-            conn.request("PUT", "/rest/items/%s/state" % item, state)
-            conn.getresponse()
-            conn.close()
-        except Exception as inst:
-            syslog.syslog("Error updating openhab: " + str(inst))
+        """Queue the alert on the dispatcher, the delivery runs off the status loop."""
+        ALERTS.inc(door.id)
+        if self.alert_backend is not None:
+            self.dispatcher.submit(self.alert_type, self.alert_backend.send, door, title, message)
 
     def toggle(self, doorId):
-        for d in self.doors:
-            if d.id == doorId:
-                syslog.syslog('%s: toggled' % d.name)
-                d.toggle_relay()
-                return
+        d = self.registry.get(doorId)
+        if d is None:
+            return False
+        if not d.toggle_relay():
+            syslog.syslog('%s: toggle ignored, relay busy' % d.name)
+            return False
+        syslog.syslog('%s: toggled' % d.name)
+        self.toggle_count += 1
+        if self.wakeupHandler is not None:
+            self.wakeupHandler()
+        return True
+
+    def submit_toggle(self, doorId):
+        """Toggle the door through its command queue, return the Command.
+
+        Returns the pending command when the toggle is merged into it, and
+        None when the door is unknown or its relay is busy."""
+        d = self.registry.get(doorId)
+        if d is None:
+            return None
+        now = self.clock.seconds()
+        command = self.commands.get_pending(doorId, now)
+        if command is not None:
+            command.requests += 1
+            syslog.syslog('%s: toggle merged into command %d' % (d.name, command.id))
+            return command
+
+        action = {'open': 'close', 'closed': 'open'}.get(d.last_state)
+        if not self.toggle(doorId):
+            return None
+        command, replaced = self.commands.add(d, action, now)
+        if replaced is not None:
+            self.notify_command(replaced)
+        self.notify_command(command)
+        return command
+
+    def get_etag(self):
+        """Strong entity tag of the door states, changes with every transition or toggle."""
+        return '"%d-%d"' % (self.version, self.toggle_count)
+
+    def get_changes(self, version):
+        return self.change_log.get_changes(version, self.doors)
+
+    def get_command_changes(self, version):
+        return self.change_log.get_command_changes(version, self.commands.pending.values())
 
     def get_updates(self, lastupdate):
-        updates = []
-        for d in self.doors:
-            if d.last_state_time >= lastupdate:
-                updates.append((d.id, d.last_state, d.last_state_time))
-        return updates
+        return [(d.id, d.last_state, d.last_state_time)
+                for d in self.registry.changed_since(lastupdate)]
 
 
 def format_seconds(num_seconds):
@@ -0,0 +1,309 @@
+# Federate several garage_server instances behind one dashboard.
+#
+# The hub keeps one upstream connection per site: it reads the site doors
+# from /cfg, then long-polls /upd and merges every update into a single
+# view. Browsers and scripts talk to the hub only, with the same /cfg,
+# /upd, /evt, /doors and /clk resources as a single garage_server.
+
+import base64
+import json
+import sys
+import syslog
+
+if sys.version_info < (3,):
+    from urllib import quote
+else:
+    from urllib.parse import quote
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.web import http, server
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+import session_auth
+from clock import SystemClock
+from garage_controller import ChangeLog, Command, DoorRegistry
+from garage_server import ClickHandler, ConfigHandler, DoorsHandler, \
+    EventStreamHandler, SessionGuard, StaticFile, UpdateHandler, UptimeHandler, \
+    create_session_auth
+from host_health import HostHealth
+
+
+class HubDoor(object):
+    last_action = None
+    last_action_time = None
+    registry = None
+    # The site follows the commands, the hub only forwards them
+    time_to_open = time_to_close = 0
+
+    def __init__(self, doorId, site, remote_id, name):
+        self.id = doorId
+        self.site = site
+        self.remote_id = remote_id
+        self.name = name
+
+    @property
+    def last_state(self):
+        return self.registry.get_state(self.id)[0]
+
+    @property
+    def last_state_time(self):
+        return self.registry.get_state(self.id)[1]
+
+
+class HubView(object):
+    """Merged doors of every site, with the change log interface of Controller.
+
+    Hub door ids are "<site>-<door>"; the view remembers the site and the
+    remote id of each door, ids are never split."""
+
+    def __init__(self, change_log_size=1024, clock=None):
+        self.clock = clock or SystemClock()
+        self.registry = DoorRegistry()
+        self.sites = {}
+        self.updateHandlers = []
+        self.change_log = ChangeLog(change_log_size)
+        self.toggle_count = 0
+        self.next_command_id = 1
+
+    @property
+    def doors(self):
+        return self.registry.doors
+
+    @property
+    def version(self):
+        return self.change_log.version
+
+    def add_site(self, site_client):
+        self.sites[site_client.site_id] = site_client
+
+    def add_update_handler(self, update_handler):
+        self.updateHandlers.append(update_handler)
+
+    def update_door(self, site_id, remote_id, name, state, state_time):
+        """Merge a remote door state, return True if it changed."""
+        doorId = '%s-%s' % (site_id, remote_id)
+        door = self.registry.get(doorId)
+        if door is None:
+            door = HubDoor(doorId, site_id, remote_id, name or remote_id)
+            self.registry.add(door, state, state_time)
+        elif (door.last_state, door.last_state_time) == (state, state_time):
+            return False
+        else:
+            if name is not None:
+                door.name = name
+            self.registry.set_state(doorId, state, state_time)
+        self.change_log.append(doorId, state, state_time)
+        return True
+
+    def notify_updates(self):
+        for update_handler in self.updateHandlers:
+            update_handler.handle_updates()
+
+    def get_etag(self):
+        return '"%d-%d"' % (self.version, self.toggle_count)
+
+    def get_changes(self, version):
+        return self.change_log.get_changes(version, self.doors)
+
+    def get_command_changes(self, version):
+        return []
+
+    def get_updates(self, lastupdate):
+        return [(d.id, d.last_state, d.last_state_time)
+                for d in self.registry.changed_since(lastupdate)]
+
+    def is_monitor_only(self, doorId):
+        door = self.registry.get(doorId)
+        return door is not None and self.sites[door.site].monitor_only
+
+    def toggle(self, doorId):
+        door = self.registry.get(doorId)
+        if door is None or self.is_monitor_only(doorId):
+            return False
+        self.toggle_count += 1
+        self.sites[door.site].toggle(door.remote_id)
+        return True
+
+    def submit_toggle(self, doorId):
+        """Forward the toggle, return a Command reporting it as forwarded."""
+        door = self.registry.get(doorId)
+        if door is None or not self.toggle(doorId):
+            return None
+        command = Command(self.next_command_id, door, None, self.clock.seconds(), 0)
+        command.status = 'forwarded'
+        self.next_command_id += 1
+        return command
+
+
+class SiteClient(object):
+    """Upstream connection to one garage_server, over the shared agent.
+
+    Clicks send the session cookie the site handed out on the first
+    login, Basic credentials only go out again when it is refused."""
+    retry_delay = 10
+    poll_timeout = 300
+
+    def __init__(self, view, site_id, config, agent, clock=reactor):
+        self.view = view
+        self.site_id = site_id
+        self.url = config['url'].rstrip('/')
+        self.name = config.get('name', site_id)
+        self.monitor_only = config.get('monitor_only', False)
+        self.headers = {}
+        if config.get('username'):
+            credentials = '%s:%s' % (config['username'], config.get('password', ''))
+            self.headers[b'Authorization'] = [
+                b'Basic ' + base64.b64encode(str.encode(credentials))]
+        self.agent = agent
+        self.clock = clock
+        self.version = None
+        self.cookie = None
+
+    def get(self, path):
+        url = str.encode('%s/%s' % (self.url, path))
+        d = self.agent.request(b'GET', url, Headers(self.headers))
+        d.addCallback(readBody)
+        return d
+
+    def get_json(self, path):
+        d = self.get(path)
+        d.addCallback(lambda body: json.loads(body.decode('utf-8')))
+        return d
+
+    def start(self):
+        d = self.get_json('cfg')
+        d.addCallback(self.on_config)
+        d.addCallbacks(self.poll_next, self.on_error)
+        return d
+
+    def poll_next(self, _):
+        # Not returned, chaining every poll would keep them all alive
+        self.poll()
+
+    def on_config(self, doors):
+        changed = False
+        for doorId, name, state, state_time in doors:
+            changed |= self.view.update_door(
+                self.site_id, doorId, '%s %s' % (self.name, name), state, state_time)
+        if changed:
+            self.view.notify_updates()
+
+    def poll(self):
+        if self.version is None:
+            path = 'upd?lastupdate=0'
+        else:
+            path = 'upd?version=%d' % self.version
+        d = self.get_json(path)
+        d.addTimeout(self.poll_timeout, self.clock)
+        d.addCallback(self.on_updates)
+        d.addCallbacks(self.poll_next, self.on_error)
+        return d
+
+    def on_updates(self, response):
+        self.version = response.get('version')
+        changed = False
+        for doorId, state, state_time in response['update']:
+            changed |= self.view.update_door(self.site_id, doorId, None, state, state_time)
+        if changed:
+            self.view.notify_updates()
+
+    def on_error(self, failure):
+        if failure.check(defer.TimeoutError):
+            # Nothing changed during the long poll
+            self.poll()
+            return
+        syslog.syslog('Hub: lost site %s: %s' % (self.site_id, failure.getErrorMessage()))
+        self.version = None
+        self.clock.callLater(self.retry_delay, self.start)
+
+    def toggle(self, doorId):
+        d = self.click('clk?id=%s' % quote(doorId), self.cookie is not None)
+        d.addErrback(lambda failure: syslog.syslog(
+            'Hub: toggle on %s failed: %s' % (self.site_id, failure.getErrorMessage())))
+        return d
+
+    def click(self, path, with_cookie):
+        headers = {b'Cookie': [self.cookie]} if with_cookie else self.headers
+        url = str.encode('%s/%s' % (self.url, path))
+        d = self.agent.request(b'GET', url, Headers(headers))
+        d.addCallback(self.on_click, path, with_cookie)
+        return d
+
+    def on_click(self, response, path, with_cookie):
+        if response.code == 401 and with_cookie:
+            # The session expired, or the site restarted
+            self.cookie = None
+            d = readBody(response)
+            d.addCallback(lambda _: self.click(path, False))
+            return d
+        for cookie in response.headers.getRawHeaders(b'set-cookie', []):
+            cookie = cookie.split(b';')[0].strip()
+            if cookie.startswith(session_auth.COOKIE_NAME + b'='):
+                self.cookie = cookie
+        return readBody(response)
+
+
+class HubClickHandler(ClickHandler):
+    """Forwards clicks, except on the doors of monitor only sites."""
+
+    def render_GET(self, request):
+        door = bytes.decode(request.args.get(b'id', [b''])[0])
+        if self.controller.is_monitor_only(door):
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(http.FORBIDDEN)
+            return b'{"error": "monitor only site"}'
+        return ClickHandler.render_GET(self, request)
+
+
+def main(args):
+    syslog.openlog('garage_hub')
+
+    config_filename = 'hub.json'
+    if len(sys.argv) == 2:
+        config_filename = sys.argv[1]
+
+    config_file = open(config_filename)
+    config = json.load(config_file)
+    config_file.close()
+
+    view = HubView(clock=reactor)
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = 2
+    agent = Agent(reactor, pool=pool)
+    for site_id, site_config in sorted(config['sites'].items()):
+        site_client = SiteClient(view, site_id, site_config, agent)
+        view.add_site(site_client)
+        site_client.start()
+
+    update_handler = UpdateHandler(view)
+    event_handler = EventStreamHandler(view)
+    view.add_update_handler(update_handler)
+    view.add_update_handler(event_handler)
+
+    root = StaticFile(config['site'].get('static_dir', 'www'))
+    root.putChild(b'cfg', ConfigHandler(view))
+    root.putChild(b'doors', DoorsHandler(view))
+    root.putChild(b'upd', update_handler)
+    root.putChild(b'evt', event_handler)
+    # The uptime shown by the dashboard is the hub's own
+    health = HostHealth()
+    root.putChild(b'upt', UptimeHandler(health))
+    task.LoopingCall(health.sample).start(config['site'].get('health_interval', 30))
+    if not config['site'].get('monitor_only', False):
+        click_handler = HubClickHandler(view)
+        if config['site'].get('use_auth', True):
+            click_handler = SessionGuard(click_handler,
+                                         create_session_auth(config['site'], reactor),
+                                         config['site'].get('secure_cookie', False))
+        root.putChild(b'clk', click_handler)
+    task.LoopingCall(event_handler.send_heartbeat).start(15, now=False)
+
+    reactor.listenTCP(config['site']['port'], server.Site(root))  # @UndefinedVariable
+    reactor.run()  # @UndefinedVariable
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+# Sampler process of the two process mode: owns the GPIO pins and the
+# Controller, publishes the doors into the shared state table and takes
+# toggles from the web process over the command socket.
+#
+#   python3 garage_sampler.py [config_file]
+#
+# Run it next to garage_server.py with "use_sampler_process": true in the
+# config section; the web process can then restart without touching the
+# pins.
+
+import json
+import sys
+import syslog
+
+from twisted.internet import reactor
+
+import shared_state
+from garage_controller import Controller
+from garage_server import GarageDoorServer, create_gpio_backend
+
+
+def main(args):
+    syslog.openlog('garage_sampler')
+
+    config_filename = 'config.json'
+    if len(sys.argv) == 2:
+        config_filename = sys.argv[1]
+
+    syslog.syslog('Config file: %s' % config_filename)
+    config_file = open(config_filename)
+    config = json.load(config_file)
+    config_file.close()
+
+    controller = Controller(config, reactor, create_gpio_backend(config))
+    table = shared_state.StateTable(
+        config['config'].get('state_table', shared_state.DEFAULT_TABLE),
+        max(32, len(controller.doors)), create=True)
+    publisher = shared_state.StatePublisher(controller, table)
+    controller.set_update_handler(publisher)
+
+    # The status loop, edge detection and history of the server, without its web side
+    sampler = GarageDoorServer(controller, config, reactor, table.max_doors)
+    sampler.start_snapshots()
+    publisher.handle_updates()
+    sampler.start_status_check()
+    sampler.start_history()
+    sampler.watch_config(config_filename)
+
+    reactor.listenUNIX(  # @UndefinedVariable
+        config['config'].get('command_socket', shared_state.DEFAULT_SOCKET),
+        shared_state.CommandServerFactory(controller, publisher), wantPID=True)
+    reactor.run()  # @UndefinedVariable
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
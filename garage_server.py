@@ -1,39 +1,89 @@
-from garage_controller import Controller
-
+from garage_controller import Controller, format_seconds
+from history import EventHistory
+from host_health import HostHealth
+
+import gpio_backends
+import gpio_trace
+import metrics
+import session_auth
+import shared_state
+import snapshot
+
+import base64
+import binascii
 import json
+import math
+import os
+import re
+import signal
 import syslog
-import time
-import subprocess
 import sys
-import re
 
-from twisted.cred import checkers, portal
+from twisted.internet import defer
 from twisted.internet import task
+from twisted.internet import threads
 from twisted.internet import reactor
 from twisted.internet import ssl
+from twisted.python.failure import Failure
+from twisted.web import http
 from twisted.web import server
-from twisted.web.guard import HTTPAuthSessionWrapper, BasicCredentialFactory
-from twisted.web.resource import Resource, IResource
+from twisted.web.resource import Resource
 from twisted.web.static import File
-from zope.interface import implementer
 
 
-@implementer(portal.IRealm)
-class HttpPasswordRealm(object):
-    def __init__(self, myresource):
-        self.myresource = myresource
-
-    def requestAvatar(self, user, mind, *interfaces):
-        if IResource in interfaces:
-            return (IResource, self.myresource, lambda: None)
-        raise NotImplementedError()
+# Settings of the config section only read at startup, kept on a config reload
+RESTART_SETTINGS = ('gpio_backend', 'record_trace', 'use_https', 'use_auth', 'use_edge_detect',
+                    'use_history', 'use_snapshot', 'use_sampler_process', 'state_table',
+                    'command_socket')
+
+
+def check_config(config):
+    """Raise ValueError if a setting the controller needs is missing or mistyped."""
+    for section in ('config', 'doors', 'alerts', 'site'):
+        if not isinstance(config.get(section), dict):
+            raise ValueError('no %s section' % section)
+    if not isinstance(config['config'].get('use_alerts'), bool):
+        raise ValueError('use_alerts must be true or false')
+    alerts = config['alerts']
+    for key in ('time_to_wait', 'time_btw_alert_repeat'):
+        value = alerts.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError('alerts %s must be a number of seconds' % key)
+    if 'alert_type' not in alerts or not isinstance(alerts['alert_type'], (str, type(None))):
+        raise ValueError('alerts alert_type must be a backend name or null')
+    for doorId, door in config['doors'].items():
+        if not isinstance(door, dict):
+            raise ValueError('door %s is not an object' % doorId)
+        for key in ('name', 'in_sentence', 'relay_pin', 'state_pin'):
+            if key not in door:
+                raise ValueError('door %s has no %s' % (doorId, key))
 
 
 class GarageDoorServer:
-    def __init__(self, controller, config):
+    def __init__(self, controller, config, clock=reactor, max_doors=None):
+        """`max_doors` caps the doors a config reload may bring, the size of
+        the shared state table in two process mode."""
         self.controller = controller
+        self.max_doors = max_doors
         self.config = config
+        self.clock = clock
         self.updateHandler = UpdateHandler(self.controller)
+        self.eventHandler = EventStreamHandler(self.controller)
+        self.pending_check = None
+        self.config_watcher = None
+        self.health = HostHealth()
+        self.history = None
+        if self.get_config_with_default(config['config'], 'use_history', False):
+            history_config = config.get('history', {})
+            self.history = EventHistory(
+                self.get_config_with_default(history_config, 'path', 'history.db'),
+                self.get_config_with_default(history_config, 'ring_size', 256),
+                self.get_config_with_default(history_config, 'flush_interval', 5))
+            self.controller.set_history(self.history)
+        metrics.Gauge('garage_longpoll_waiting', 'Requests waiting on /upd',
+                      self.updateHandler.waiting_count)
+        metrics.Gauge('garage_connected_clients', 'Clients waiting on /upd or streaming /evt',
+                      lambda: self.updateHandler.waiting_count() + len(self.eventHandler.streams))
 
     def get_config_with_default(self, config, param, default):
         if not config:
@@ -42,29 +92,165 @@ class GarageDoorServer:
             return default
         return config[param]
 
+    def start_status_check(self):
+        if self.get_config_with_default(self.config['config'], 'use_edge_detect', False):
+            if self.controller.enable_edge_detection(self.on_edge):
+                syslog.syslog("Using edge triggered status checks")
+                self.controller.set_wakeup_handler(self.schedule_status_check)
+                self.schedule_status_check()
+                return
+            syslog.syslog("Falling back to polled status checks")
+        self.looping_call(self.controller.status_check).start(0.5)
+
+    def looping_call(self, func):
+        call = task.LoopingCall(func)
+        call.clock = self.clock
+        return call
+
+    def on_edge(self, channel):
+        if self.clock is reactor:
+            # RPi.GPIO runs edge callbacks on its own thread
+            reactor.callFromThread(self.schedule_status_check)  # @UndefinedVariable
+        else:
+            self.schedule_status_check()
+
+    def schedule_status_check(self, delay=0):
+        if self.pending_check is not None and self.pending_check.active():
+            self.pending_check.cancel()
+        self.pending_check = self.clock.callLater(delay, self.edge_status_check)
+
+    def edge_status_check(self):
+        self.pending_check = None
+        self.controller.status_check()
+        # Missed edges are caught by a slow safety check
+        delay = self.get_config_with_default(
+            self.config['config'], 'edge_safety_interval', 60)
+        next_delay = self.controller.next_check_delay()
+        if next_delay is not None:
+            delay = min(delay, next_delay)
+        self.schedule_status_check(delay)
+
+    def get_static_dir(self):
+        static_dir = self.get_config_with_default(self.config['site'], 'static_dir', None)
+        if static_dir is not None:
+            return static_dir
+        # Use the output of build_assets.py when it has been built
+        if os.path.exists(os.path.join('www-dist', 'index.html')):
+            return 'www-dist'
+        return 'www'
+
+    def start_history(self):
+        if self.history is not None:
+            self.history.start()
+            reactor.addSystemEventTrigger(  # @UndefinedVariable
+                'before', 'shutdown', self.history.stop)
+
+    def watch_config(self, path):
+        """Reload the config from `path` on SIGHUP, and when its modification time changes."""
+        self.config_path = path
+        self.config_mtime = self.get_config_mtime()
+        signal.signal(signal.SIGHUP, lambda signum, frame: (
+            reactor.callFromThread(self.reload_config)))  # @UndefinedVariable
+        interval = self.get_config_with_default(self.config['config'], 'config_poll_interval', 5)
+        if interval:
+            self.config_watcher = self.looping_call(self.check_config_mtime)
+            self.config_watcher.start(interval, now=False)
+
+    def get_config_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return None
+
+    def check_config_mtime(self):
+        mtime = self.get_config_mtime()
+        if mtime is not None and mtime != self.config_mtime:
+            self.reload_config()
+
+    def reload_config(self):
+        """Apply the config file to the running controller, keep the old one if it is invalid."""
+        self.config_mtime = self.get_config_mtime()
+        try:
+            with open(self.config_path) as config_file:
+                config = json.load(config_file)
+            check_config(config)
+        except (OSError, ValueError) as inst:
+            syslog.syslog('Config reload of %s failed, keeping the running config: %s' % (
+                self.config_path, inst))
+            return False
+        if self.max_doors is not None and len(config['doors']) > self.max_doors:
+            syslog.syslog('Config reload of %s needs a restart: %d doors, the state table '
+                          'holds %d' % (self.config_path, len(config['doors']), self.max_doors))
+            return False
+        # The listening sockets, authentication and GPIO backend are set up once
+        for key in RESTART_SETTINGS:
+            if config['config'].get(key) != self.config['config'].get(key):
+                syslog.syslog('Config reload: %s needs a restart' % key)
+            if key in self.config['config']:
+                config['config'][key] = self.config['config'][key]
+            else:
+                config['config'].pop(key, None)
+        if config.get('site') != self.config.get('site'):
+            syslog.syslog('Config reload: the site section needs a restart')
+        config['site'] = self.config['site']
+        try:
+            self.controller.reload(config)
+        except Exception as inst:
+            # Raising would also stop the LoopingCall watching the file
+            syslog.syslog('Config reload of %s failed, keeping the running config: %r' % (
+                self.config_path, inst))
+            return False
+        self.config = config
+        return True
+
+    def start_snapshots(self):
+        """Restore the door states saved before a restart, then save them at
+        intervals and on shutdown. Call before start_status_check."""
+        if not self.get_config_with_default(self.config['config'], 'use_snapshot', False):
+            return
+        snapshot_config = self.config.get('snapshot', {})
+        path = self.get_config_with_default(snapshot_config, 'path', 'snapshot.json')
+        doors = snapshot.load(path)
+        if doors is not None:
+            syslog.syslog('Restored %d doors from %s' % (
+                self.controller.restore_snapshot(doors), path))
+        writer = snapshot.SnapshotWriter(self.controller, path)
+        self.looping_call(writer.write).start(
+            self.get_config_with_default(snapshot_config, 'interval', 60), now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', writer.write)  # @UndefinedVariable
+
     def run(self):
-        task.LoopingCall(self.controller.status_check).start(0.5)
-        root = File('www')
-        root.putChild(b'st', StatusHandler(self))
+        if self.get_config_with_default(self.config['config'], 'use_sampler_process', False):
+            # The sampler process reads the doors, follow its state table
+            self.looping_call(self.controller.refresh).start(
+                self.get_config_with_default(self.config['config'], 'state_poll_interval', 1))
+        else:
+            self.start_snapshots()
+            self.start_status_check()
+        root = StaticFile(self.get_static_dir())
+        root.putChild(b'st', StatusHandler(self.controller))
+        root.putChild(b'doors', DoorsHandler(self.controller))
         root.putChild(b'upd', self.updateHandler)
+        root.putChild(b'evt', self.eventHandler)
+        self.looping_call(self.eventHandler.send_heartbeat).start(
+            self.get_config_with_default(self.config['site'], 'heartbeat_interval', 15),
+            now=False)
         root.putChild(b'cfg', ConfigHandler(self.controller))
-        root.putChild(b'upt', UptimeHandler(self))
+        root.putChild(b'upt', UptimeHandler(self.health))
+        root.putChild(b'health', HealthHandler(self.health))
+        root.putChild(b'metrics', MetricsHandler())
+        if self.history is not None:
+            root.putChild(b'history', HistoryHandler(self.history))
+            self.start_history()
+        self.looping_call(self.health.sample).start(
+            self.get_config_with_default(self.config['site'], 'health_interval', 30))
 
         if not self.config['site']['monitor_only']:
             if self.config['config']['use_auth']:
-                click_handler = ClickHandler(self.controller)
-                username = self.config['site']['username']
-                password = self.config['site']['password'].encode('utf-8')
-                args = {username: password}
-                checker = checkers.InMemoryUsernamePasswordDatabaseDontUse(
-                    **args)
-                realm = HttpPasswordRealm(click_handler)
-                p = portal.Portal(realm, [checker])
-                credentialFactory = BasicCredentialFactory(
-                    "Garage Door Controller")
-                protected_resource = HTTPAuthSessionWrapper(
-                    p, [credentialFactory])
-                root.putChild(b'clk', protected_resource)
+                auth = create_session_auth(self.config['site'], self.clock)
+                root.putChild(b'clk', SessionGuard(ClickHandler(self.controller), auth,
+                                                   self.get_config_with_default(
+                                                       self.config['config'], 'use_https', False)))
             else:
                 root.putChild(b'clk', ClickHandler(self.controller))
         site = server.Site(root)
@@ -82,6 +268,51 @@ class GarageDoorServer:
             reactor.run()  # @UndefinedVariable
 
 
+class StaticFile(File):
+    """Static files with precompressed variants and long lived hashed assets.
+
+    A request accepting gzip or brotli gets the `.gz` or `.br` file written
+    by build_assets.py next to the original, when there is one. Files with
+    a content hash in their name never change and are cached for a year;
+    everything else is revalidated."""
+    contentEncodings = dict(File.contentEncodings, **{'.br': 'br'})
+    hashed_name = re.compile(r'\.[0-9a-f]{10}\.\w+$')
+    variants = [('br', '.br'), ('gzip', '.gz')]
+
+    def accepted_encodings(self, request):
+        header = request.getHeader('Accept-Encoding') or ''
+        encodings = set()
+        for item in header.split(','):
+            fields = item.strip().split(';')
+            if fields[1:] and fields[1].strip() in ('q=0', 'q=0.0'):
+                continue
+            encodings.add(fields[0].strip().lower())
+        return encodings
+
+    def render_GET(self, request):
+        extension = os.path.splitext(self.basename())[1]
+        if self.isdir() or extension in self.contentEncodings:
+            return File.render_GET(self, request)
+
+        if self.hashed_name.search(self.basename()):
+            request.setHeader('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+            request.setHeader('Cache-Control', 'no-cache')
+
+        accepted = self.accepted_encodings(request)
+        variants = [(encoding, self.siblingExtension(suffix))
+                    for encoding, suffix in self.variants]
+        variants = [(encoding, variant) for encoding, variant in variants if variant.exists()]
+        if variants:
+            # On the plain response too, or a shared cache hands it to every client
+            request.setHeader('Vary', 'Accept-Encoding')
+        for encoding, variant in variants:
+            if encoding in accepted:
+                compressed = self.createSimilarFile(variant.path)
+                return compressed.render_GET(request)
+        return File.render_GET(self, request)
+
+
 class ClickHandler(Resource):
     isLeaf = True
 
@@ -90,9 +321,138 @@ class ClickHandler(Resource):
         self.controller = controller
 
     def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        if not request.args.get(b'id'):
+            request.setResponseCode(http.BAD_REQUEST)
+            return b'{"error": "no door id"}'
         door = bytes.decode(request.args[b'id'][0])
-        self.controller.toggle(door)
-        return b'OK'
+        if self.controller.registry.get(door) is None:
+            request.setResponseCode(http.NOT_FOUND)
+            return b'{"error": "unknown door"}'
+        command = self.controller.submit_toggle(door)
+        if not isinstance(command, defer.Deferred):
+            return self.format_command(request, command.as_update() if command else None)
+
+        # Toggles through the sampler process answer later
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        command.addCallback(lambda update: self.format_command(request, update))
+        command.addErrback(self.unavailable, request)
+        command.addCallback(lambda body: lost or (request.write(body), request.finish()))
+        return server.NOT_DONE_YET
+
+    def format_command(self, request, update):
+        if update is None:
+            request.setResponseCode(http.CONFLICT)
+            return b'{"error": "relay busy"}'
+        commandId, doorId, action, status, requests = update
+        return str.encode(json.dumps({'command': commandId, 'door': doorId, 'action': action,
+                                      'status': status, 'requests': requests}))
+
+    def unavailable(self, failure, request):
+        syslog.syslog('Toggle failed: %s' % failure.getErrorMessage())
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        return b'{"error": "controller unavailable"}'
+
+
+class SessionGuard(Resource):
+    """Lets through requests with a session cookie, or Basic credentials.
+
+    Valid Basic credentials get a session cookie back, browsers then send
+    both and only the cookie signature is checked. Passwords are checked
+    off the reactor thread, one at a time per client. Clients locked out by
+    failed logins, or with a check still running, get a 429 without their
+    password being checked."""
+    isLeaf = True
+    realm = 'Garage Door Controller'
+
+    def __init__(self, resource, auth, secure=False):
+        Resource.__init__(self)
+        self.resource = resource
+        self.auth = auth
+        self.secure = secure
+        self.checking = set()  # clients with a password check running
+
+    def get_token(self, request):
+        authorization = request.getHeader(b'authorization') or b''
+        if authorization.startswith(b'Bearer '):
+            return bytes.decode(authorization[7:].strip(), 'utf-8', 'replace')
+        for cookie in (request.getHeader(b'cookie') or b'').split(b';'):
+            name, _, value = cookie.strip().partition(b'=')
+            if name == session_auth.COOKIE_NAME:
+                return bytes.decode(value, 'utf-8', 'replace')
+        return None
+
+    def get_credentials(self, request):
+        authorization = request.getHeader(b'authorization') or b''
+        if not authorization.startswith(b'Basic '):
+            return None
+        try:
+            credentials = base64.b64decode(authorization[6:].strip()).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+        username, _, password = credentials.partition(':')
+        return username, password
+
+    def render(self, request):
+        token = self.get_token(request)
+        if token and self.auth.check_token(token) is not None:
+            return self.resource.render(request)
+
+        client = getattr(request.getClientAddress(), 'host', None)
+        retry_after = self.auth.retry_after(client)
+        if client in self.checking:
+            retry_after = max(retry_after, 1)
+        if retry_after:
+            request.setResponseCode(429)
+            request.setHeader(b'Retry-After', str.encode(str(int(math.ceil(retry_after)))))
+            return b'Too many failed logins'
+
+        credentials = self.get_credentials(request)
+        if credentials is None:
+            return self.unauthorized(request)
+
+        # PBKDF2 takes tens of milliseconds, the reactor keeps serving meanwhile
+        self.checking.add(client)
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        d = threads.deferToThread(self.auth.check_password, *credentials)
+        d.addBoth(self.checked, request, lost, client, credentials[0])
+        return server.NOT_DONE_YET
+
+    def checked(self, result, request, lost, client, username):
+        self.checking.discard(client)
+        if isinstance(result, Failure):
+            syslog.syslog('Password check failed: %s' % result.getErrorMessage())
+            result = False
+        token = self.auth.record_login(client, username, result)
+        if lost:
+            return
+        if token is None:
+            body = self.unauthorized(request)
+        else:
+            # Strict: clicks are GETs, no other site may send them with the cookie
+            cookie = '%s=%s; Max-Age=%d; Path=/; HttpOnly; SameSite=Strict' % (
+                bytes.decode(session_auth.COOKIE_NAME), token, self.auth.token_lifetime)
+            if self.secure:
+                cookie += '; Secure'
+            request.setHeader(b'Set-Cookie', str.encode(cookie))
+            try:
+                body = self.resource.render(request)
+            except Exception as inst:
+                # Twisted only answers the errors of a synchronous render
+                syslog.syslog('Error rendering %s: %r' % (request.uri, inst))
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+                body = b'Internal error'
+            if body == server.NOT_DONE_YET:
+                return
+        request.write(body)
+        request.finish()
+
+    def unauthorized(self, request):
+        request.setResponseCode(http.UNAUTHORIZED)
+        request.setHeader(b'WWW-Authenticate', str.encode('Basic realm="%s"' % self.realm))
+        return b'Unauthorized'
 
 
 class StatusHandler(Resource):
@@ -103,43 +463,148 @@ class StatusHandler(Resource):
         self.controller = controller
 
     def render(self, request):
-        door = request.args['id'][0]
-        for d in self.controller.doors:
-            if (d.id == door):
-                return d.last_state
-        return ''
+        d = self.controller.registry.get(bytes.decode(request.args.get(b'id', [b''])[0]))
+        if d is not None:
+            return str.encode(d.last_state)
+        return b''
 
 
-class ConfigHandler(Resource):
+class CachedJSONResource(Resource):
+    """JSON view of the doors, serialized once per controller ETag.
+
+    Requests whose If-None-Match matches the current ETag get a 304."""
     isLeaf = True
 
     def __init__(self, controller):
         Resource.__init__(self)
         self.controller = controller
+        self.cached_etag = None
+        self.cached_body = None
 
     def render_GET(self, request):
         request.setHeader('Content-Type', 'application/json')
-        return str.encode(json.dumps([(d.id, d.name, d.last_state, d.last_state_time)
-                                      for d in self.controller.doors]))
+        request.setHeader('Cache-Control', 'no-cache')
+        etag = str.encode(self.controller.get_etag())
+        request.setHeader('ETag', etag)
+        tags = request.getHeader(b'If-None-Match')
+        if tags and (etag in [tag.strip() for tag in tags.split(b',')] or tags.strip() == b'*'):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return b''
+        if self.cached_etag != etag:
+            self.cached_body = str.encode(json.dumps(self.get_content()))
+            self.cached_etag = etag
+        return self.cached_body
+
+    def get_content(self):
+        raise NotImplementedError()
+
+
+class ConfigHandler(CachedJSONResource):
+    def get_content(self):
+        return [(d.id, d.name, d.last_state, d.last_state_time)
+                for d in self.controller.doors]
+
+
+class DoorsHandler(CachedJSONResource):
+    """State of every door in one request."""
+
+    def get_content(self):
+        return [{'id': d.id,
+                 'name': d.name,
+                 'state': d.last_state,
+                 'last_state_time': d.last_state_time,
+                 'pending_action':
+                     d.last_action if d.last_state in ('opening', 'closing') else None,
+                 'last_action_time': d.last_action_time}
+                for d in self.controller.doors]
 
 
 class UptimeHandler(Resource):
     isLeaf = True
 
-    def __init__(self, controller):
+    def __init__(self, health):
         Resource.__init__(self)
-        self.uptime_pattern = re.compile(b"([:.\\w]+)")
+        self.health = health
 
     def getUptime(self):
-        uptime = subprocess.check_output(['uptime']).strip()
-        uptime = uptime.split(b",")[0]
-        result = self.uptime_pattern.findall(uptime)
-        return result[2]
+        uptime = self.health.snapshot.get('uptime')
+        if uptime is None:
+            return b'unknown'
+        return str.encode(format_seconds(int(uptime)))
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        uptime = bytes.decode(self.getUptime())
+        return str.encode(json.dumps("Uptime: %s" % uptime))
+
+
+class HealthHandler(Resource):
+    """Last host health snapshot, sampled on a timer by the server."""
+    isLeaf = True
+
+    def __init__(self, health):
+        Resource.__init__(self)
+        self.health = health
 
     def render_GET(self, request):
         request.setHeader('Content-Type', 'application/json')
-        uptime = self.getUptime()
-        return json.dumps("Uptime: %s" % uptime)
+        return self.health.snapshot_json
+
+
+class HistoryHandler(Resource):
+    """Door transitions in a time range: /history?door=&from=&to="""
+    isLeaf = True
+
+    def __init__(self, history):
+        Resource.__init__(self)
+        self.history = history
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        args = request.args
+        door = None
+        if args.get(b'door', [b''])[0]:
+            door = bytes.decode(args[b'door'][0])
+        try:
+            start = float(args[b'from'][0]) if args.get(b'from', [b''])[0] else None
+            end = float(args[b'to'][0]) if args.get(b'to', [b''])[0] else None
+        except ValueError:
+            request.setResponseCode(400)
+            return b'{"error": "from and to must be timestamps"}'
+
+        events = self.history.query_recent(door, start, end)
+        if events is not None:
+            return self.format_events(events)
+
+        # Older events come from SQLite, off the reactor thread
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        d = threads.deferToThread(self.history.query, door, start, end)
+        d.addCallback(lambda events: self.send_events(request, lost, events))
+        d.addErrback(lambda failure: self.send_error(request, lost, failure))
+        return server.NOT_DONE_YET
+
+    def send_events(self, request, lost, events):
+        if not lost:
+            request.write(self.format_events(events))
+            request.finish()
+
+    def send_error(self, request, lost, failure):
+        syslog.syslog("Error querying history: " + str(failure.value))
+        if not lost:
+            request.setResponseCode(500)
+            request.finish()
+
+    def format_events(self, events):
+        return str.encode(json.dumps([list(event) for event in events]))
+
+
+class MetricsHandler(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return str.encode(metrics.REGISTRY.render())
 
 
 class UpdateHandler(Resource):
@@ -147,27 +612,45 @@ class UpdateHandler(Resource):
 
     def __init__(self, controller):
         Resource.__init__(self)
-        self.delayed_requests = []
+        # Waiting requests grouped by (version seen, jsonp callback)
+        self.delayed_requests = {}
         self.controller = controller
 
     def handle_updates(self):
-        for request in self.delayed_requests:
-            updates = self.controller.get_updates(request.lastupdate)
-            if updates != []:
-                self.send_updates(request, updates)
-                self.delayed_requests.remove(request)
-
-    def format_updates(self, request, update):
+        waiting, self.delayed_requests = self.delayed_requests, {}
+        for (seen, callback), requests in waiting.items():
+            version, updates = self.controller.get_changes(seen)
+            commands = self.controller.get_command_changes(seen)
+            if updates == [] and commands == []:
+                # Groups can end up on the same version, merge them
+                self.delayed_requests.setdefault((version, callback), []).extend(requests)
+                continue
+            # Serialized once, written to every client of the group
+            response = self.format_updates(callback, version, updates, commands)
+            for request in requests:
+                request.write(response)
+                request.finish()
+
+    def format_updates(self, callback, version, update, commands=()):
         response = json.dumps(
-            {'timestamp': int(time.time()), 'update': update})
-        if hasattr(request, 'jsonpcallback'):
-            return str.encode(request.jsonpcallback + '(' + response + ')')
+            {'timestamp': int(self.controller.clock.seconds()), 'version': version,
+             'update': update, 'commands': list(commands)})
+        if callback is not None:
+            return str.encode(callback + '(' + response + ')')
         else:
             return str.encode(response)
 
-    def send_updates(self, request, updates):
-        request.write(self.format_updates(request, updates))
-        request.finish()
+    def waiting_count(self):
+        return sum(len(requests) for requests in self.delayed_requests.values())
+
+    def remove_request(self, request):
+        # The group of a request changes when it is moved to a newer version
+        for key, requests in list(self.delayed_requests.items()):
+            if request in requests:
+                requests.remove(request)
+                if not requests:
+                    del self.delayed_requests[key]
+                return
 
     def render_GET(self, request):
 
@@ -178,29 +661,117 @@ class UpdateHandler(Resource):
         args = request.args
 
         # set jsonp callback handler name if it exists
+        callback = None
         if b'callback' in args:
-            request.jsonpcallback = args[b'callback'][0]
-
-        # set lastupdate if it exists
-        if b'lastupdate' in args:
-            request.lastupdate = float(args[b'lastupdate'][0])
-        else:
-            request.lastupdate = 0
+            callback = bytes.decode(args[b'callback'][0])
 
         # Can we accommodate this request now?
-        updates = self.controller.get_updates(request.lastupdate)
-        if updates != []:
-            return self.format_updates(request, updates)
+        commands = []
+        try:
+            seen = int(args[b'version'][0]) if b'version' in args else None
+            lastupdate = float(args[b'lastupdate'][0]) if b'lastupdate' in args else 0
+        except ValueError:
+            request.setResponseCode(400)
+            return b'{"error": "version must be an integer and lastupdate a timestamp"}'
+        if seen is not None:
+            version, updates = self.controller.get_changes(seen)
+            commands = self.controller.get_command_changes(seen)
+        else:
+            version = self.controller.version
+            updates = self.controller.get_updates(lastupdate)
+        if updates != [] or commands != []:
+            return self.format_updates(callback, version, updates, commands)
 
+        # Nothing new, the client is up to date with the current version
         request.notifyFinish().addErrback(
-            lambda x: self.delayed_requests.remove(request))
-        self.delayed_requests.append(request)
+            lambda x: self.remove_request(request))
+        self.delayed_requests.setdefault((version, callback), []).append(request)
 
         # tell the client we're not done yet
         return server.NOT_DONE_YET
 
 
-def main(args):
+class EventStreamHandler(Resource):
+    """Server-Sent Events stream of the door transitions.
+
+    Each event carries the same payload as /upd and the change log version
+    as its id, so a reconnecting EventSource resumes from Last-Event-ID."""
+    isLeaf = True
+
+    def __init__(self, controller):
+        Resource.__init__(self)
+        self.streams = {}  # request => last version sent
+        self.controller = controller
+
+    def handle_updates(self):
+        encoded = {}
+        for request, version in list(self.streams.items()):
+            if version not in encoded:
+                encoded[version] = self.format_event(
+                    *self.controller.get_changes(version),
+                    commands=self.controller.get_command_changes(version))
+            if encoded[version] is not None:
+                request.write(encoded[version])
+                self.streams[request] = self.controller.version
+
+    def format_event(self, version, update, commands=()):
+        if update == [] and not commands:
+            return None
+        data = json.dumps({'timestamp': int(self.controller.clock.seconds()),
+                           'version': version,
+                           'update': update,
+                           'commands': list(commands)})
+        return str.encode('id: %d\ndata: %s\n\n' % (version, data))
+
+    def send_heartbeat(self):
+        for request in list(self.streams):
+            request.write(b': heartbeat\n\n')
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+
+        last_event_id = request.getHeader('Last-Event-ID')
+        if last_event_id is not None and last_event_id.isdigit():
+            version = int(last_event_id)
+        else:
+            version = -1  # Send the state of every door
+
+        request.write(b'retry: 5000\n\n')
+        self.streams[request] = version
+        request.notifyFinish().addBoth(
+            lambda x: self.streams.pop(request, None))
+        self.handle_updates()
+        return server.NOT_DONE_YET
+
+
+def create_session_auth(site, clock):
+    """SessionAuth for the credentials of a `site` config section."""
+    password_hash = site.get('password_hash')
+    if not password_hash:
+        syslog.syslog('Plain text password in the config, '
+                      'use session_auth.py to get a password_hash')
+        password_hash = session_auth.hash_password(site['password'])
+    return session_auth.SessionAuth(
+        site['username'], password_hash, clock,
+        token_lifetime=site.get('session_lifetime', 3600),
+        max_failures=site.get('login_max_failures', 5),
+        lockout=site.get('login_lockout', 30))
+
+
+def create_gpio_backend(config):
+    """The GPIO backend of the config, recording a trace if record_trace is set."""
+    backend = gpio_backends.create(config)
+    trace_path = config['config'].get('record_trace')
+    if trace_path:
+        backend, trace_writer = gpio_trace.start_recorder(trace_path, backend, reactor)
+        reactor.addSystemEventTrigger(  # @UndefinedVariable
+            'before', 'shutdown', trace_writer.close)
+    return backend
+
+
+def main(args, gpio_backend=None):
+    """Run the server, `gpio_backend` overrides the backend named in the config."""
     syslog.openlog('garage_controller')
 
     config_filename = 'config.json'
@@ -211,10 +782,24 @@ def main(args):
     config_file = open(config_filename)
     config = json.load(config_file)
     config_file.close()
-
-    controller = Controller(config)
-    garage_server = GarageDoorServer(controller, config)
+    if gpio_backend is not None:
+        config['config']['gpio_backend'] = gpio_backend
+
+    if config['config'].get('use_sampler_process', False):
+        controller = shared_state.SharedStateView(
+            config['config'].get('state_table', shared_state.DEFAULT_TABLE),
+            config['config'].get('change_log_size', 256), reactor)
+        reactor.connectUNIX(  # @UndefinedVariable
+            config['config'].get('command_socket', shared_state.DEFAULT_SOCKET),
+            shared_state.CommandClientFactory(controller))
+    else:
+        controller = Controller(config, reactor, create_gpio_backend(config))
+    garage_server = GarageDoorServer(controller, config, reactor)
     controller.set_update_handler(garage_server.updateHandler)
+    controller.add_update_handler(garage_server.eventHandler)
+    if not config['config'].get('use_sampler_process', False):
+        # The sampler reloads the doors, this process only follows them
+        garage_server.watch_config(config_filename)
     garage_server.run()
 
 
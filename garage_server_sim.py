@@ -2,11 +2,9 @@
 # This allow to run the server on a laptop for development.
 
 import sys
-sys.modules['RPi'] = __import__('simRPi')
 
-import garage_server  # noqa
+import garage_server
 
 
 if __name__ == '__main__':
-    import sys
-    garage_server.main(sys.argv[1:])
+    garage_server.main(sys.argv[1:], gpio_backend='sim')
@@ -0,0 +1,174 @@
+"""GPIO backends of the controller, selected by "gpio_backend" in config.json.
+
+Pins are BCM / line offsets. Each backend can set up, read and write
+single pins, and read a list of pins with `read_all`, which the status
+check calls once per tick for every state pin. Edge callbacks are
+optional: a backend without them raises NotImplementedError and the
+server keeps polling.
+
+    "rpi"    RPi.GPIO (the default)
+    "gpiod"  the Linux GPIO character device through libgpiod, every state
+             line read with a single request; also drives I2C port
+             expanders that have a kernel gpiochip driver (MCP23017, PCF8574)
+    "sim"    the simRPi simulator, for development and tests
+"""
+
+
+class RPiBackend(object):
+    """RPi.GPIO in BCM numbering, one call per pin."""
+
+    def __init__(self, module=None):
+        if module is None:
+            import RPi.GPIO as module
+        self.gpio = module
+        self.gpio.setwarnings(False)
+        self.gpio.cleanup()
+        self.gpio.setmode(self.gpio.BCM)
+
+    def setup_output(self, pin, value):
+        self.gpio.setup(pin, self.gpio.OUT)
+        self.gpio.output(pin, value)
+
+    def setup_input(self, pin, pull_up=True):
+        self.gpio.setup(pin, self.gpio.IN,
+                        pull_up_down=self.gpio.PUD_UP if pull_up else self.gpio.PUD_OFF)
+
+    def read(self, pin):
+        return self.gpio.input(pin)
+
+    def read_all(self, pins):
+        return [self.gpio.input(pin) for pin in pins]
+
+    def write(self, pin, value):
+        self.gpio.output(pin, value)
+
+    def add_edge_callback(self, pin, callback):
+        """Call `callback(pin)` on both edges, from the backend's own thread."""
+        self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=callback)
+
+    def remove_edge_callback(self, pin):
+        self.gpio.remove_event_detect(pin)
+
+    def cleanup(self):
+        self.gpio.cleanup()
+
+
+class SimBackend(RPiBackend):
+    """The simRPi simulator. `gpio` is the simulator module, to drive the pins."""
+
+    def __init__(self, module=None):
+        if module is None:
+            import simRPi.GPIO as module
+        RPiBackend.__init__(self, module)
+
+
+class GpiodBackend(object):
+    """Lines of a GPIO character device, through the libgpiod 2 bindings.
+
+    The lines set up before the first read or write are requested
+    together, so `read_all` costs one ioctl for every state pin. Lines set
+    up later get a request of their own, the lines in use are never
+    released. No edge callbacks: they would need a thread waiting on the
+    request, the server polls instead."""
+
+    def __init__(self, chip='/dev/gpiochip0', consumer='garage-door-controller'):
+        import gpiod
+        from gpiod.line import Bias, Direction, Value
+        self.gpiod = gpiod
+        self.Bias = Bias
+        self.Direction = Direction
+        self.Value = Value
+        self.chip = chip
+        self.consumer = consumer
+        self.settings = {}  # pin => LineSettings, not requested yet
+        self.requests = {}  # pin => LineRequest holding the line
+        self.line_settings = {}  # pin => LineSettings of the requested lines
+
+    def value(self, value):
+        return self.Value.ACTIVE if value else self.Value.INACTIVE
+
+    def request_lines(self):
+        if self.settings:
+            request = self.gpiod.request_lines(
+                self.chip, consumer=self.consumer, config=dict(self.settings))
+            for pin in self.settings:
+                self.requests[pin] = request
+            self.line_settings.update(self.settings)
+            self.settings = {}
+
+    def get_request(self, pin):
+        if pin not in self.requests:
+            self.request_lines()
+        return self.requests[pin]
+
+    def setup(self, pin, settings):
+        if pin in self.requests:
+            # The new config replaces the whole request's, list every line of it
+            request = self.requests[pin]
+            self.line_settings[pin] = settings
+            request.reconfigure_lines({p: self.line_settings[p] for p in self.requests
+                                       if self.requests[p] is request})
+            return
+        self.settings[pin] = settings
+        if self.requests:
+            self.request_lines()
+
+    def output_settings(self, value):
+        return self.gpiod.LineSettings(
+            direction=self.Direction.OUTPUT, output_value=self.value(value))
+
+    def setup_output(self, pin, value):
+        self.setup(pin, self.output_settings(value))
+
+    def setup_input(self, pin, pull_up=True):
+        self.setup(pin, self.gpiod.LineSettings(
+            direction=self.Direction.INPUT,
+            bias=self.Bias.PULL_UP if pull_up else self.Bias.DISABLED))
+
+    def read(self, pin):
+        return 1 if self.get_request(pin).get_value(pin) == self.Value.ACTIVE else 0
+
+    def read_all(self, pins):
+        # One get_values per request, a single one unless lines were added later
+        groups = {}
+        for pin in pins:
+            request = self.get_request(pin)
+            groups.setdefault(id(request), (request, []))[1].append(pin)
+        values = {}
+        for request, group in groups.values():
+            values.update(zip(group, request.get_values(group)))
+        return [1 if values[pin] == self.Value.ACTIVE else 0 for pin in pins]
+
+    def write(self, pin, value):
+        self.get_request(pin).set_value(pin, self.value(value))
+        # Kept for a later reconfigure of the request
+        self.line_settings[pin] = self.output_settings(value)
+
+    def add_edge_callback(self, pin, callback):
+        raise NotImplementedError('gpiod backend does not run edge callbacks')
+
+    def remove_edge_callback(self, pin):
+        pass
+
+    def cleanup(self):
+        released = set()
+        for request in self.requests.values():
+            if id(request) not in released:
+                released.add(id(request))
+                request.release()
+        self.requests = {}
+        self.line_settings = {}
+
+
+def create(config):
+    """Build the backend named by config['config']['gpio_backend']."""
+    name = config['config'].get('gpio_backend', 'rpi')
+    if name == 'rpi':
+        return RPiBackend()
+    elif name == 'gpiod':
+        gpiod_config = config.get('gpiod', {})
+        return GpiodBackend(gpiod_config.get('chip', '/dev/gpiochip0'),
+                            gpiod_config.get('consumer', 'garage-door-controller'))
+    elif name == 'sim':
+        return SimBackend()
+    raise ValueError('Unknown gpio_backend %r' % name)
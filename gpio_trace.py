@@ -0,0 +1,234 @@
+# Record the GPIO activity of the controller and replay it through the
+# simulator.
+#
+#   python3 gpio_trace.py trace_file [config_file] [--realtime]
+#
+# Recording is enabled with "record_trace": "<path>" in the config section
+# of config.json, whatever the GPIO backend. Replay runs the trace through
+# a Controller on the simulator backend, as fast as possible or in real
+# time with --realtime, and prints the transitions, alerts and per-event
+# processing latency.
+
+import struct
+import sys
+
+# File header: magic, format version, start time of the trace
+MAGIC = b'GPTR'
+VERSION = 1
+HEADER = struct.Struct('<4sBd')
+
+# Records follow as: delta from the previous record in microseconds
+# (varint), then the kind in the top bit with the channel in the low
+# bits, then the value: 3 bytes for back to back events, 7 bytes for
+# events up to 9 hours apart. Channels are limited to 0-127.
+OUTPUT_FLAG = 0x80
+MAX_CHANNEL = OUTPUT_FLAG - 1
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+class TraceWriter(object):
+    """Appends GPIO events to a trace file, flushed at most every flush_interval seconds."""
+
+    def __init__(self, path, start_time, flush_interval=1.0):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, start_time))
+        self.start_time = start_time
+        self.last_tick = 0
+        self.flush_interval = flush_interval
+        self.last_flush = start_time
+        self.count = 0
+
+    def write(self, event_time, kind, channel, value):
+        if not 0 <= channel <= MAX_CHANNEL:
+            raise ValueError('GPIO channel %d does not fit a trace, the limit is %d'
+                             % (channel, MAX_CHANNEL))
+        tick = max(self.last_tick, int(round((event_time - self.start_time) * 1e6)))
+        flags = channel | (OUTPUT_FLAG if kind == 'output' else 0)
+        self.file.write(encode_varint(tick - self.last_tick) +
+                        struct.pack('<BB', flags, 1 if value else 0))
+        self.last_tick = tick
+        self.count += 1
+        if event_time - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = event_time
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """Return the start time and the (time, kind, channel, value) events of a trace.
+
+    Event times are in seconds from the start of the trace."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, start_time = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a version %d GPIO trace' % (path, VERSION))
+
+    events = []
+    tick = 0
+    pos = HEADER.size
+    while pos < len(data):
+        delta = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            delta |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        flags, value = struct.unpack_from('<BB', data, pos)
+        pos += 2
+        tick += delta
+        kind = 'output' if flags & OUTPUT_FLAG else 'input'
+        events.append((tick / 1e6, kind, flags & ~OUTPUT_FLAG, value))
+    return start_time, events
+
+
+class TraceRecorder(object):
+    """GPIO backend recording the inputs and outputs of the backend it wraps.
+
+    Inputs are recorded when their level changes, the controller reads
+    every pin twice a second and the repeats carry nothing. Outputs are
+    all recorded. Everything else goes straight to the wrapped backend."""
+
+    def __init__(self, backend, writer, clock):
+        self.backend = backend
+        self.writer = writer
+        self.clock = clock
+        self.levels = {}
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def record_input(self, pin, value):
+        if self.levels.get(pin) != value:
+            self.levels[pin] = value
+            self.writer.write(self.clock.seconds(), 'input', pin, value)
+
+    def read(self, pin):
+        value = self.backend.read(pin)
+        self.record_input(pin, value)
+        return value
+
+    def read_all(self, pins):
+        values = self.backend.read_all(pins)
+        for pin, value in zip(pins, values):
+            self.record_input(pin, value)
+        return values
+
+    def write(self, pin, value):
+        self.backend.write(pin, value)
+        self.writer.write(self.clock.seconds(), 'output', pin, value)
+
+    def setup_output(self, pin, value):
+        self.backend.setup_output(pin, value)
+        self.writer.write(self.clock.seconds(), 'output', pin, value)
+
+
+def start_recorder(path, backend, clock):
+    """Return (recording backend, writer) recording the activity of `backend`."""
+    writer = TraceWriter(path, clock.seconds())
+    return TraceRecorder(backend, writer, clock), writer
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def replay(config, events, clock, tail=30):
+    """Run the events through a Controller on the simulated GPIO.
+
+    The status loop runs every half second as on the server, and every
+    replayed level change is also checked at once, the way edge detection
+    would, to time its processing. With a VirtualClock the trace runs as
+    fast as possible; with the reactor the caller runs the reactor until
+    the returned end time. Return the end time and a function building
+    the report."""
+    from twisted.internet import task
+    import garage_controller
+    import gpio_backends
+    import metrics
+
+    backend = gpio_backends.SimBackend()
+    gpio = backend.gpio
+    gpio.verbose = False
+    controller = garage_controller.Controller(config, clock, backend)
+    latencies = []
+
+    def on_event(channel, value):
+        start = metrics.timer()
+        controller.status_check()
+        latencies.append(metrics.timer() - start)
+
+    transitions_before = sum(garage_controller.TRANSITIONS.values.values())
+    alerts_before = sum(garage_controller.ALERTS.values.values())
+    loop = task.LoopingCall(controller.status_check)
+    loop.clock = clock
+    loop.start(0.5)
+    end = clock.seconds() + gpio.replay(events, clock, on_event) + tail
+
+    def report():
+        loop.stop()
+        latencies.sort()
+        result = {
+            'events': len(latencies),
+            'transitions': sum(garage_controller.TRANSITIONS.values.values()) - transitions_before,
+            'alerts': sum(garage_controller.ALERTS.values.values()) - alerts_before,
+        }
+        if latencies:
+            result.update({
+                'latency_mean_ms': 1000 * sum(latencies) / len(latencies),
+                'latency_p50_ms': 1000 * percentile(latencies, 0.5),
+                'latency_p99_ms': 1000 * percentile(latencies, 0.99),
+                'latency_max_ms': 1000 * latencies[-1],
+            })
+        return result
+    return end, report
+
+
+def main(args):
+    import json
+    import time
+
+    from clock import VirtualClock
+
+    realtime = '--realtime' in args
+    args = [arg for arg in args if arg != '--realtime']
+    if not args:
+        print('Usage: gpio_trace.py trace_file [config_file] [--realtime]')
+        return 1
+    start_time, events = read_trace(args[0])
+    with open(args[1] if len(args) > 1 else 'config.json') as config_file:
+        config = json.load(config_file)
+    config['config']['use_openhab'] = False
+    config['alerts']['alert_type'] = None
+
+    wall_start = time.time()
+    if realtime:
+        from twisted.internet import reactor
+        end, report = replay(config, events, reactor)
+        reactor.callLater(end - reactor.seconds(), reactor.stop)  # @UndefinedVariable
+        reactor.run()  # @UndefinedVariable
+    else:
+        clock = VirtualClock(start_time)
+        end, report = replay(config, events, clock)
+        clock.run_until(end)
+    result = report()
+    result['wall_seconds'] = time.time() - wall_start
+    for key, value in sorted(result.items()):
+        print('%s: %s' % (key, value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,106 @@
+import sqlite3
+import threading
+
+from collections import deque
+
+
+class EventHistory(object):
+    """Append-only store of the door state transitions.
+
+    `record` only appends to memory: a ring buffer of the recent events and
+    a batch of pending rows that a writer thread inserts into SQLite every
+    `flush_interval` seconds, so recording never waits on the disk. Queries
+    covered by the ring buffer are answered from memory, older ones from
+    the (time) and (door, time) indexes."""
+
+    def __init__(self, path, ring_size=256, flush_interval=5):
+        self.flush_interval = flush_interval
+        self.recent = deque(maxlen=ring_size)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS events '
+                            '(time REAL NOT NULL, door TEXT NOT NULL, state TEXT NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS events_time ON events (time)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS events_door_time ON events (door, time)')
+
+    def record(self, door_id, state, state_time):
+        event = (state_time, door_id, state)
+        with self.lock:
+            self.recent.append(event)
+            self.pending.append(event)
+
+    def flush(self):
+        """Write the pending events in one transaction, return how many were written."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        with self.db_lock:
+            with self.db:
+                self.db.executemany(
+                    'INSERT INTO events (time, door, state) VALUES (?, ?, ?)', pending)
+        return len(pending)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='event-history')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def query_recent(self, door=None, start=None, end=None):
+        """Answer from the ring buffer, or None if it does not cover `start`."""
+        with self.lock:
+            recent = list(self.recent)
+        if start is None or not recent or start <= recent[0][0]:
+            return None
+        return [event for event in recent
+                if event[0] >= start and (end is None or event[0] <= end) and
+                (door is None or event[1] == door)]
+
+    def query(self, door=None, start=None, end=None, limit=1000):
+        """Return the (time, door, state) events in the time range, oldest first.
+
+        At most `limit` events: the first ones from `start`, or without a
+        `start` the most recent ones."""
+        events = self.query_recent(door, start, end)
+        if events is not None:
+            return events[:limit]
+
+        self.flush()
+        clauses = []
+        params = []
+        if door is not None:
+            clauses.append('door = ?')
+            params.append(door)
+        if start is not None:
+            clauses.append('time >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('time <= ?')
+            params.append(end)
+        sql = 'SELECT time, door, state FROM events'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        newest_first = start is None
+        sql += ' ORDER BY time DESC LIMIT ?' if newest_first else ' ORDER BY time LIMIT ?'
+        params.append(limit)
+        with self.db_lock:
+            events = [tuple(row) for row in self.db.execute(sql, params)]
+        if newest_first:
+            events.reverse()
+        return events
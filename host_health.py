@@ -0,0 +1,76 @@
+import json
+import syslog
+import time
+
+
+class HostHealth(object):
+    """Snapshot of the host uptime, load, memory and CPU temperature.
+
+    Everything is read from procfs and sysfs, no process is forked.
+    `sample` is meant to run on a timer; readers get the cached snapshot
+    and its JSON encoding."""
+
+    def __init__(self, proc='/proc', thermal_zone='/sys/class/thermal/thermal_zone0'):
+        self.proc = proc
+        self.thermal_zone = thermal_zone
+        self.snapshot = {}
+        self.snapshot_json = b'{}'
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def read_uptime(self):
+        data = self.read(self.proc + '/uptime')
+        if data is None:
+            return None
+        return float(data.split()[0])
+
+    def read_loadavg(self):
+        data = self.read(self.proc + '/loadavg')
+        if data is None:
+            return None
+        return [float(load) for load in data.split()[:3]]
+
+    def read_memory(self):
+        data = self.read(self.proc + '/meminfo')
+        if data is None:
+            return None
+        meminfo = {}
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                meminfo[fields[0].rstrip(':')] = int(fields[1])
+        if 'MemTotal' not in meminfo:
+            return None
+        available = meminfo.get('MemAvailable', meminfo.get('MemFree', 0))
+        return {'total_kb': meminfo['MemTotal'], 'available_kb': available}
+
+    def read_cpu_temperature(self):
+        data = self.read(self.thermal_zone + '/temp')
+        if data is None:
+            return None
+        return int(data) / 1000.0
+
+    def parse(self, name, reader):
+        """Run `reader`, None if the file holds something unexpected."""
+        try:
+            return reader()
+        except (ValueError, IndexError) as inst:
+            syslog.syslog('Host health: cannot parse %s: %s' % (name, inst))
+            return None
+
+    def sample(self):
+        self.snapshot = {
+            'timestamp': int(time.time()),
+            'uptime': self.parse('uptime', self.read_uptime),
+            'loadavg': self.parse('loadavg', self.read_loadavg),
+            'memory': self.parse('meminfo', self.read_memory),
+            'cpu_temperature': self.parse('temperature', self.read_cpu_temperature),
+        }
+        self.snapshot_json = str.encode(json.dumps(self.snapshot))
+        return self.snapshot
+
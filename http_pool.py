@@ -0,0 +1,104 @@
+import select
+import socket
+import threading
+
+import sys
+if sys.version_info < (3,):
+    import httplib as httpclient
+else:
+    import http.client as httpclient
+
+
+# Methods a server can receive twice with the same effect, the only ones
+# resent when the connection fails after the request went out
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+def is_dropped(conn):
+    """True if the server closed the idle connection (it is readable, or gone)."""
+    sock = conn.sock
+    if sock is None or sock.fileno() < 0:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (ValueError, OSError):
+        return True
+    return bool(readable)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections shared by the outbound notifications.
+
+    Connections are kept per (scheme, host) and reused across requests and
+    alerts, so only the first request to a server pays for the TCP and TLS
+    handshakes. Idle connections the server has closed are dropped before
+    use. A request failing on a reused connection is retried once on a
+    fresh connection if it was not sent, or if its method is idempotent: a
+    POST the server may have processed is never sent twice."""
+
+    def __init__(self, max_idle=4, timeout=10):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, host):
+        with self.lock:
+            self.created += 1
+        if scheme == 'https':
+            return httpclient.HTTPSConnection(host, timeout=self.timeout)
+        return httpclient.HTTPConnection(host, timeout=self.timeout)
+
+    def acquire(self, scheme, host):
+        with self.lock:
+            connections = self.idle.get((scheme, host), [])
+            while connections:
+                conn = connections.pop()
+                if not is_dropped(conn):
+                    return conn, True
+                conn.close()
+        return self.connect(scheme, host), False
+
+    def release(self, scheme, host, conn):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, host), [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def request(self, scheme, host, method, url, body=None, headers=None):
+        """Send the request and return (status, body) of the response."""
+        conn, reused = self.acquire(scheme, host)
+        sent = False
+        try:
+            conn.request(method, url, body, headers or {})
+            sent = True
+            response = conn.getresponse()
+            data = response.read()
+        except (httpclient.HTTPException, socket.error):
+            conn.close()
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+            conn = self.connect(scheme, host)
+            try:
+                conn.request(method, url, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except Exception:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(scheme, host, conn)
+        return response.status, data
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
@@ -0,0 +1,143 @@
+"""Minimal metrics in the Prometheus text exposition format.
+
+Recording is a dict update or a bisection, and gauges are callbacks only
+evaluated when the metrics are scraped, so instrumentation is close to
+free when nobody reads them."""
+
+import threading
+import time
+
+from bisect import bisect_left
+
+timer = getattr(time, 'perf_counter', time.time)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Register `metric`, replacing any previous metric of the same name."""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + 1
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.labelnames, labels),
+                             format_value(value))
+                for labels, value in values]
+
+
+class Gauge(object):
+    """Value computed by `callback()` at scrape time."""
+    type = 'gauge'
+
+    def __init__(self, name, help, callback, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        if registry is not None:
+            registry.register(self)
+
+    def render(self):
+        return ['%s %s' % (self.name, format_value(self.callback()))]
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels => [per bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labelvalues)
+            if counts is None:
+                counts = self.values[labelvalues] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labelvalues):
+        counts = self.values.get(labelvalues)
+        if counts is None:
+            return 0
+        return sum(counts[:-1])
+
+    def render(self):
+        with self.lock:
+            values = sorted((labels, list(counts)) for labels, counts in self.values.items())
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labelnames, labels, [('le', format_value(bound))]),
+                    cumulative))
+            label_text = format_labels(self.labelnames, labels)
+            lines.append('%s_sum%s %s' % (self.name, label_text, format_value(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, label_text, cumulative))
+        return lines
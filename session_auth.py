@@ -0,0 +1,128 @@
+# Password check for the click resource, done once per session.
+#
+# The password is checked against a salted PBKDF2 hash, then the client
+# gets a signed session token in a cookie. Later requests only need an
+# HMAC comparison. Failed logins are throttled per client address.
+#
+#   python3 session_auth.py <password>
+#
+# prints the password_hash to put in the site section of config.json.
+
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import sys
+
+from clock import SystemClock
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = 100000
+COOKIE_NAME = b'garage_session'
+
+
+def hash_password(password, salt=None, iterations=ITERATIONS):
+    """Return the salted hash of the password as "pbkdf2_sha256$<iterations>$<salt>$<hash>"."""
+    if salt is None:
+        salt = binascii.hexlify(os.urandom(16)).decode('ascii')
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                                 salt.encode('ascii'), iterations)
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations, salt,
+                            base64.b64encode(digest).decode('ascii'))
+
+
+def verify_password(password, password_hash):
+    try:
+        algorithm, iterations, salt, _ = password_hash.split('$')
+    except ValueError:
+        return False
+    if algorithm != ALGORITHM:
+        return False
+    return hmac.compare_digest(hash_password(password, salt, int(iterations)), password_hash)
+
+
+class SessionAuth(object):
+    """Logins against one account, signed session tokens and failure throttling.
+
+    A token is "<username>:<expiry>:<signature>", signed with a secret
+    drawn at startup, so restarting the server ends every session. After
+    max_failures failed logins a client is locked out for lockout seconds,
+    doubling with every further failure up to max_lockout."""
+
+    def __init__(self, username, password_hash, clock=None, token_lifetime=3600,
+                 max_failures=5, lockout=30, max_lockout=3600, secret=None):
+        self.username = username
+        self.password_hash = password_hash
+        self.clock = clock or SystemClock()
+        self.token_lifetime = token_lifetime
+        self.max_failures = max_failures
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self.secret = secret or os.urandom(32)
+        self.failures = {}  # client => [failed logins, locked until, last failure]
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def issue_token(self, username):
+        payload = '%s:%d' % (username, int(self.clock.seconds() + self.token_lifetime))
+        return '%s:%s' % (payload, self.sign(payload))
+
+    def check_token(self, token):
+        """Return the username of a valid, unexpired token, None otherwise."""
+        payload, _, signature = token.rpartition(':')
+        username, _, expiry = payload.rpartition(':')
+        if not hmac.compare_digest(self.sign(payload), signature):
+            return None
+        if not expiry.isdigit() or int(expiry) < self.clock.seconds():
+            return None
+        return username
+
+    def retry_after(self, client):
+        """Seconds the client has to wait before its next login, 0 if it may try now."""
+        failures = self.failures.get(client)
+        if failures is None:
+            return 0
+        return max(0, failures[1] - self.clock.seconds())
+
+    def login(self, client, username, password):
+        """Check the credentials, return a new token or None.
+
+        Callers check retry_after first, a locked out client is not
+        checked at all."""
+        return self.record_login(client, username, self.check_password(username, password))
+
+    def check_password(self, username, password):
+        """The slow part of a login, safe to run in a thread: touches no state."""
+        return username == self.username and verify_password(password, self.password_hash)
+
+    def record_login(self, client, username, success):
+        """Count the result of check_password, return a new token or None."""
+        if success:
+            self.failures.pop(client, None)
+            return self.issue_token(username)
+
+        now = self.clock.seconds()
+        self.expire_failures(now)
+        failures = self.failures.setdefault(client, [0, 0, now])
+        failures[0] += 1
+        failures[2] = now
+        if failures[0] >= self.max_failures:
+            extra = failures[0] - self.max_failures
+            failures[1] = now + min(self.max_lockout, self.lockout * 2 ** min(extra, 16))
+        return None
+
+    def expire_failures(self, now):
+        # Forget clients quiet for a while, so the table stays small
+        expired = [client for client, (_, until, last) in self.failures.items()
+                   if now - max(until, last) > self.max_lockout]
+        for client in expired:
+            del self.failures[client]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: session_auth.py <password>')
+        sys.exit(1)
+    print(hash_password(sys.argv[1]))
@@ -0,0 +1,372 @@
+# Door state shared between the sampler process, which owns the GPIO pins
+# and the Controller, and the web process.
+#
+# The sampler publishes the doors into a memory mapped table guarded by a
+# sequence counter (a seqlock): the writer makes the counter odd, writes,
+# and makes it even again; readers copy the table and retry if the counter
+# was odd or moved meanwhile, so they never take a lock. Toggles go from
+# the web process to the sampler over a local socket, which also carries
+# the command status changes and a wakeup after every table write.
+
+import json
+import math
+import mmap
+import os
+import struct
+import syslog
+
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.protocols.basic import LineReceiver
+
+from clock import SystemClock
+from garage_controller import ChangeLog, DoorRegistry
+
+MAGIC = b'GDST'
+LAYOUT_VERSION = 1
+SEQUENCE = struct.Struct('<Q')
+# magic, layout version, sequence, change log version, toggle count, door count
+HEADER = struct.Struct('<4sIQQQI4x')
+# id, name, state, state time, last action, last action time
+DOOR = struct.Struct('<32s64s12sd12sd')
+READ_RETRIES = 100
+
+DEFAULT_TABLE = '/dev/shm/garage_state'
+DEFAULT_SOCKET = '/tmp/garage_commands.sock'
+
+
+def encode(text, size):
+    return (text or '').encode('utf-8')[:size]
+
+
+def decode(data):
+    return data.rstrip(b'\0').decode('utf-8', 'replace')
+
+
+def create_table(path, max_doors):
+    """Write an empty table for `max_doors` doors to `path`, replacing any previous one.
+
+    The new file is renamed over the old one, so a web process mapping the
+    old file never sees it shrink under the mapping; it reopens the table
+    when the file changes. The sequence goes on from the old table."""
+    sequence = 0
+    try:
+        with open(path, 'rb') as old_file:
+            magic, layout, old_sequence = HEADER.unpack(old_file.read(HEADER.size))[:3]
+        if magic == MAGIC and layout == LAYOUT_VERSION:
+            sequence = (old_sequence // 2 + 1) * 2
+    except (OSError, struct.error):
+        pass  # No previous table
+    new_path = path + '.new'
+    fd = os.open(new_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, HEADER.size + max_doors * DOOR.size)
+        os.write(fd, HEADER.pack(MAGIC, LAYOUT_VERSION, sequence, 0, 0, 0))
+    finally:
+        os.close(fd)
+    os.replace(new_path, path)
+
+
+class StateTable(object):
+    """Fixed size table of the door states in a memory mapped file."""
+
+    def __init__(self, path, max_doors=32, create=False):
+        if create:
+            create_table(path, max_doors)
+        self.path = path
+        fd = os.open(path, os.O_RDWR if create else os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            if stat.st_size < HEADER.size:
+                raise ValueError('%s is not a state table' % path)
+            self.file_id = (stat.st_ino, stat.st_size)
+            self.max_doors = (stat.st_size - HEADER.size) // DOOR.size
+            access = mmap.ACCESS_WRITE if create else mmap.ACCESS_READ
+            self.map = mmap.mmap(fd, stat.st_size, access=access)
+        finally:
+            os.close(fd)
+
+    def replaced(self):
+        """True if the file at the path is no longer the mapped one."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_size) != self.file_id
+
+    def sequence(self):
+        return SEQUENCE.unpack_from(self.map, 8)[0]
+
+    def write(self, version, toggle_count, doors):
+        """Publish the (id, name, state, state time, last action, last action time)
+        of the doors."""
+        if len(doors) > self.max_doors:
+            raise ValueError('%d doors, the table holds %d' % (len(doors), self.max_doors))
+        sequence = self.sequence() + 1
+        SEQUENCE.pack_into(self.map, 8, sequence)
+        for n, (doorId, name, state, state_time, action, action_time) in enumerate(doors):
+            DOOR.pack_into(self.map, HEADER.size + n * DOOR.size,
+                           encode(doorId, 32), encode(name, 64), encode(state, 12),
+                           state_time if state_time is not None else math.nan,
+                           encode(action, 12),
+                           action_time if action_time is not None else math.nan)
+        HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, sequence + 1, version,
+                         toggle_count, len(doors))
+        return sequence + 1
+
+    def read(self):
+        """Return (sequence, version, toggle count, doors), None if no consistent copy was read."""
+        for _ in range(READ_RETRIES):
+            before = self.sequence()
+            if before % 2:
+                continue
+            data = self.map[:]
+            if self.sequence() != before:
+                continue
+            magic, layout, sequence, version, toggle_count, count = HEADER.unpack_from(data)
+            if magic != MAGIC or layout != LAYOUT_VERSION or sequence != before:
+                return None
+            if count > self.max_doors:
+                syslog.syslog('State table %s lists %d doors, it holds %d' % (
+                    self.path, count, self.max_doors))
+                return None
+            doors = []
+            for n in range(count):
+                fields = DOOR.unpack_from(data, HEADER.size + n * DOOR.size)
+                doors.append((decode(fields[0]), decode(fields[1]), decode(fields[2]),
+                              None if math.isnan(fields[3]) else fields[3],
+                              decode(fields[4]) or None,
+                              None if math.isnan(fields[5]) else fields[5]))
+            return sequence, version, toggle_count, doors
+        return None
+
+    def close(self):
+        self.map.close()
+
+
+class StatePublisher(object):
+    """Update handler of the sampler's Controller: writes the table, wakes the web process."""
+
+    def __init__(self, controller, table):
+        self.controller = controller
+        self.table = table
+        self.clients = set()
+        self.command_version = controller.version
+
+    def handle_updates(self):
+        sequence = self.table.write(
+            self.controller.version, self.controller.toggle_count,
+            [(d.id, d.name, d.last_state, d.last_state_time, d.last_action, d.last_action_time)
+             for d in self.controller.doors])
+        commands = self.controller.get_command_changes(self.command_version)
+        self.command_version = self.controller.version
+        for client in list(self.clients):
+            for update in commands:
+                client.send({'command': update})
+            client.send({'changed': sequence})
+
+
+class CommandServer(LineReceiver):
+    """Sampler side of the command socket, one per web process."""
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.factory.publisher.clients.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.publisher.clients.discard(self)
+
+    def send(self, message):
+        self.sendLine(str.encode(json.dumps(message)))
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.send({'reply': None, 'error': 'bad request'})
+            return
+        if request.get('toggle') is None:
+            self.send({'reply': None, 'error': 'unknown request'})
+            return
+        command = self.factory.controller.submit_toggle(request['toggle'])
+        self.send({'reply': command.as_update() if command is not None else None})
+
+
+class CommandServerFactory(protocol.Factory):
+    protocol = CommandServer
+
+    def __init__(self, controller, publisher):
+        self.controller = controller
+        self.publisher = publisher
+
+
+class CommandClient(LineReceiver):
+    """Web side of the command socket."""
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.replies = deque()
+        self.factory.resetDelay()
+        self.factory.view.set_command_client(self)
+
+    def connectionLost(self, reason):
+        self.factory.view.set_command_client(None)
+        while self.replies:
+            self.replies.popleft().errback(reason)
+
+    def toggle(self, doorId):
+        d = defer.Deferred()
+        self.replies.append(d)
+        self.sendLine(str.encode(json.dumps({'toggle': doorId})))
+        return d
+
+    def lineReceived(self, line):
+        message = json.loads(line.decode('utf-8'))
+        if 'reply' in message:
+            self.replies.popleft().callback(message['reply'])
+        elif 'command' in message:
+            self.factory.view.on_command(message['command'])
+        elif 'changed' in message:
+            self.factory.view.refresh()
+
+
+class CommandClientFactory(protocol.ReconnectingClientFactory):
+    protocol = CommandClient
+    maxDelay = 10
+
+    def __init__(self, view):
+        self.view = view
+
+
+class SharedDoor(object):
+    last_action = None
+    last_action_time = None
+    registry = None
+
+    def __init__(self, doorId, name):
+        self.id = doorId
+        self.name = name
+
+    @property
+    def last_state(self):
+        return self.registry.get_state(self.id)[0]
+
+    @property
+    def last_state_time(self):
+        return self.registry.get_state(self.id)[1]
+
+
+class SharedStateView(object):
+    """The doors of the table, with the interface of Controller the web resources use.
+
+    Like the hub, the view keeps its own change log, so its versions are
+    not the sampler's."""
+
+    def __init__(self, table_path, change_log_size=256, clock=None):
+        self.table_path = table_path
+        self.table = None
+        self.clock = clock or SystemClock()
+        self.registry = DoorRegistry()
+        self.change_log = ChangeLog(change_log_size)
+        self.updateHandlers = []
+        self.toggle_count = 0
+        self.sequence = None
+        self.command_client = None
+
+    @property
+    def doors(self):
+        return self.registry.doors
+
+    @property
+    def version(self):
+        return self.change_log.version
+
+    def set_update_handler(self, update_handler):
+        self.updateHandlers = [update_handler]
+
+    def add_update_handler(self, update_handler):
+        self.updateHandlers.append(update_handler)
+
+    def set_history(self, history):
+        pass  # The sampler records the transitions
+
+    def set_command_client(self, client):
+        self.command_client = client
+
+    def notify_updates(self):
+        for update_handler in self.updateHandlers:
+            update_handler.handle_updates()
+
+    def open_table(self):
+        try:
+            self.table = StateTable(self.table_path)
+        except (OSError, ValueError) as inst:
+            # The sampler has not created it yet
+            syslog.syslog('State table unavailable: %s' % inst)
+        return self.table is not None
+
+    def refresh(self):
+        """Read the table if it changed, return True if any door did."""
+        if self.table is not None and self.table.replaced():
+            # The sampler restarted and created a new table
+            self.table.close()
+            self.table = None
+        if self.table is None and not self.open_table():
+            return False
+        if self.table.sequence() == self.sequence:
+            return False
+        snapshot = self.table.read()
+        if snapshot is None:
+            return False
+        self.sequence, _, toggle_count, doors = snapshot
+        changed = toggle_count != self.toggle_count
+        self.toggle_count = toggle_count
+        seen = set()
+        for doorId, name, state, state_time, action, action_time in doors:
+            seen.add(doorId)
+            door = self.registry.get(doorId)
+            if door is None:
+                door = SharedDoor(doorId, name)
+                self.registry.add(door, state, state_time)
+                moved = True
+            else:
+                moved = (door.last_state, door.last_state_time) != (state, state_time)
+                if moved:
+                    self.registry.set_state(doorId, state, state_time)
+            door.name = name
+            door.last_action, door.last_action_time = action, action_time
+            if moved:
+                self.change_log.append(doorId, state, state_time)
+                changed = True
+        for door in [d for d in self.doors if d.id not in seen]:
+            self.registry.remove(door.id)
+            changed = True
+        if changed:
+            self.notify_updates()
+        return changed
+
+    def on_command(self, update):
+        self.change_log.append_command(update)
+        self.notify_updates()
+
+    def get_etag(self):
+        return '"%d-%d"' % (self.version, self.toggle_count)
+
+    def get_changes(self, version):
+        return self.change_log.get_changes(version, self.doors)
+
+    def get_command_changes(self, version):
+        return self.change_log.get_command_changes(version)
+
+    def get_updates(self, lastupdate):
+        return [(d.id, d.last_state, d.last_state_time)
+                for d in self.registry.changed_since(lastupdate)]
+
+    def submit_toggle(self, doorId):
+        """Send the toggle to the sampler, the Deferred fires with the command update."""
+        if self.command_client is None:
+            syslog.syslog('Toggle of %s dropped, the sampler is not connected' % doorId)
+            return defer.fail(RuntimeError('sampler not connected'))
+        return self.command_client.toggle(doorId)
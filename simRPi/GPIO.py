@@ -79,6 +79,13 @@ state = [LOW for _ in range(len(GPIO_BOARD_NAMES))]
 
 output_callback = [None for _ in range(len(GPIO_BOARD_NAMES))]
 
+# Print every output change
+verbose = True
+
+edge_detect = [None for _ in range(len(GPIO_BOARD_NAMES))]
+edge_callbacks = [[] for _ in range(len(GPIO_BOARD_NAMES))]
+edge_event = [False for _ in range(len(GPIO_BOARD_NAMES))]
+
 # class PWM():
 
 
@@ -133,14 +140,18 @@ def output(channel, mode):
         if output_callback[channel] is not None:
             output_callback[channel](channel, mode)
 
-    print("Pin {0} is now: {1}".format(getGPIOName(channel), mode))
+    if verbose:
+        print("Pin {0} is now: {1}".format(getGPIOName(channel), mode))
     return None
 
 
 def cleanup(channel=None):
-    global direction, state
+    global direction, state, edge_detect, edge_callbacks, edge_event
     direction = [UNKNOWN for _ in range(len(GPIO_BOARD_NAMES))]
     state = [LOW for _ in range(len(GPIO_BOARD_NAMES))]
+    edge_detect = [None for _ in range(len(GPIO_BOARD_NAMES))]
+    edge_callbacks = [[] for _ in range(len(GPIO_BOARD_NAMES))]
+    edge_event = [False for _ in range(len(GPIO_BOARD_NAMES))]
     return None
 
 
@@ -149,16 +160,38 @@ def setwarnings(state):
     return
 
 
-def add_event_callback():
-    raise NotImplementedError
+def add_event_callback(channel, callback):
+    if gpiomode == BOARD:
+        channel = convertBoardToGPIO(channel)
+    if edge_detect[channel] is None:
+        raise RuntimeError('Add event detection using add_event_detect first '
+                           'before adding a callback')
+    edge_callbacks[channel].append(callback)
+    return None
 
 
-def add_event_detect(channel):
-    raise NotImplementedError
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    if gpiomode == BOARD:
+        channel = convertBoardToGPIO(channel)
+    if direction[channel] is not IN:
+        raise RuntimeError('You must setup() the GPIO channel as an input first')
+    if edge not in [RISING, FALLING, BOTH]:
+        raise ValueError('The edge must be set to RISING, FALLING or BOTH')
+    if edge_detect[channel] is not None:
+        raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+    edge_detect[channel] = edge
+    edge_event[channel] = False
+    if callback is not None:
+        edge_callbacks[channel].append(callback)
+    return None
 
 
 def event_detected(channel):
-    raise NotImplementedError
+    if gpiomode == BOARD:
+        channel = convertBoardToGPIO(channel)
+    detected = edge_event[channel]
+    edge_event[channel] = False
+    return detected
 
 
 def getmode():
@@ -169,8 +202,13 @@ def gpio_function():
     raise NotImplementedError
 
 
-def remove_event_detect():
-    raise NotImplementedError
+def remove_event_detect(channel):
+    if gpiomode == BOARD:
+        channel = convertBoardToGPIO(channel)
+    edge_detect[channel] = None
+    edge_callbacks[channel] = []
+    edge_event[channel] = False
+    return None
 
 
 def wait_for_edge(channel, edge):
@@ -178,14 +216,25 @@ def wait_for_edge(channel, edge):
 
 
 def set_state(channel, mode):
-    """Set the specified pin state."""
+    """Set the specified pin state, firing edge callbacks if the level changed."""
     global state
     if gpiomode == BOARD:
         channel = convertBoardToGPIO[channel]
+    previous = state[channel]
     state[channel] = mode
+    if previous != mode:
+        _fire_edge(channel, RISING if mode else FALLING)
     return
 
 
+def _fire_edge(channel, edge):
+    if edge_detect[channel] not in [edge, BOTH]:
+        return
+    edge_event[channel] = True
+    for callback in list(edge_callbacks[channel]):
+        callback(channel)
+
+
 def set_output_callback(channel, callback):
     global output_callback
     if gpiomode == UNKNOWN:
@@ -195,3 +244,24 @@ def set_output_callback(channel, callback):
         channel = convertBoardToGPIO[channel]
     output_callback[channel] = callback
     return
+
+
+def replay(events, clock, on_event=None):
+    """Schedule recorded input levels on clock, relative to its current time.
+
+    events are (time, kind, channel, value) tuples as read by
+    gpio_trace.read_trace, times in seconds from the start of the trace.
+    Only input levels are replayed, recorded outputs are what the controller
+    did in the field. on_event(channel, value) runs after each level is set.
+    Return the time of the last event."""
+    def fire(channel, value):
+        set_state(channel, value)
+        if on_event is not None:
+            on_event(channel, value)
+
+    last = 0.0
+    for event_time, kind, channel, value in events:
+        last = max(last, event_time)
+        if kind == 'input':
+            clock.callLater(event_time, fire, channel, value)
+    return last
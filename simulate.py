@@ -0,0 +1,140 @@
+# Run the controller, the status loop and long-poll clients on a virtual
+# clock, with simulated doors that move when their relay is pressed.
+# A day of activity runs in seconds.
+#
+#   python3 simulate.py [config_file] [hours]
+
+import json
+import random
+import sys
+import time
+
+import simRPi.GPIO as gpio
+
+from twisted.internet import defer
+
+import garage_controller
+from clock import VirtualClock
+from garage_controller import Controller
+from garage_server import GarageDoorServer
+from gpio_backends import SimBackend
+
+
+class DoorMotor(object):
+    """Moves the simulated door when its relay is pressed."""
+
+    def __init__(self, door, clock):
+        self.door = door
+        self.clock = clock
+        self.moving = None
+        gpio.set_output_callback(door.relay_pin, self.on_relay)
+
+    def closed_value(self):
+        return self.door.state_pin_closed_value
+
+    def on_relay(self, channel, mode):
+        if mode:
+            return
+        if self.moving is not None and self.moving.active():
+            # Pressing during a move stops the door where it is
+            self.moving.cancel()
+            self.moving = None
+        elif gpio.input(self.door.state_pin) == self.closed_value():
+            self.clock.callLater(1, gpio.set_state, self.door.state_pin,
+                                 1 - self.closed_value())
+        else:
+            self.moving = self.clock.callLater(
+                self.door.time_to_close, gpio.set_state, self.door.state_pin,
+                self.closed_value())
+
+
+class LongPollClient(object):
+    """Stands in for a browser request parked on /upd, polls again when answered."""
+
+    def __init__(self, handler, clock):
+        self.handler = handler
+        self.clock = clock
+        self.version = 0
+        self.responses = 0
+
+    def poll(self):
+        self.args = {b'version': [str.encode(str(self.version))]}
+        self.written = []
+        self.finished = defer.Deferred()
+        body = self.handler.render_GET(self)
+        if isinstance(body, bytes):
+            self.on_response(body)
+
+    def setHeader(self, name, value):
+        pass
+
+    def notifyFinish(self):
+        return self.finished
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.on_response(b''.join(self.written))
+
+    def on_response(self, body):
+        self.version = json.loads(body.decode('utf-8'))['version']
+        self.responses += 1
+        self.clock.callLater(1, self.poll)
+
+
+def schedule_activity(controller, clock, end, rng):
+    """Toggle each door a few times an hour, sometimes leaving it open for long."""
+    for door in controller.doors:
+        when = clock.seconds()
+        while True:
+            when += rng.expovariate(1 / 1800.0)
+            if when >= end:
+                break
+            clock.callLater(when - clock.seconds(), controller.toggle, door.id)
+
+
+def run_simulation(config, hours=24, clients=3, seed=0):
+    gpio.verbose = False
+    clock = VirtualClock(time.time())
+    controller = Controller(config, clock, SimBackend(gpio))
+    server = GarageDoorServer(controller, config, clock)
+    controller.set_update_handler(server.updateHandler)
+
+    motors = [DoorMotor(door, clock) for door in controller.doors]
+    poll_clients = [LongPollClient(server.updateHandler, clock) for _ in range(clients)]
+    for client in poll_clients:
+        client.poll()
+
+    end = clock.seconds() + hours * 3600
+    schedule_activity(controller, clock, end, random.Random(seed))
+
+    alerts_before = sum(garage_controller.ALERTS.values.values())
+    transitions_before = sum(garage_controller.TRANSITIONS.values.values())
+    start = time.time()
+    server.start_status_check()
+    clock.run_until(end)
+
+    return {
+        'doors': len(motors),
+        'simulated_hours': hours,
+        'wall_seconds': time.time() - start,
+        'transitions': sum(garage_controller.TRANSITIONS.values.values()) - transitions_before,
+        'alerts': sum(garage_controller.ALERTS.values.values()) - alerts_before,
+        'longpoll_responses': sum(client.responses for client in poll_clients),
+    }
+
+
+def main(args):
+    config_filename = args[0] if args else 'config.json'
+    hours = float(args[1]) if len(args) > 1 else 24
+    with open(config_filename) as config_file:
+        config = json.load(config_file)
+    config['config']['use_openhab'] = False
+    config['alerts']['alert_type'] = None
+    for key, value in sorted(run_simulation(config, hours).items()):
+        print('%s: %s' % (key, value))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+import smtplib
+import socket
+import threading
+import time
+
+from collections import deque
+
+
+class SMTPTransport(object):
+    """One authenticated SMTP session kept open across alerts.
+
+    The session is checked with NOOP before each send and opened again
+    (connect, STARTTLS, login) when the server dropped it. The duration of
+    each send is kept in `latencies` so the saving can be measured."""
+
+    def __init__(self, host, port, username, password, use_tls=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.server = None
+        self.connects = 0
+        self.latencies = deque(maxlen=100)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.close()
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        server.login(self.username, self.password)
+        self.server = server
+        self.connects += 1
+
+    def is_connected(self):
+        if self.server is None:
+            return False
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def send(self, from_addr, to_addrs, message):
+        start = time.time()
+        with self.lock:
+            if not self.is_connected():
+                self.connect()
+            try:
+                self.transfer(from_addr, to_addrs, message)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # The server may have the message already, sending it again could
+                # deliver it twice: the dispatcher counts the attempt as failed
+                self.close()
+                raise
+        latency = time.time() - start
+        self.latencies.append(latency)
+        return latency
+
+    def transfer(self, from_addr, to_addrs, message):
+        """SMTP.sendmail in steps, so a session dropped before MAIL FROM is
+        answered is opened again: nothing was handed over yet."""
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        try:
+            self.server.ehlo_or_helo_if_needed()
+            code, response = self.server.mail(from_addr)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # Dropped between the NOOP and the send
+            self.connect()
+            code, response = self.server.mail(from_addr)
+        if code != 250:
+            self.server.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+        refused = {}
+        for to_addr in to_addrs:
+            code, response = self.server.rcpt(to_addr)
+            if code not in (250, 251):
+                refused[to_addr] = (code, response)
+        if len(refused) == len(to_addrs):
+            self.server.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, response = self.server.data(message)
+        if code != 250:
+            self.server.rset()
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def last_latency(self):
+        if not self.latencies:
+            return None
+        return self.latencies[-1]
+
+    def average_latency(self):
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
@@ -0,0 +1,62 @@
+# Snapshot of the door states, saved at intervals and on shutdown so a
+# restarted controller resumes where it stopped: the doors whose pins did
+# not change meanwhile are not announced again, and the open door alerts
+# keep their due times.
+#
+# The file is a small JSON object, replaced atomically:
+#   {"format": 1, "time": <save time>, "doors": {<door id>: {...}}}
+# with the fields of Controller.get_snapshot for every door.
+
+import json
+import os
+import syslog
+
+FORMAT_VERSION = 1
+
+
+def load(path):
+    """Return the doors saved at `path`, None if there is no usable snapshot."""
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as inst:
+        syslog.syslog('Snapshot %s ignored: %s' % (path, inst))
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('format') != FORMAT_VERSION:
+        syslog.syslog('Snapshot %s ignored: unknown format' % path)
+        return None
+    return snapshot.get('doors', {})
+
+
+def save(path, doors, time):
+    """Write the snapshot next to `path` then rename it, a crash leaves the previous one."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as snapshot_file:
+        json.dump({'format': FORMAT_VERSION, 'time': time, 'doors': doors},
+                  snapshot_file, separators=(',', ':'), sort_keys=True)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotWriter(object):
+    """Saves the snapshot of `controller`, only when it changed since the last save."""
+
+    def __init__(self, controller, path):
+        self.controller = controller
+        self.path = path
+        self.saved = None
+
+    def write(self):
+        doors = self.controller.get_snapshot()
+        if doors == self.saved:
+            return False
+        try:
+            save(self.path, doors, self.controller.clock.seconds())
+        except OSError as inst:
+            syslog.syslog('Snapshot %s not saved: %s' % (self.path, inst))
+            return False
+        self.saved = doors
+        return True
@@ -0,0 +1,115 @@
+import json
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+from urllib.parse import parse_qs
+
+import alert_backends
+from garage_controller import Controller
+
+
+class FakeEntryPoint(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def load(self):
+        return self.value
+
+
+class RecordingBackend(object):
+    def __init__(self, config, controller):
+        self.sent = []
+
+    def send(self, door, title, message):
+        self.sent.append((door.id, title))
+
+
+class AlertBackendsTest(unittest.TestCase):
+    def setUp(self):
+        with open('config.json') as config_file:
+            self.config = json.load(config_file)
+            self.config['config']['gpio_backend'] = 'sim'
+
+    def test_no_alert_imports(self):
+        # A controller without alerts does not pay for smtplib, email or http.client
+        code = ('import sys, garage_controller; '
+                'print(" ".join(m for m in ("smtplib", "email.mime.text", "http.client", '
+                '"concurrent.futures") if m in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'')
+
+    @patch("http_pool.ConnectionPool.request", autospec=True)
+    def test_pushover(self, mock_request):
+        self.config['alerts']['alert_type'] = 'pushover'
+        controller = Controller(self.config)
+        mock_request.return_value = (200, b'{"status": 1}')
+        controller.alert_backend.send(controller.doors[0], "title", "left is open")
+        body = mock_request.call_args[0][5]
+        self.assertEqual(parse_qs(body)['message'], ['left is open'])
+
+    @patch("http_pool.ConnectionPool.request", autospec=True)
+    def test_error_status(self, mock_request):
+        self.config['alerts']['alert_type'] = 'pushbullet'
+        controller = Controller(self.config)
+        door = controller.doors[0]
+        mock_request.return_value = (401, b'{"error": "invalid token"}')
+        self.assertRaises(IOError, controller.alert_backend.send, door, "title", "message")
+        self.assertEqual(door.pb_idens, {})
+
+        # Counted as a failed delivery
+        controller.send_alert(door, "title", "message")
+        controller.dispatcher.join()
+        self.assertEqual(controller.dispatcher.results['pushbullet']['failed'], 1)
+
+    def test_entry_point(self):
+        self.config['alerts']['alert_type'] = 'recording'
+        entry_points = [FakeEntryPoint('recording', RecordingBackend)]
+        with patch('importlib.metadata.entry_points', return_value=entry_points):
+            controller = Controller(self.config)
+        self.assertIsInstance(controller.alert_backend, RecordingBackend)
+
+        door = controller.doors[0]
+        controller.send_alert(door, "title", "message")
+        controller.dispatcher.join()
+        self.assertEqual(controller.alert_backend.sent, [(door.id, "title")])
+
+        self.config['alerts']['alert_type'] = 'nope'
+        with patch('importlib.metadata.entry_points', return_value=[]):
+            self.assertEqual(Controller(self.config).alert_type, None)
+        self.assertIs(alert_backends.find('smtp'), alert_backends.SMTPBackend)
+
+    def test_reload_keeps_or_closes_backends(self):
+        self.config['alerts']['alert_type'] = 'pushbullet'
+        controller = Controller(self.config)
+        pushbullet = controller.alert_backend
+
+        # Only the timings changed, the backend and its threads are kept
+        config = json.loads(json.dumps(self.config))
+        config['alerts']['time_to_wait'] = 1
+        controller.configure_alerts(config)
+        self.assertIs(controller.alert_backend, pushbullet)
+        self.assertEqual(controller.time_to_wait, 1)
+
+        config['alerts']['pushbullet']['access_token'] = 'other'
+        controller.configure_alerts(config)
+        self.assertIsNot(controller.alert_backend, pushbullet)
+        controller.dispatcher.join()
+        self.assertRaises(RuntimeError, pushbullet.fanout.submit, len, '')
+
+        # A backend that fails to build leaves the running settings alone
+        current = controller.alert_backend
+        config['alerts']['alert_type'] = 'pushover'
+        del config['alerts']['pushover']
+        config['alerts']['time_to_wait'] = 2
+        self.assertRaises(KeyError, controller.configure_alerts, config)
+        self.assertIs(controller.alert_backend, current)
+        self.assertEqual((controller.alert_type, controller.time_to_wait), ('pushbullet', 1))
+
+        config['alerts']['alert_type'] = None
+        with patch.object(current, 'close') as mock_close:
+            controller.configure_alerts(config)
+            controller.dispatcher.join()
+        mock_close.assert_called_once_with()
+        self.assertEqual(controller.alert_backend, None)
@@ -0,0 +1,88 @@
+import threading
+import unittest
+
+from alert_dispatcher import AlertDispatcher
+
+
+class AlertDispatcherTest(unittest.TestCase):
+    def test_results(self):
+        dispatcher = AlertDispatcher()
+        reported = []
+        dispatcher.set_result_handler(
+            lambda backend, success, error: reported.append((backend, success)))
+
+        def fail():
+            raise IOError("unreachable")
+
+        dispatcher.submit('smtp', lambda: None)
+        dispatcher.submit('smtp', fail)
+        dispatcher.join()
+        dispatcher.stop()
+
+        self.assertEqual(dispatcher.results['smtp'],
+                         {'sent': 1, 'failed': 1, 'dropped': 0})
+        self.assertEqual(sorted(reported), [('smtp', False), ('smtp', True)])
+
+    def test_queue_full(self):
+        dispatcher = AlertDispatcher(queue_size=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        self.assertTrue(dispatcher.submit('pushover', block))
+        started.wait()
+        self.assertTrue(dispatcher.submit('pushover', lambda: None))
+        self.assertFalse(dispatcher.submit('pushover', lambda: None))
+        release.set()
+        dispatcher.join()
+        dispatcher.stop()
+        self.assertEqual(dispatcher.results['pushover'],
+                         {'sent': 2, 'failed': 0, 'dropped': 1})
+
+    def test_backend_concurrency(self):
+        dispatcher = AlertDispatcher(concurrency={'openhab': 1})
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def deliver():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            threading.Event().wait(0.01)
+            with lock:
+                running.pop()
+
+        for _ in range(4):
+            dispatcher.submit('openhab', deliver)
+        dispatcher.join()
+        dispatcher.stop()
+        self.assertEqual(max(peak), 1)
+
+    def test_backends_independent(self):
+        dispatcher = AlertDispatcher()
+        release = threading.Event()
+        delivered = threading.Event()
+
+        # Two slow emails queued ahead of an openHAB update
+        dispatcher.submit('smtp', release.wait)
+        dispatcher.submit('smtp', release.wait)
+        dispatcher.submit('openhab', delivered.set)
+        self.assertTrue(delivered.wait(1))
+        self.assertEqual(dispatcher.results.get('smtp'), None)
+        release.set()
+        dispatcher.join()
+        dispatcher.stop()
+        self.assertEqual(dispatcher.results['smtp']['sent'], 2)
+
+    def test_backend_order(self):
+        dispatcher = AlertDispatcher()
+        delivered = []
+        for n in range(20):
+            dispatcher.submit('pushover', delivered.append, n)
+        dispatcher.join()
+        dispatcher.stop()
+        self.assertEqual(delivered, list(range(20)))
@@ -6,9 +6,7 @@ from unittest.mock import patch
 
 import json
 
-import sys
-sys.modules['RPi'] = __import__('simRPi')
-from garage_controller import Controller  # noqa
+from garage_controller import Controller
 
 
 def fake_syslog(message):
@@ -19,15 +17,18 @@ class ControllerTest(unittest.TestCase):
     def setUp(self):
         config_file = open('config_perso.json')
         self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
         config_file.close()
 
     @patch("syslog.syslog", side_effect=fake_syslog, autospec=True)
     def test_send_alert(self, mock_syslog):
         controller = Controller(self.config)
         for door in controller.doors:
-            self.assertEqual(door.pb_iden, None)
+            self.assertEqual(door.pb_idens, {})
             controller.send_alert(door, "Test alert", "A simple test to verify alert 1.")
+        controller.dispatcher.join()
 
         for door in controller.doors:
-            self.assertNotEqual(door.pb_iden, None)
+            self.assertNotEqual(door.pb_idens, {})
             controller.send_alert(door, "Test alert", "A simple test to verify alert 2.")
+        controller.dispatcher.join()
@@ -0,0 +1,39 @@
+import threading
+import time
+import unittest
+
+from clock import SystemClock, VirtualClock
+
+
+class SystemClockTest(unittest.TestCase):
+    def test_call_later(self):
+        clock = SystemClock()
+        called = threading.Event()
+        start = time.time()
+        call = clock.callLater(0.05, called.set)
+        # The caller is not blocked through the delay
+        self.assertLess(time.time() - start, 0.05)
+        self.assertTrue(call.active())
+        self.assertTrue(called.wait(1))
+        self.assertFalse(call.active())
+
+    def test_cancel(self):
+        clock = SystemClock()
+        called = []
+        call = clock.callLater(0.05, called.append, 1)
+        call.cancel()
+        time.sleep(0.1)
+        self.assertEqual(called, [])
+        self.assertFalse(call.active())
+
+
+class VirtualClockTest(unittest.TestCase):
+    def test_order(self):
+        clock = VirtualClock()
+        calls = []
+        clock.callLater(2, lambda: calls.append(('b', clock.seconds())))
+        clock.callLater(1, lambda: calls.append(('a', clock.seconds())))
+        clock.callLater(3, calls.append, 'cancelled').cancel()
+        clock.advance(5)
+        self.assertEqual(calls, [('a', 1), ('b', 2)])
+        self.assertEqual(clock.seconds(), 5)
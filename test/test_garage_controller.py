@@ -5,11 +5,14 @@ from unittest.mock import patch, call
 
 import json
 import random
+import threading
 
-import sys
-sys.modules['RPi'] = __import__('simRPi')
-from garage_controller import Controller  # noqa
-from garage_controller import format_seconds  # noqa
+from clock import VirtualClock
+from garage_controller import Controller
+from garage_controller import DeadlineQueue
+from garage_controller import DoorRegistry
+from garage_controller import PinFilter
+from garage_controller import format_seconds
 
 
 class MockUpdateHandler():
@@ -22,9 +25,17 @@ class ControllerTest(unittest.TestCase):
     def setUp(self):
         config_file = open('config.json')
         self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
         config_file.close()
 
-    @patch("RPi.GPIO.output", autospec=True)
+    def wait_for_release(self, door):
+        # SystemClock releases the relay from a timer thread
+        for _ in range(100):
+            if not door.relay_active:
+                return
+            threading.Event().wait(0.01)
+
+    @patch("simRPi.GPIO.output", autospec=True)
     def test_init(self, mock_output):
         controller = Controller(self.config)
         self.assertEqual(len(controller.doors), 2)
@@ -37,19 +48,132 @@ class ControllerTest(unittest.TestCase):
             self.assertEqual(door.last_action, None)
             self.assertEqual(door.last_action_time, None)
 
-    @patch("RPi.GPIO.output", autospec=True)
+    @patch("simRPi.GPIO.output", autospec=True)
     def test_toggle_relay(self, mock_output):
         controller = Controller(self.config)
 
         for door in controller.doors:
             controller.toggle(door.id)
+            self.wait_for_release(door)
             mock_output.assert_has_calls(
                 [call(door.relay_pin, False),
                  call(door.relay_pin, True)], any_order=False)
 
+    @patch("time.sleep", autospec=True)
+    @patch("simRPi.GPIO.output", autospec=True)
+    def test_scheduled_relay_pulse(self, mock_output, mock_sleep):
+        clock = VirtualClock(10.0)
+        controller = Controller(self.config, clock)
+
+        left, right = controller.doors
+        mock_output.reset_mock()
+        self.assertTrue(controller.toggle(left.id))
+        self.assertTrue(controller.toggle(right.id))
+        # Both pulses run concurrently and nothing sleeps
+        mock_output.assert_has_calls(
+            [call(left.relay_pin, False), call(right.relay_pin, False)])
+        self.assertEqual(mock_output.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 0)
+
+        # Overlapping pulse on the same relay is refused
+        self.assertFalse(controller.toggle(left.id))
+        self.assertEqual(len(clock.getDelayedCalls()), 2)
+
+        clock.advance(left.relay_pulse_time)
+        mock_output.assert_has_calls(
+            [call(left.relay_pin, True), call(right.relay_pin, True)])
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertTrue(controller.toggle(left.id))
+
+    @patch("simRPi.GPIO.output", autospec=True)
+    def test_command_queue(self, mock_output):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock)
+        left = controller.registry.get('left')
+        sim_gpio.set_state(left.state_pin, left.state_pin_closed_value)
+        controller.status_check()
+        version = controller.version
+        mock_output.reset_mock()
+
+        # A double tap pulses the relay once
+        command = controller.submit_toggle('left')
+        clock.advance(1)
+        self.assertIs(controller.submit_toggle('left'), command)
+        self.assertEqual(mock_output.call_count, 2)
+        self.assertEqual((command.action, command.status, command.requests),
+                         ('open', 'pending', 2))
+        self.assertEqual(controller.get_command_changes(version),
+                         [[command.id, 'left', 'open', 'pending', 1]])
+        self.assertIsNone(controller.submit_toggle('nope'))
+
+        # Done once the opening time has passed with the door open
+        sim_gpio.set_state(left.state_pin, 1 - left.state_pin_closed_value)
+        controller.status_check()
+        self.assertEqual(command.status, 'pending')
+        self.assertAlmostEqual(controller.next_check_delay(), left.time_to_open - 1)
+        clock.advance(left.time_to_open)
+        controller.status_check()
+        self.assertEqual(command.status, 'done')
+        self.assertEqual(controller.get_command_changes(version)[-1][3], 'done')
+
+        # A door that never closes fails its command after the grace time
+        command = controller.submit_toggle('left')
+        self.assertEqual(command.action, 'close')
+        clock.advance(left.time_to_close + controller.commands.grace)
+        controller.status_check()
+        self.assertEqual(command.status, 'failed')
+        self.assertEqual(controller.commands.pending, {})
+
+    @patch("simRPi.GPIO.output", autospec=True)
+    def test_stop_command(self, mock_output):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock)
+        left = controller.registry.get('left')
+        sim_gpio.set_state(left.state_pin, left.state_pin_closed_value)
+        controller.status_check()
+        controller.submit_toggle('left')
+        sim_gpio.set_state(left.state_pin, 1 - left.state_pin_closed_value)
+        clock.advance(5)
+        controller.status_check()
+        self.assertEqual(left.last_state, 'opening')
+
+        stop = controller.submit_toggle('left')
+        self.assertEqual(stop.action, None)
+        clock.advance(1)
+        self.assertIsNone(controller.commands.check(left, clock.seconds()))
+        self.assertEqual(stop.status, 'pending')
+        # Done when the door reports its next state
+        controller.status_check()
+        self.assertEqual(left.last_state, 'open')
+        self.assertEqual(stop.status, 'done')
+
+    @patch("simRPi.GPIO.output", autospec=True)
+    def test_command_resync(self, mock_output):
+        clock = VirtualClock(100.0)
+        self.config['config']['change_log_size'] = 2
+        controller = Controller(self.config, clock)
+        controller.registry.set_state('left', 'closed', 90.0)
+        controller.registry.set_state('right', 'closed', 90.0)
+        version = controller.version
+        left = controller.submit_toggle('left')
+        clock.advance(1)
+        right = controller.submit_toggle('right')
+        self.assertEqual(controller.get_command_changes(version),
+                         [left.as_update(), right.as_update()])
+
+        # The pending left command fell out of the log, a client behind it gets it anyway
+        clock.advance(controller.commands.coalesce_window)
+        controller.submit_toggle('right')
+        self.assertEqual([update[0] for update in controller.get_command_changes(version)],
+                         [left.id, right.id, right.id + 1])
+        self.assertEqual(controller.get_command_changes(controller.version - 1),
+                         [[right.id + 1, 'right', 'open', 'pending', 1]])
+        # So does a client from before a restart
+        self.assertEqual(len(controller.get_command_changes(controller.version + 5)), 2)
+
     @patch('time.time', autospec=True)
-    @patch("RPi.GPIO.output", autospec=True)
-    @patch("RPi.GPIO.input", autospec=True)
+    @patch("simRPi.GPIO.output", autospec=True)
+    @patch("simRPi.GPIO.input", autospec=True)
     def test_door_get_state(self, mock_input, mock_output, mock_time):
         start_time = 10.0
         mock_time.return_value = start_time
@@ -115,8 +239,8 @@ class ControllerTest(unittest.TestCase):
     @patch('time.time', autospec=True)
     @patch("garage_controller.Controller.send_alert", autospec=True)
     @patch("garage_controller.Controller.notify_state_change", autospec=True)
-    @patch("RPi.GPIO.output", autospec=True)
-    @patch("RPi.GPIO.input", side_effect=sim_gpio.input, autospec=True)
+    @patch("simRPi.GPIO.output", autospec=True)
+    @patch("simRPi.GPIO.input", side_effect=sim_gpio.input, autospec=True)
     def test_status_check_alert(self, mock_input, mock_output, mock_notify, mock_alert, mock_time):
         start_time = 10.0
         mock_time.return_value = start_time
@@ -186,8 +310,8 @@ class ControllerTest(unittest.TestCase):
     @patch('time.time', autospec=True)
     @patch("garage_controller.Controller.send_alert", autospec=True)
     @patch("garage_controller.Controller.notify_state_change", autospec=True)
-    @patch("RPi.GPIO.output", autospec=True)
-    @patch("RPi.GPIO.input", side_effect=sim_gpio.input, autospec=True)
+    @patch("simRPi.GPIO.output", autospec=True)
+    @patch("simRPi.GPIO.input", side_effect=sim_gpio.input, autospec=True)
     def test_toggle_sequence(self, mock_input, mock_output, mock_notify, mock_alert, mock_time):
         start_time = 10.0
         mock_time.return_value = start_time
@@ -201,6 +325,7 @@ class ControllerTest(unittest.TestCase):
         self.assertEqual(door.get_state(), 'closed')
 
         controller.toggle(door.id)
+        self.wait_for_release(door)
         mock_output.assert_has_calls(
             [call(door.relay_pin, False),
              call(door.relay_pin, True)], any_order=False)
@@ -237,6 +362,7 @@ class ControllerTest(unittest.TestCase):
         mock_alert.reset_mock()
 
         controller.toggle(door.id)
+        self.wait_for_release(door)
         sim_gpio.set_state(door.state_pin, 1)
 
         mock_time.return_value = start_time + door.time_to_open + \
@@ -270,6 +396,7 @@ class ControllerTest(unittest.TestCase):
         self.assertEqual(mock_alert.call_count, 0)
 
         controller.toggle(door.id)
+        self.wait_for_release(door)
 
         sim_gpio.set_state(door.state_pin, 1)
         mock_time.return_value = start_time + door.time_to_open / 2
@@ -291,6 +418,7 @@ class ControllerTest(unittest.TestCase):
         start_time = start_time + 2 * door.time_to_open + controller.time_to_wait + 2
         mock_time.return_value = start_time
         controller.toggle(door.id)
+        self.wait_for_release(door)
         self.assertEqual(door.get_state(), 'closing')
         controller.status_check()
         self.assertEqual(mock_alert.call_count, 0)
@@ -310,6 +438,7 @@ class ControllerTest(unittest.TestCase):
         start_time = start_time + 2 * door.time_to_close + controller.time_to_wait
         mock_time.return_value = start_time
         controller.toggle(door.id)
+        self.wait_for_release(door)
         self.assertEqual(door.get_state(), 'closing')
         controller.status_check()
         self.assertEqual(mock_alert.call_count, 0)
@@ -329,3 +458,214 @@ class ControllerTest(unittest.TestCase):
         for x in range(20):
             sec = random.randint(0, 5000)
             print("%s seconds, to formated seconds: %s" % (sec, format_seconds(sec)))
+
+    @patch('time.time', autospec=True)
+    def test_edge_detection(self, mock_time):
+        mock_time.return_value = 10.0
+        controller = Controller(self.config)
+        door = controller.doors[0]
+
+        edges = []
+        self.assertTrue(controller.enable_edge_detection(edges.append))
+        sim_gpio.set_state(door.state_pin, 1)
+        sim_gpio.set_state(door.state_pin, 1)
+        sim_gpio.set_state(door.state_pin, 0)
+        self.assertEqual(edges, [door.state_pin, door.state_pin])
+
+        # Enabling twice conflicts with the existing detection
+        self.assertFalse(controller.enable_edge_detection(edges.append))
+        sim_gpio.set_state(door.state_pin, 1)
+        self.assertEqual(len(edges), 2)
+
+    @patch("simRPi.GPIO.input", autospec=True)
+    def test_status_check_reads_pins_together(self, mock_input):
+        mock_input.return_value = 0
+        clock = VirtualClock(10.0)
+        controller = Controller(self.config, clock)
+        pins = [door.state_pin for door in controller.doors]
+
+        with patch.object(controller.backend, 'read_all',
+                          wraps=controller.backend.read_all) as mock_read_all:
+            controller.status_check()
+        mock_read_all.assert_called_once_with(pins)
+        mock_input.assert_has_calls([call(pin) for pin in pins])
+        for door in controller.doors:
+            self.assertEqual(door.last_state, 'closed')
+
+    @patch('time.time', autospec=True)
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_next_check_delay(self, mock_notify, mock_time):
+        start_time = 10.0
+        mock_time.return_value = start_time
+        controller = Controller(self.config)
+        controller.use_alerts = True
+        controller.time_to_wait = 10
+        door = controller.doors[0]
+
+        wakeups = []
+        controller.set_wakeup_handler(lambda: wakeups.append(True))
+
+        # All closed, nothing timed pending
+        controller.status_check()
+        self.assertEqual(controller.next_check_delay(), None)
+
+        controller.toggle(door.id)
+        self.assertEqual(wakeups, [True])
+        sim_gpio.set_state(door.state_pin, 1)
+        controller.status_check()
+        self.assertEqual(door.last_state, 'opening')
+        self.assertEqual(controller.next_check_delay(), door.time_to_open)
+
+        mock_time.return_value = start_time + door.time_to_open
+        controller.status_check()
+        self.assertEqual(door.last_state, 'open')
+        self.assertEqual(controller.next_check_delay(), controller.time_to_wait)
+
+    @patch("http_pool.ConnectionPool.request", autospec=True)
+    def test_pushbullet_iden_per_token(self, mock_request):
+        self.config['alerts']['alert_type'] = 'pushbullet'
+        self.config['alerts']['pushbullet']['access_token'] = ['a', 'b']
+        controller = Controller(self.config)
+        door = controller.doors[0]
+
+        mock_request.side_effect = lambda pool, scheme, host, method, url, body, headers: (
+            200, ('{"iden": "%s-1"}' % headers['Authorization'][-1]).encode())
+        controller.alert_backend.send(door, "title", "message")
+        self.assertEqual(door.pb_idens, {'a': 'a-1', 'b': 'b-1'})
+
+        mock_request.reset_mock()
+        controller.alert_backend.send(door, "title", "message")
+        deletes = sorted(c[0][4] for c in mock_request.call_args_list if c[0][3] == "DELETE")
+        self.assertEqual(deletes, ['/v2/pushes/a-1', '/v2/pushes/b-1'])
+
+    @patch('time.time', autospec=True)
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_get_changes(self, mock_notify, mock_time):
+        mock_time.return_value = 10.0
+        controller = Controller(self.config)
+        left, right = controller.doors
+
+        self.assertEqual(controller.get_changes(0), (0, []))
+        controller.status_check()
+        self.assertEqual(controller.version, 2)
+        version, updates = controller.get_changes(0)
+        self.assertEqual(version, 2)
+        self.assertEqual(sorted(u[0] for u in updates), sorted([left.id, right.id]))
+        self.assertEqual(controller.get_changes(2), (2, []))
+
+        # Only the latest state of a door is reported
+        mock_time.return_value = 20.0
+        sim_gpio.set_state(left.state_pin, 1)
+        controller.status_check()
+        sim_gpio.set_state(left.state_pin, 0)
+        controller.status_check()
+        self.assertEqual(controller.get_changes(2), (4, [(left.id, 'closed', 20.0)]))
+
+        # Unknown versions get every door
+        self.assertEqual(len(controller.get_changes(10)[1]), 2)
+        controller.change_log.changes.clear()
+        self.assertEqual(len(controller.get_changes(3)[1]), 2)
+
+    def test_door_registry(self):
+        class FakeDoor(object):
+            def __init__(self, doorId):
+                self.id = doorId
+
+        registry = DoorRegistry()
+        doors = [FakeDoor('door%d' % n) for n in range(500)]
+        for n, door in enumerate(doors):
+            registry.add(door, 'unknown', float(n % 7))
+        self.assertEqual(len(registry), 500)
+        self.assertIs(registry.get('door42'), doors[42])
+        self.assertEqual(registry.get('nope'), None)
+
+        registry.set_state('door3', 'open', 100.0)
+        registry.set_state('door10', 'closed', 50.0)
+        self.assertEqual([d.id for d in registry.changed_since(7.0)], ['door10', 'door3'])
+        self.assertEqual(registry.get_state('door3'), ('open', 100.0))
+
+        registry.remove('door10')
+        self.assertEqual([d.id for d in registry.changed_since(7.0)], ['door3'])
+        self.assertEqual(len(registry.changed_since(0.0)), 499)
+
+    def test_deadline_queue(self):
+        deadlines = DeadlineQueue()
+        deadlines.schedule('left', 'alert', 30.0)
+        deadlines.schedule('right', 'travel', 20.0)
+        deadlines.schedule('right', 'alert', 25.0)
+        self.assertEqual(deadlines.next_due(), 20.0)
+
+        # Rescheduled and cancelled entries are skipped
+        deadlines.schedule('left', 'alert', 40.0)
+        deadlines.cancel('right', 'travel')
+        self.assertEqual(deadlines.next_due(), 25.0)
+        self.assertEqual(deadlines.pop_due(30.0), [('right', 'alert')])
+        self.assertEqual(deadlines.pop_due(39.0), [])
+        self.assertEqual(deadlines.pop_due(40.0), [('left', 'alert')])
+        self.assertEqual((len(deadlines), deadlines.next_due()), (0, None))
+
+        for n in range(1000):
+            deadlines.schedule('left', 'alert', float(n))
+        self.assertLess(len(deadlines.heap), 100)
+
+    def test_pin_filter(self):
+        pin_filter = PinFilter(samples=3)
+        self.assertEqual(pin_filter.update(0, 0.0), 0)
+        # Chatter never reaches three matching reads
+        for value in [1, 0, 1, 1, 0]:
+            self.assertEqual(pin_filter.update(value, 0.0), 0)
+        self.assertEqual(pin_filter.update(1, 0.0), 0)
+        self.assertEqual(pin_filter.pending_deadline(0.0), 0.5)
+        self.assertEqual(pin_filter.update(1, 0.0), 0)
+        self.assertEqual(pin_filter.update(1, 0.0), 1)
+        self.assertEqual(pin_filter.pending_deadline(0.0), None)
+
+        pin_filter = PinFilter(settle_time=2)
+        pin_filter.update(0, 0.0)
+        self.assertEqual(pin_filter.update(1, 1.0), 0)
+        self.assertEqual(pin_filter.pending_deadline(1.0), 3.0)
+        self.assertEqual(pin_filter.update(1, 2.5), 0)
+        self.assertEqual(pin_filter.update(1, 3.0), 1)
+
+    @patch('time.time', autospec=True)
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_status_check_debounce(self, mock_notify, mock_time):
+        mock_time.return_value = 10.0
+        self.config['doors']['left']['debounce_time'] = 1
+        controller = Controller(self.config)
+        door = controller.registry.get('left')
+        controller.status_check()
+        mock_notify.reset_mock()
+
+        for n, value in enumerate([1, 0, 1, 0, 1]):
+            mock_time.return_value = 10.0 + n * 0.1
+            sim_gpio.set_state(door.state_pin, value)
+            controller.status_check()
+        self.assertEqual(mock_notify.call_count, 0)
+        self.assertAlmostEqual(controller.next_check_delay(), 1.0)
+
+        mock_time.return_value = 11.4
+        controller.status_check()
+        mock_notify.assert_called_once_with(controller, door, "open")
+
+    @patch("simRPi.GPIO.output", autospec=True)
+    @patch("garage_controller.Controller.send_alert", autospec=True)
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_door_left_open_for_a_day(self, mock_notify, mock_alert, mock_output):
+        from twisted.internet import task
+        clock = VirtualClock(1000.0)
+        controller = Controller(self.config, clock)
+        door = controller.registry.get('left')
+        sim_gpio.set_state(door.state_pin, 1 - door.state_pin_closed_value)
+        loop = task.LoopingCall(controller.status_check)
+        loop.clock = clock
+        loop.start(0.5)
+
+        clock.advance(24 * 3600)
+        loop.stop()
+        sim_gpio.set_state(door.state_pin, door.state_pin_closed_value)
+
+        # One alert once the door settles open, then one every repeat interval
+        alerts = [c for c in mock_alert.call_args_list if c[0][1] is door]
+        self.assertEqual(len(alerts), 24 * 3600 // controller.time_btw_alert_repeat)
+        self.assertEqual(door.last_state, 'open')
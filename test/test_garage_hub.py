@@ -0,0 +1,256 @@
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from types import SimpleNamespace
+from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.http_headers import Headers
+from twisted.web.test.requesthelper import DummyRequest
+
+import garage_hub  # noqa
+from garage_hub import HubClickHandler, HubView, SiteClient  # noqa
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeSiteClient(SiteClient):
+    """Answers from a list of canned responses, then waits forever."""
+
+    def __init__(self, view, site_id, responses, monitor_only=False):
+        config = {'url': 'http://%s' % site_id, 'monitor_only': monitor_only}
+        SiteClient.__init__(self, view, site_id, config, None, Clock())
+        self.responses = responses
+        self.paths = []
+
+    def get(self, path):
+        self.paths.append(path)
+        if self.responses:
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                return defer.fail(response)
+            return defer.succeed(response)
+        return defer.Deferred()
+
+    def get_json(self, path):
+        return self.get(path)
+
+    def click(self, path, with_cookie):
+        return self.get(path)
+
+
+class UpdateRecorder(object):
+    def __init__(self):
+        self.count = 0
+
+    def handle_updates(self):
+        self.count += 1
+
+
+class HubTest(unittest.TestCase):
+    def test_merge_sites(self):
+        view = HubView()
+        recorder = UpdateRecorder()
+        view.add_update_handler(recorder)
+
+        north = FakeSiteClient(view, 'north', [
+            [['left', 'LEFT', 'closed', 10.0], ['right', 'RIGHT', 'open', 11.0]],
+            {'version': 5, 'update': [['left', 'opening', 20.0]]}])
+        south = FakeSiteClient(view, 'south', [
+            [['left', 'LEFT', 'closed', 12.0]]])
+        for site in [north, south]:
+            view.add_site(site)
+            site.start()
+
+        self.assertEqual(north.paths, ['cfg', 'upd?lastupdate=0', 'upd?version=5'])
+        self.assertEqual(south.paths, ['cfg', 'upd?lastupdate=0'])
+        self.assertEqual(sorted(d.id for d in view.doors),
+                         ['north-left', 'north-right', 'south-left'])
+        self.assertEqual(view.registry.get('north-left').name, 'north LEFT')
+        self.assertEqual(view.registry.get('north-left').last_state, 'opening')
+        self.assertEqual(recorder.count, 3)
+
+        # Clients of the hub see every site through one change log
+        version, updates = view.get_changes(0)
+        self.assertEqual(version, 4)
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(view.get_changes(3), (4, [('south-left', 'closed', 12.0)]))
+        self.assertEqual(view.get_updates(15.0), [('north-left', 'opening', 20.0)])
+
+    def test_unchanged_state(self):
+        view = HubView()
+        self.assertTrue(view.update_door('north', 'left', 'LEFT', 'closed', 10.0))
+        self.assertFalse(view.update_door('north', 'left', None, 'closed', 10.0))
+        self.assertEqual(view.version, 1)
+
+    def test_retry(self):
+        view = HubView()
+        site = FakeSiteClient(view, 'north', [
+            IOError("refused"),
+            [['left', 'LEFT', 'closed', 10.0]],
+            defer.TimeoutError()])
+        site.start()
+        self.assertEqual(view.doors, [])
+        site.clock.advance(site.retry_delay)
+        self.assertEqual(len(view.doors), 1)
+        # A long poll timing out is polled again right away
+        self.assertEqual(site.paths, ['cfg', 'cfg', 'upd?lastupdate=0', 'upd?lastupdate=0'])
+
+    def test_toggle(self):
+        view = HubView()
+        site = FakeSiteClient(view, 'north', [[['my door', 'DOOR', 'closed', 10.0]]])
+        view.add_site(site)
+        site.start()
+        etag = view.get_etag()
+        self.assertTrue(view.toggle('north-my door'))
+        self.assertEqual(site.paths[-1], 'clk?id=my%20door')
+        self.assertNotEqual(view.get_etag(), etag)
+        self.assertFalse(view.toggle('south-left'))
+
+    def test_monitor_only(self):
+        view = HubView()
+        site = FakeSiteClient(view, 'north', [[['left', 'LEFT', 'closed', 10.0]]],
+                              monitor_only=True)
+        view.add_site(site)
+        site.start()
+        self.assertFalse(view.toggle('north-left'))
+
+        request = DummyRequest([])
+        request.args = {b'id': [b'north-left']}
+        HubClickHandler(view).render(request)
+        self.assertEqual(request.responseCode, 403)
+        self.assertEqual(site.paths, ['cfg', 'upd?lastupdate=0'])
+
+
+class FakeAgent(object):
+    """Answers with canned (code, Set-Cookie) responses, records the headers sent."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+
+    def request(self, method, url, headers):
+        self.sent.append((url, headers.getRawHeaders(b'cookie'),
+                          headers.getRawHeaders(b'authorization')))
+        code, cookie = self.responses.pop(0)
+        response_headers = Headers({b'set-cookie': [cookie]} if cookie else {})
+        return defer.succeed(SimpleNamespace(code=code, headers=response_headers))
+
+
+class SessionCookieTest(unittest.TestCase):
+    @patch('garage_hub.readBody', side_effect=lambda response: defer.succeed(b'{}'))
+    def test_cookie_reused(self, mock_read):
+        agent = FakeAgent([(200, b'garage_session=one; Max-Age=3600; HttpOnly'),
+                           (200, None),
+                           (401, None),
+                           (200, b'garage_session=two; Max-Age=3600; HttpOnly'),
+                           (200, None)])
+        site = SiteClient(HubView(), 'north', {'url': 'http://north', 'username': 'user',
+                                                'password': '12345'}, agent, Clock())
+        for _ in range(4):
+            site.toggle('left')
+        basic = site.headers[b'Authorization']
+        self.assertEqual([(cookie, authorization) for _, cookie, authorization in agent.sent], [
+            (None, basic),
+            ([b'garage_session=one'], None),
+            # The session ran out, logged in again
+            ([b'garage_session=one'], None),
+            (None, basic),
+            ([b'garage_session=two'], None)])
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class HubServerTest(unittest.TestCase):
+    """The hub in front of two simulated controllers, all real processes."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        with open(os.path.join(ROOT, 'config.json')) as config_file:
+            config = json.load(config_file)
+        config['config'].update({'use_alerts': False, 'use_auth': True})
+        self.ports = {}
+        hub_sites = {}
+        for site_id in ['north', 'south']:
+            self.ports[site_id] = free_port()
+            config['site']['port'] = self.ports[site_id]
+            self.start(site_id, 'garage_server_sim.py', config)
+            hub_sites[site_id] = {'url': self.url(site_id), 'monitor_only': site_id == 'south',
+                                  'username': 'user', 'password': '12345'}
+        self.ports['hub'] = free_port()
+        self.start('hub', 'garage_hub.py', {
+            'site': {'port': self.ports['hub'], 'username': 'admin', 'password': 'secret',
+                     'static_dir': os.path.join(ROOT, 'www')},
+            'sites': hub_sites})
+
+    def start(self, name, script, config):
+        filename = os.path.join(self.tmp, name + '.json')
+        with open(filename, 'w') as config_file:
+            json.dump(config, config_file)
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, script), filename],
+                                   cwd=ROOT, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d' % self.ports[name]
+
+    def get(self, name, path, credentials=None):
+        request = Request('%s/%s' % (self.url(name), path))
+        if credentials:
+            request.add_header('Authorization', 'Basic ' + bytes.decode(base64.b64encode(
+                str.encode(credentials))))
+        try:
+            with urlopen(request, timeout=5) as response:
+                return response.status, json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            return e.code, None
+
+    def wait_for(self, condition, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                result = condition()
+                if result:
+                    return result
+            except OSError:
+                pass
+            time.sleep(0.1)
+        self.fail('timed out')
+
+    def last_action_time(self, site_id):
+        return self.get(site_id, 'doors')[1][0]['last_action_time']
+
+    def test_clicks(self):
+        self.wait_for(lambda: len(self.get('hub', 'cfg')[1]) == 4)
+
+        self.assertEqual(self.get('hub', 'upt')[0], 200)
+        self.assertEqual(self.get('hub', 'clk?id=north-left')[0], 401)
+        self.assertEqual(self.get('hub', 'clk?id=north-left', 'admin:wrong')[0], 401)
+        self.assertEqual(self.get('hub', 'clk?id=south-left', 'admin:secret')[0], 403)
+
+        status, command = self.get('hub', 'clk?id=north-left', 'admin:secret')
+        self.assertEqual(status, 200)
+        self.assertEqual(command['status'], 'forwarded')
+        # The site checks the credentials of the hub in turn
+        self.wait_for(lambda: self.last_action_time('north'))
+        self.assertEqual(self.last_action_time('south'), None)
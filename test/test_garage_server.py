@@ -1,24 +1,594 @@
 import unittest
+from unittest.mock import Mock, patch
 
+import gzip
 import json
+import os
+import shutil
+import signal
+import tempfile
+import time
 
-import sys
-sys.modules['RPi'] = __import__('simRPi')
+import simRPi.GPIO as sim_gpio
+
+from clock import VirtualClock  # noqa
 from garage_controller import Controller  # noqa
+import build_assets  # noqa
 import garage_server  # noqa
+from history import EventHistory  # noqa
+from host_health import HostHealth  # noqa
+
+from twisted.internet import defer  # noqa
+from twisted.web.server import NOT_DONE_YET  # noqa
+from twisted.web.test.requesthelper import DummyRequest  # noqa
 
 
 class UptimeHandlerTest(unittest.TestCase):
     def setUp(self):
         config_file = open('config.json')
         self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
         config_file.close()
 
     def test_uptime(self):
+        health = HostHealth()
+        health.sample()
+        uptime_handler = garage_server.UptimeHandler(health)
+        health.snapshot['uptime'] = 93784.5
+        self.assertEqual(uptime_handler.getUptime(), b'1 day, 2:03:04')
+
+
+class HealthHandlerTest(unittest.TestCase):
+    def test_snapshot(self):
+        health = HostHealth()
+        handler = garage_server.HealthHandler(health)
+        self.assertEqual(handler.render_GET(DummyRequest([b''])), b'{}')
+
+        health.sample()
+        snapshot = json.loads(handler.render_GET(DummyRequest([b''])).decode())
+        self.assertGreater(snapshot['uptime'], 0.0)
+        self.assertEqual(len(snapshot['loadavg']), 3)
+        self.assertGreater(snapshot['memory']['total_kb'], 0)
+
+    def test_missing_files(self):
+        health = HostHealth(proc='/nonexistent', thermal_zone='/nonexistent')
+        snapshot = health.sample()
+        self.assertEqual(snapshot['uptime'], None)
+        self.assertEqual(snapshot['cpu_temperature'], None)
+
+    def test_unparsable_files(self):
+        proc = tempfile.mkdtemp()
+        try:
+            for name, data in (('uptime', ''), ('loadavg', '0.1 0.2 x'),
+                               ('meminfo', 'MemTotal: lots kB\n')):
+                with open(os.path.join(proc, name), 'w') as f:
+                    f.write(data)
+            health = HostHealth(proc=proc, thermal_zone=proc)
+            with open(os.path.join(proc, 'temp'), 'w') as f:
+                f.write('hot')
+            snapshot = health.sample()
+        finally:
+            shutil.rmtree(proc)
+        self.assertEqual([snapshot[key] for key in
+                          ('uptime', 'loadavg', 'memory', 'cpu_temperature')],
+                         [None, None, None, None])
+
+
+class UpdateHandlerTest(unittest.TestCase):
+    def setUp(self):
+        config_file = open('config.json')
+        self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        config_file.close()
+
+    def request(self, args):
+        request = DummyRequest([b''])
+        request.args = args
+        return request
+
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_fan_out(self, mock_notify):
         controller = Controller(self.config)
-        uptime_handler = garage_server.UptimeHandler(controller)
-        uptime = uptime_handler.getUptime()
-        # Check that all field returned a numerical value greater or equal to zero
-        uptime_fields = uptime.split(b":")
-        for field in uptime_fields:
-            self.assertGreaterEqual(float(field), 0.0)
+        controller.status_check()
+        handler = garage_server.UpdateHandler(controller)
+
+        # Out of date client is answered right away
+        request = self.request({b'version': [b'0']})
+        response = json.loads(handler.render_GET(request).decode())
+        self.assertEqual(response['version'], 2)
+        self.assertEqual(len(response['update']), 2)
+
+        waiting = [self.request({b'version': [b'2']}) for _ in range(3)]
+        waiting.append(self.request({b'lastupdate': [b'%d' % (time.time() + 10)]}))
+        for request in waiting:
+            self.assertEqual(handler.render_GET(request), NOT_DONE_YET)
+        self.assertEqual(list(handler.delayed_requests.keys()), [(2, None)])
+
+        handler.handle_updates()
+        self.assertEqual(sum(r.finished for r in waiting), 0)
+
+        door = controller.doors[0]
+        sim_gpio.set_state(door.state_pin, 1)
+        controller.status_check()
+        handler.handle_updates()
+        self.assertEqual(handler.delayed_requests, {})
+        bodies = set(b''.join(r.written) for r in waiting)
+        self.assertEqual(len(bodies), 1)
+        response = json.loads(bodies.pop().decode())
+        self.assertEqual(response['version'], 3)
+        self.assertEqual(response['update'][0][:2], [door.id, 'open'])
+        self.assertEqual(sum(r.finished for r in waiting), 4)
+
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_groups_merged(self, mock_notify):
+        controller = Controller(self.config)
+        sim_gpio.set_state(controller.doors[0].state_pin, 0)
+        controller.status_check()
+        handler = garage_server.UpdateHandler(controller)
+
+        # Groups seen at two versions without door changes in between
+        first = self.request({b'version': [b'2']})
+        handler.render_GET(first)
+        controller.change_log.touch()
+        second = self.request({b'version': [b'3']})
+        handler.render_GET(second)
+        controller.change_log.touch()
+        handler.handle_updates()
+        self.assertEqual(handler.delayed_requests, {(4, None): [first, second]})
+        self.assertEqual(handler.waiting_count(), 2)
+
+        # A client going away is found in its new group
+        handler.remove_request(first)
+        self.assertEqual(handler.delayed_requests, {(4, None): [second]})
+
+    def test_bad_version(self):
+        handler = garage_server.UpdateHandler(Controller(self.config))
+        for args in ({b'version': [b'abc']}, {b'lastupdate': [b'x']}):
+            request = self.request(args)
+            self.assertIn(b'error', handler.render_GET(request))
+            self.assertEqual(request.responseCode, 400)
+
+
+class EventStreamHandlerTest(unittest.TestCase):
+    def setUp(self):
+        config_file = open('config.json')
+        self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        config_file.close()
+
+    def events(self, request):
+        data = b''.join(request.written).decode()
+        return [json.loads(line[len('data: '):])
+                for line in data.split('\n') if line.startswith('data: ')]
+
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_stream(self, mock_notify):
+        controller = Controller(self.config)
+        controller.status_check()
+        handler = garage_server.EventStreamHandler(controller)
+
+        request = DummyRequest([b''])
+        self.assertEqual(handler.render_GET(request), NOT_DONE_YET)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'content-type'),
+                         [b'text/event-stream'])
+        events = self.events(request)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(len(events[0]['update']), 2)
+
+        # Resume from the last event id
+        resumed = DummyRequest([b''])
+        resumed.requestHeaders.setRawHeaders(b'last-event-id', [b'2'])
+        handler.render_GET(resumed)
+        self.assertEqual(self.events(resumed), [])
+
+        door = controller.doors[0]
+        sim_gpio.set_state(door.state_pin, 1)
+        controller.status_check()
+        handler.handle_updates()
+        for stream in [request, resumed]:
+            self.assertEqual(self.events(stream)[-1]['update'][0][:2], [door.id, 'open'])
+        self.assertIn(b'id: 3\n', b''.join(resumed.written))
+
+        handler.send_heartbeat()
+        self.assertEqual(resumed.written[-1], b': heartbeat\n\n')
+
+        resumed.processingFailed(Exception("gone"))
+        self.assertEqual(list(handler.streams), [request])
+
+
+class MetricsHandlerTest(unittest.TestCase):
+    def setUp(self):
+        config_file = open('config.json')
+        self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        config_file.close()
+
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_metrics(self, mock_notify):
+        controller = Controller(self.config)
+        garage_server.GarageDoorServer(controller, self.config)
+        controller.status_check()
+
+        handler = garage_server.MetricsHandler()
+        text = handler.render_GET(DummyRequest([b''])).decode()
+        self.assertIn('garage_status_check_seconds_count', text)
+        self.assertIn('garage_gpio_read_seconds_bucket', text)
+        self.assertIn('garage_door_transitions_total{door="%s",state="closed"}'
+                      % controller.doors[0].id, text)
+        self.assertIn('garage_longpoll_waiting 0.0', text)
+        self.assertIn('garage_connected_clients 0.0', text)
+
+
+class ConfigReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'config.json')
+        with open('config.json') as config_file:
+            self.config = json.load(config_file)
+            self.config['config']['gpio_backend'] = 'sim'
+        self.write_config(self.config, 1000)
+
+    def tearDown(self):
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        shutil.rmtree(self.dir)
+
+    def write_config(self, config, mtime):
+        with open(self.path, 'w') as config_file:
+            json.dump(config, config_file)
+        os.utime(self.path, (mtime, mtime))
+
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_reload_keeps_state(self, mock_notify):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock)
+        server = garage_server.GarageDoorServer(controller, self.config, clock)
+        server.watch_config(self.path)
+        left = controller.registry.get('left')
+        sim_gpio.set_state(left.state_pin, 1 - left.state_pin_closed_value)
+        sim_gpio.set_state(controller.registry.get('right').state_pin, 0)
+        controller.status_check()
+        version = controller.version
+        etag = controller.get_etag()
+
+        config = json.loads(json.dumps(self.config))
+        config['doors']['left']['name'] = 'Workshop'
+        config['doors']['middle'] = dict(config['doors'].pop('right'), relay_pin=25, state_pin=22)
+        config['alerts']['time_to_wait'] = 1
+        config['config']['gpio_backend'] = 'rpi'
+        self.write_config(config, 2000)
+        mock_notify.reset_mock()
+        with patch("simRPi.GPIO.setup", side_effect=sim_gpio.setup) as mock_setup:
+            clock.advance(5)
+        # Only the pins of the new door are set up
+        self.assertEqual(sorted(c[0][0] for c in mock_setup.call_args_list), [22, 25])
+
+        self.assertIs(controller.registry.get('left'), left)
+        self.assertEqual(left.name, 'Workshop')
+        self.assertEqual(left.last_state, 'open')
+        self.assertEqual(left.last_state_time, 100.0)
+        self.assertEqual(controller.registry.get('right'), None)
+        self.assertEqual(controller.registry.get('middle').last_state, 'unknown')
+        self.assertEqual(controller.time_to_wait, 1)
+        self.assertEqual(server.config['config']['gpio_backend'], 'sim')
+        self.assertEqual(controller.version, version + 1)
+        self.assertNotEqual(controller.get_etag(), etag)
+
+        # Only the new door is announced
+        sim_gpio.set_state(22, 0)
+        controller.status_check()
+        self.assertEqual([c[0][1].id for c in mock_notify.call_args_list], ['middle'])
+
+        # A broken file leaves the running config alone
+        with open(self.path, 'w') as config_file:
+            config_file.write('{"doors": ')
+        self.assertFalse(server.reload_config())
+        self.assertEqual(len(controller.doors), 2)
+
+    def test_bad_alert_settings(self):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock)
+        server = garage_server.GarageDoorServer(controller, self.config, clock)
+        server.watch_config(self.path)
+
+        config = json.loads(json.dumps(self.config))
+        config['alerts']['time_to_wait'] = 'soon'
+        self.write_config(config, 2000)
+        clock.advance(5)
+        del config['config']['use_alerts']
+        self.write_config(config, 3000)
+        clock.advance(5)
+        self.assertEqual(controller.time_to_wait, self.config['alerts']['time_to_wait'])
+
+        # A failure applying a valid looking file keeps the watcher running
+        config = json.loads(json.dumps(self.config))
+        config['alerts']['alert_type'] = 'pushover'
+        del config['alerts']['pushover']
+        self.write_config(config, 4000)
+        clock.advance(5)
+        self.assertIs(server.config, self.config)
+        self.assertTrue(server.config_watcher.running)
+
+        self.write_config(self.config, 5000)
+        clock.advance(5)
+        self.assertIsNot(server.config, self.config)
+
+    def test_bad_pin_changes_nothing(self):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock)
+        server = garage_server.GarageDoorServer(controller, self.config, clock)
+        server.watch_config(self.path)
+        left = controller.registry.get('left')
+
+        config = json.loads(json.dumps(self.config))
+        config['doors']['left']['name'] = 'Workshop'
+        config['doors']['a'] = dict(config['doors'].pop('right'), relay_pin=500)
+        config['alerts']['time_to_wait'] = 1
+        self.write_config(config, 2000)
+        clock.advance(5)
+        self.assertIs(server.config, self.config)
+        self.assertEqual([d.id for d in controller.doors], ['left', 'right'])
+        self.assertEqual(left.name, self.config['doors']['left']['name'])
+        self.assertEqual(controller.time_to_wait, self.config['alerts']['time_to_wait'])
+
+        config['doors']['a']['relay_pin'] = 25
+        self.write_config(config, 3000)
+        clock.advance(5)
+        self.assertEqual(sorted(d.id for d in controller.doors), ['a', 'left'])
+        self.assertIs(controller.registry.get('left'), left)
+        self.assertEqual(left.name, 'Workshop')
+        self.assertEqual(controller.time_to_wait, 1)
+
+    def test_state_table_full(self):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock)
+        server = garage_server.GarageDoorServer(controller, self.config, clock, max_doors=2)
+        server.watch_config(self.path)
+
+        config = json.loads(json.dumps(self.config))
+        config['doors']['middle'] = dict(config['doors']['right'], relay_pin=25, state_pin=22)
+        self.write_config(config, 2000)
+        clock.advance(5)
+        self.assertEqual(len(controller.doors), 2)
+        self.assertIs(server.config, self.config)
+        self.assertTrue(server.config_watcher.running)
+
+
+class HistoryHandlerTest(unittest.TestCase):
+    def test_recent(self):
+        history = EventHistory(':memory:')
+        history.record('left', 'open', 10.0)
+        history.record('right', 'open', 20.0)
+        handler = garage_server.HistoryHandler(history)
+
+        request = DummyRequest([b''])
+        request.args = {b'door': [b'right'], b'from': [b'15']}
+        self.assertEqual(json.loads(handler.render_GET(request).decode()),
+                         [[20.0, 'right', 'open']])
+
+        request = DummyRequest([b''])
+        request.args = {b'from': [b'yesterday']}
+        handler.render_GET(request)
+        self.assertEqual(request.responseCode, 400)
+
+
+class StaticFileTest(unittest.TestCase):
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.bundle = build_assets.build('www', os.path.join(self.output, 'dist'))
+        self.root = garage_server.StaticFile(os.path.join(self.output, 'dist'))
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def get(self, path, accept_encoding=None):
+        request = DummyRequest(path.split(b'/'))
+        if accept_encoding is not None:
+            request.requestHeaders.setRawHeaders(b'accept-encoding', [accept_encoding])
+        resource = self.root
+        while request.postpath:
+            resource = resource.getChildWithDefault(request.postpath.pop(0), request)
+        resource.render(request)
+        return request
+
+    def header(self, request, name):
+        values = request.responseHeaders.getRawHeaders(name)
+        return values[0] if values else None
+
+    def test_index(self):
+        request = self.get(b'index.html')
+        index = b''.join(request.written)
+        self.assertIn(str.encode('/' + self.bundle), index)
+        self.assertNotIn(b'date.format.js', index)
+        self.assertEqual(self.header(request, b'cache-control'), b'no-cache')
+        self.assertEqual(self.header(request, b'content-encoding'), None)
+
+    def test_compressed_hashed_asset(self):
+        request = self.get(str.encode(self.bundle), b'gzip, deflate')
+        self.assertEqual(self.header(request, b'content-encoding'), b'gzip')
+        self.assertEqual(self.header(request, b'vary'), b'Accept-Encoding')
+        self.assertIn(b'immutable', self.header(request, b'cache-control'))
+        bundle = gzip.decompress(b''.join(request.written))
+        self.assertIn(b'dateFormat', bundle)
+        self.assertIn(b'function poll', bundle)
+
+        request = self.get(str.encode(self.bundle), b'gzip;q=0')
+        self.assertEqual(self.header(request, b'content-encoding'), None)
+        self.assertEqual(self.header(request, b'vary'), b'Accept-Encoding')
+
+        request = self.get(str.encode(self.bundle))
+        self.assertEqual(self.header(request, b'content-encoding'), None)
+        self.assertEqual(self.header(request, b'vary'), b'Accept-Encoding')
+
+
+class DoorsHandlerTest(unittest.TestCase):
+    def setUp(self):
+        config_file = open('config.json')
+        self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        config_file.close()
+
+    def get(self, handler, etag=None):
+        request = DummyRequest([b''])
+        if etag is not None:
+            request.requestHeaders.setRawHeaders(b'if-none-match', [etag])
+        body = handler.render_GET(request)
+        return request, body
+
+    @patch("time.sleep", autospec=True)
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_etag(self, mock_notify, mock_sleep):
+        controller = Controller(self.config)
+        controller.status_check()
+        handler = garage_server.DoorsHandler(controller)
+
+        request, body = self.get(handler)
+        doors = json.loads(body.decode())
+        self.assertEqual([d['state'] for d in doors], ['closed', 'closed'])
+        etag = request.responseHeaders.getRawHeaders(b'etag')[0]
+
+        request, body = self.get(handler, etag)
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(body, b'')
+
+        # Serialized once per version
+        self.assertIs(self.get(handler)[1], self.get(handler)[1])
+
+        controller.toggle(controller.doors[0].id)
+        sim_gpio.set_state(controller.doors[0].state_pin, 1)
+        controller.status_check()
+        request, body = self.get(handler, etag)
+        self.assertNotEqual(request.responseCode, 304)
+        self.assertEqual(json.loads(body.decode())[0]['pending_action'], 'open')
+
+    def test_status(self):
+        controller = Controller(self.config)
+        handler = garage_server.StatusHandler(controller)
+        request = DummyRequest([b''])
+        request.args = {b'id': [str.encode(controller.doors[0].id)]}
+        self.assertEqual(handler.render(request), b'unknown')
+        request.args = {b'id': [b'nope']}
+        self.assertEqual(handler.render(request), b'')
+
+
+class ClickHandlerTest(unittest.TestCase):
+    def setUp(self):
+        config_file = open('config.json')
+        self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        config_file.close()
+
+    def test_command_reported(self):
+        from clock import VirtualClock
+        controller = Controller(self.config, VirtualClock(100.0))
+        handler = garage_server.ClickHandler(controller)
+        update_handler = garage_server.UpdateHandler(controller)
+        controller.set_update_handler(update_handler)
+        controller.status_check()
+
+        poll = DummyRequest([b''])
+        poll.args = {b'version': [str.encode(str(controller.version))]}
+        self.assertEqual(update_handler.render_GET(poll), NOT_DONE_YET)
+
+        request = DummyRequest([b''])
+        request.args = {b'id': [b'left']}
+        command = json.loads(handler.render_GET(request).decode())
+        self.assertEqual((command['door'], command['status']), ('left', 'pending'))
+        self.assertEqual(json.loads(b''.join(poll.written).decode())['commands'],
+                         [[command['command'], 'left', command['action'], 'pending', 1]])
+
+        request.args = {b'id': [b'nope']}
+        handler.render_GET(request)
+        self.assertEqual(request.responseCode, 404)
+
+
+class SessionGuardTest(unittest.TestCase):
+    class Protected(object):
+        def render(self, request):
+            return b'OK'
+
+    def setUp(self):
+        from clock import VirtualClock
+        from session_auth import SessionAuth, hash_password
+        self.auth = SessionAuth('user', hash_password('12345', iterations=1000),
+                                VirtualClock(1000.0), max_failures=2)
+        self.guard = garage_server.SessionGuard(self.Protected(), self.auth)
+        # Password checks run in the calling thread
+        patcher = patch('garage_server.threads.deferToThread', side_effect=defer.maybeDeferred)
+        self.deferToThread = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, headers):
+        request = DummyRequest([b''])
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name, [value])
+        body = self.guard.render(request)
+        if body == NOT_DONE_YET:
+            body = b''.join(request.written)
+        return request, body
+
+    def test_basic_then_cookie(self):
+        request, body = self.request({})
+        self.assertEqual(request.responseCode, 401)
+        self.assertIn(b'Basic', request.responseHeaders.getRawHeaders(b'WWW-Authenticate')[0])
+
+        request, body = self.request({b'Authorization': b'Basic dXNlcjoxMjM0NQ=='})
+        self.assertEqual(body, b'OK')
+        cookie = request.responseHeaders.getRawHeaders(b'Set-Cookie')[0]
+        self.assertIn(b'SameSite=Strict', cookie)
+        cookie = cookie.split(b';')[0]
+
+        with patch('session_auth.verify_password') as mock_verify:
+            request, body = self.request({b'Cookie': b'theme=dark; ' + cookie,
+                                          b'Authorization': b'Basic dXNlcjoxMjM0NQ=='})
+            self.assertEqual(body, b'OK')
+            token = cookie.split(b'=', 1)[1]
+            request, body = self.request({b'Authorization': b'Bearer ' + token})
+            self.assertEqual(body, b'OK')
+        mock_verify.assert_not_called()
+
+    def test_render_error_after_login(self):
+        self.guard.resource = Mock()
+        self.guard.resource.render.side_effect = KeyError(b'id')
+        request, body = self.request({b'Authorization': b'Basic dXNlcjoxMjM0NQ=='})
+        self.assertEqual(request.responseCode, 500)
+        self.assertEqual(request.finished, 1)
+
+        # Clicks without a door id are answered before reaching the controller
+        click = garage_server.ClickHandler(Mock())
+        self.guard.resource = click
+        request, body = self.request({b'Authorization': b'Basic dXNlcjoxMjM0NQ=='})
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(request.finished, 1)
+        click.controller.submit_toggle.assert_not_called()
+
+    def test_throttled(self):
+        for _ in range(2):
+            request, body = self.request({b'Authorization': b'Basic dXNlcjp3cm9uZw=='})
+            self.assertEqual(request.responseCode, 401)
+        with patch('session_auth.verify_password') as mock_verify:
+            request, body = self.request({b'Authorization': b'Basic dXNlcjoxMjM0NQ=='})
+        self.assertEqual(request.responseCode, 429)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'Retry-After'), [b'30'])
+        mock_verify.assert_not_called()
+
+    def test_one_check_per_client(self):
+        checks = []
+
+        def deferToThread(f, *args):
+            checks.append(defer.Deferred())
+            return checks[-1]
+
+        self.deferToThread.side_effect = deferToThread
+        request, body = self.request({b'Authorization': b'Basic dXNlcjp3cm9uZw=='})
+        self.assertEqual(request.written, [])
+
+        # Guesses sent in parallel wait for the running check
+        request, body = self.request({b'Authorization': b'Basic dXNlcjp3cm9uZw=='})
+        self.assertEqual(request.responseCode, 429)
+        self.assertEqual(len(checks), 1)
+
+        checks[0].callback(False)
+        request, body = self.request({b'Authorization': b'Basic dXNlcjp3cm9uZw=='})
+        checks[1].callback(False)
+        self.assertEqual(request.responseCode, 401)
+        self.assertEqual([count for count, _, _ in self.auth.failures.values()], [2])
@@ -0,0 +1,150 @@
+import enum
+import json
+import sys
+import types
+import unittest
+from unittest.mock import patch
+
+from clock import VirtualClock
+from garage_controller import Controller
+import gpio_backends
+
+
+class Value(enum.Enum):
+    INACTIVE = 0
+    ACTIVE = 1
+
+
+class Direction(enum.Enum):
+    INPUT = 1
+    OUTPUT = 2
+
+
+class Bias(enum.Enum):
+    DISABLED = 1
+    PULL_UP = 2
+
+
+class LineSettings(object):
+    def __init__(self, **kw):
+        self.kw = kw
+
+    def __eq__(self, other):
+        return self.kw == other.kw
+
+    def __repr__(self):
+        return 'LineSettings(%r)' % self.kw
+
+
+class LineRequest(object):
+    """Records the calls made on one request of the stub gpiod module."""
+
+    def __init__(self, config, levels):
+        self.config = config
+        self.levels = levels
+        self.calls = []
+        self.released = False
+
+    def get_value(self, pin):
+        self.calls.append(('get_value', pin))
+        return self.levels.get(pin, Value.INACTIVE)
+
+    def get_values(self, pins):
+        self.calls.append(('get_values', list(pins)))
+        return [self.levels.get(pin, Value.INACTIVE) for pin in pins]
+
+    def set_value(self, pin, value):
+        self.calls.append(('set_value', pin, value))
+
+    def reconfigure_lines(self, config):
+        self.calls.append(('reconfigure_lines', config))
+        # Like libgpiod 2, the lines left out lose their settings
+        self.config = dict(config)
+
+    def release(self):
+        self.released = True
+
+
+def stub_gpiod():
+    gpiod = types.ModuleType('gpiod')
+    gpiod.line = types.ModuleType('gpiod.line')
+    gpiod.line.Bias, gpiod.line.Direction, gpiod.line.Value = Bias, Direction, Value
+    gpiod.LineSettings = LineSettings
+    gpiod.levels = {}
+    gpiod.requests = []
+
+    def request_lines(chip, consumer, config):
+        gpiod.requests.append(LineRequest(config, gpiod.levels))
+        return gpiod.requests[-1]
+
+    gpiod.request_lines = request_lines
+    return gpiod
+
+
+class GpiodBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.gpiod = stub_gpiod()
+        patcher = patch.dict(sys.modules, {'gpiod': self.gpiod, 'gpiod.line': self.gpiod.line})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with open('config.json') as config_file:
+            self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'gpiod'
+        self.config['config']['use_openhab'] = False
+
+    def test_controller(self):
+        clock = VirtualClock(100.0)
+        controller = Controller(self.config, clock, gpio_backends.create(self.config))
+        self.assertEqual(self.gpiod.requests, [])
+
+        self.gpiod.levels[17] = Value.ACTIVE
+        controller.status_check()
+        request, = self.gpiod.requests
+        self.assertEqual(request.config, {
+            23: LineSettings(direction=Direction.OUTPUT, output_value=Value.ACTIVE),
+            17: LineSettings(direction=Direction.INPUT, bias=Bias.PULL_UP),
+            24: LineSettings(direction=Direction.OUTPUT, output_value=Value.ACTIVE),
+            21: LineSettings(direction=Direction.INPUT, bias=Bias.PULL_UP)})
+        # Every state pin in one bulk read
+        self.assertEqual(request.calls, [('get_values', [17, 21])])
+        self.assertEqual([d.last_state for d in controller.doors], ['open', 'closed'])
+
+        request.calls = []
+        controller.toggle('left')
+        clock.advance(1)
+        self.assertEqual(request.calls[-2:], [('set_value', 23, Value.INACTIVE),
+                                              ('set_value', 23, Value.ACTIVE)])
+
+    def test_lines_added_later(self):
+        backend = gpio_backends.GpiodBackend()
+        backend.setup_input(17)
+        backend.setup_output(23, True)
+        backend.read(17)
+        first, = self.gpiod.requests
+
+        # A new door gets its own request, the lines in use stay requested
+        backend.setup_input(5, pull_up=False)
+        self.assertEqual(len(self.gpiod.requests), 2)
+        second = self.gpiod.requests[1]
+        self.assertFalse(first.released)
+        self.assertEqual(second.config,
+                         {5: LineSettings(direction=Direction.INPUT, bias=Bias.DISABLED)})
+
+        self.gpiod.levels[5] = Value.ACTIVE
+        self.assertEqual(backend.read_all([17, 5]), [0, 1])
+        self.assertEqual(first.calls[-1], ('get_values', [17]))
+        self.assertEqual(second.calls, [('get_values', [5])])
+
+        # A line set up again is reconfigured in place, the others keep their settings
+        backend.write(23, False)
+        backend.setup_input(17, pull_up=False)
+        self.assertEqual(len(self.gpiod.requests), 2)
+        self.assertEqual(first.config, {
+            17: LineSettings(direction=Direction.INPUT, bias=Bias.DISABLED),
+            23: LineSettings(direction=Direction.OUTPUT, output_value=Value.INACTIVE)})
+        backend.setup_output(23, True)
+        self.assertEqual(first.config[17],
+                         LineSettings(direction=Direction.INPUT, bias=Bias.DISABLED))
+
+        backend.cleanup()
+        self.assertTrue(first.released and second.released)
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import simRPi.GPIO as sim_gpio
+
+import gpio_backends
+import gpio_trace
+from clock import VirtualClock
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace.bin')
+        with open('config.json') as config_file:
+            self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        self.config['config']['use_openhab'] = False
+        self.config['alerts']['alert_type'] = None
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        writer = gpio_trace.TraceWriter(self.path, 1000.0)
+        writer.write(1000.0, 'input', 4, 0)
+        writer.write(1000.25, 'output', 17, True)
+        writer.write(1600.5, 'input', 4, 1)
+        writer.close()
+
+        start_time, events = gpio_trace.read_trace(self.path)
+        self.assertEqual(start_time, 1000.0)
+        self.assertEqual(events, [(0.0, 'input', 4, 0), (0.25, 'output', 17, 1),
+                                  (600.5, 'input', 4, 1)])
+        self.assertEqual(os.path.getsize(self.path), gpio_trace.HEADER.size + 3 + 5 + 7)
+
+    def test_channel_limit(self):
+        writer = gpio_trace.TraceWriter(self.path, 1000.0)
+        writer.write(1000.0, 'input', 127, 1)
+        # 128 would read back as an output on channel 0
+        self.assertRaises(ValueError, writer.write, 1000.5, 'input', 128, 1)
+        writer.close()
+        self.assertEqual(gpio_trace.read_trace(self.path)[1], [(0.0, 'input', 127, 1)])
+
+    def test_recorder_keeps_level_changes(self):
+        clock = VirtualClock(50.0)
+        writer = gpio_trace.TraceWriter(self.path, clock.seconds())
+        recorder = gpio_trace.TraceRecorder(gpio_backends.SimBackend(), writer, clock)
+        recorder.setup_input(4)
+        sim_gpio.set_state(4, 0)
+        for value in [0, 0, 1, 1, 1, 0]:
+            recorder.read(4)
+            clock.advance(0.5)
+            sim_gpio.set_state(4, value)
+        self.assertEqual(recorder.read_all([4]), [0])
+        recorder.setup_output(17, True)
+        writer.close()
+
+        _, events = gpio_trace.read_trace(self.path)
+        self.assertEqual(events, [(0.0, 'input', 4, 0), (1.5, 'input', 4, 1),
+                                  (3.0, 'input', 4, 0), (3.0, 'output', 17, 1)])
+
+    def test_replay(self):
+        door = self.config['doors']['left']
+        pin = door['state_pin']
+        closed = door.get('state_pin_closed_value', 0)
+        events = [(0.0, 'input', pin, closed),
+                  # Chattering reed switch as the door leaves
+                  (10.0, 'input', pin, 1 - closed),
+                  (10.01, 'input', pin, closed),
+                  (10.02, 'input', pin, 1 - closed),
+                  (10.5, 'output', door['relay_pin'], 0),
+                  # Left open past the alert delay, then closed
+                  (900.0, 'input', pin, closed)]
+
+        clock = VirtualClock(1000.0)
+        end, report = gpio_trace.replay(self.config, events, clock)
+        clock.run_until(end)
+        result = report()
+        self.assertEqual(result['events'], 5)
+        # Three open alerts five minutes apart, then the closed notice
+        self.assertEqual(result['alerts'], 4)
+        self.assertIn('latency_p99_ms', result)
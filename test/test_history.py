@@ -0,0 +1,50 @@
+import unittest
+
+from history import EventHistory
+
+
+class EventHistoryTest(unittest.TestCase):
+    def test_batched_writes(self):
+        history = EventHistory(':memory:')
+        history.record('left', 'open', 10.0)
+        history.record('right', 'closed', 11.0)
+        self.assertEqual(history.db.execute('SELECT COUNT(*) FROM events').fetchone()[0], 0)
+        self.assertEqual(history.flush(), 2)
+        self.assertEqual(history.flush(), 0)
+        self.assertEqual(history.db.execute('SELECT COUNT(*) FROM events').fetchone()[0], 2)
+
+    def test_query(self):
+        history = EventHistory(':memory:', ring_size=3)
+        for n in range(6):
+            history.record('left' if n % 2 else 'right', 'open', float(n))
+
+        # Covered by the ring buffer
+        self.assertEqual(history.query_recent(start=3.5),
+                         [(4.0, 'right', 'open'), (5.0, 'left', 'open')])
+        self.assertEqual(history.query_recent(start=2.0), None)
+
+        # Older events from SQLite, pending rows flushed first
+        self.assertEqual(history.query(door='left', start=0.0, end=4.0),
+                         [(1.0, 'left', 'open'), (3.0, 'left', 'open')])
+        self.assertEqual(len(history.query()), 6)
+        # Without a start, the most recent page
+        self.assertEqual(history.query(limit=2), [(4.0, 'right', 'open'), (5.0, 'left', 'open')])
+        self.assertEqual(history.query(start=0.0, limit=2),
+                         [(0.0, 'right', 'open'), (1.0, 'left', 'open')])
+
+    def test_default_page_is_newest(self):
+        history = EventHistory(':memory:')
+        for n in range(1500):
+            history.record('left', 'open' if n % 2 else 'closed', float(n))
+        events = history.query()
+        self.assertEqual(len(events), 1000)
+        self.assertEqual((events[0][0], events[-1][0]), (500.0, 1499.0))
+        self.assertEqual(history.query(end=999.0)[-1][0], 999.0)
+
+    def test_writer_thread(self):
+        history = EventHistory(':memory:', flush_interval=0.01)
+        history.start()
+        history.record('left', 'open', 1.0)
+        history.stop()
+        self.assertEqual(history.pending, [])
+        self.assertEqual(history.query(start=0.0), [(1.0, 'left', 'open')])
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from http_pool import ConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+    received = []
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.received.append((self.command, self.path))
+        if self.path == '/drop':
+            # Processed, but the connection drops before the response
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/last':
+            # Closed after a keep-alive response, as idle timeouts do
+            self.close_connection = True
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        KeepAliveHandler.connections = []
+        KeepAliveHandler.received = []
+        self.server = ThreadingServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        for n in range(3):
+            status, body = pool.request('http', self.host, 'POST', '/', str(n))
+            self.assertEqual(status, 200)
+            self.assertEqual(body, str(n).encode())
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(len(KeepAliveHandler.connections), 1)
+        pool.close()
+
+    def test_reconnect_closed_connection(self):
+        pool = ConnectionPool()
+        pool.request('http', self.host, 'POST', '/', 'a')
+        # The server side drops the idle connection
+        for conn in pool.idle[('http', self.host)]:
+            conn.sock.close()
+        status, body = pool.request('http', self.host, 'POST', '/', 'b')
+        self.assertEqual(body, b'b')
+        self.assertEqual(pool.created, 2)
+        pool.close()
+
+    def test_no_duplicate_post(self):
+        pool = ConnectionPool()
+        pool.request('http', self.host, 'POST', '/', 'a')
+        self.assertRaises(Exception, pool.request, 'http', self.host, 'POST', '/drop', 'b')
+        self.assertEqual(KeepAliveHandler.received.count(('POST', '/drop')), 1)
+
+        # An idempotent request is sent again on a fresh connection
+        pool.request('http', self.host, 'PUT', '/', 'c')
+        self.assertRaises(Exception, pool.request, 'http', self.host, 'PUT', '/drop', 'd')
+        self.assertEqual(KeepAliveHandler.received.count(('PUT', '/drop')), 2)
+        pool.close()
+
+    def test_skip_dropped_idle_connection(self):
+        pool = ConnectionPool()
+        pool.request('http', self.host, 'POST', '/last', 'a')
+        self.assertEqual(len(pool.idle[('http', self.host)]), 1)
+        time.sleep(0.1)
+        # The pool notices the server closed it before sending
+        self.assertEqual(pool.acquire('http', self.host)[1], False)
+        pool.close()
@@ -0,0 +1,43 @@
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = metrics.Counter('transitions_total', 'Transitions', ['door'],
+                                  registry=self.registry)
+        counter.inc('left')
+        counter.inc('left')
+        counter.inc('ri"ght')
+        self.assertEqual(counter.get('left'), 2)
+        self.assertEqual(self.registry.render(),
+                         '# HELP transitions_total Transitions\n'
+                         '# TYPE transitions_total counter\n'
+                         'transitions_total{door="left"} 2.0\n'
+                         'transitions_total{door="ri\\"ght"} 1.0\n')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('tick_seconds', 'Tick', buckets=(0.1, 1.0),
+                                      registry=self.registry)
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(3.0)
+        self.assertEqual(histogram.count(), 4)
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+            'tick_seconds_bucket{le="0.1"} 2',
+            'tick_seconds_bucket{le="1.0"} 3',
+            'tick_seconds_bucket{le="+Inf"} 4',
+            'tick_seconds_sum 3.65',
+            'tick_seconds_count 4'])
+
+    def test_gauge(self):
+        depth = []
+        metrics.Gauge('queue_depth', 'Depth', lambda: len(depth), registry=self.registry)
+        depth.extend([1, 2])
+        self.assertIn('queue_depth 2.0\n', self.registry.render())
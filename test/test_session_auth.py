@@ -0,0 +1,53 @@
+import unittest
+
+from clock import VirtualClock
+from session_auth import SessionAuth, hash_password, verify_password
+
+
+class SessionAuthTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(1000.0)
+        self.auth = SessionAuth('user', hash_password('12345', iterations=1000), self.clock,
+                                token_lifetime=60, max_failures=3, lockout=10, max_lockout=100)
+
+    def test_password_hash(self):
+        password_hash = hash_password('12345', iterations=1000)
+        self.assertTrue(password_hash.startswith('pbkdf2_sha256$1000$'))
+        self.assertNotEqual(password_hash, hash_password('12345', iterations=1000))
+        self.assertTrue(verify_password('12345', password_hash))
+        self.assertFalse(verify_password('1234', password_hash))
+        self.assertFalse(verify_password('12345', '12345'))
+
+    def test_token(self):
+        token = self.auth.login('10.0.0.1', 'user', '12345')
+        self.assertEqual(self.auth.check_token(token), 'user')
+        tampered = token[:-1] + ('1' if token[-1] == '0' else '0')
+        self.assertEqual(self.auth.check_token(tampered), None)
+        self.assertEqual(self.auth.check_token(token.replace('user', 'admin')), None)
+        self.assertEqual(self.auth.check_token('garbage'), None)
+
+        self.clock.advance(61)
+        self.assertEqual(self.auth.check_token(token), None)
+
+    def test_throttle(self):
+        client = '10.0.0.2'
+        for _ in range(2):
+            self.assertEqual(self.auth.login(client, 'user', 'wrong'), None)
+            self.assertEqual(self.auth.retry_after(client), 0)
+        self.auth.login(client, 'user', 'wrong')
+        self.assertEqual(self.auth.retry_after(client), 10)
+        self.assertEqual(self.auth.retry_after('10.0.0.3'), 0)
+
+        # Each further failure doubles the lockout
+        self.clock.advance(10)
+        self.auth.login(client, 'user', 'wrong')
+        self.assertEqual(self.auth.retry_after(client), 20)
+
+        # A success clears the count, quiet clients are forgotten
+        self.clock.advance(20)
+        self.assertNotEqual(self.auth.login(client, 'user', '12345'), None)
+        self.assertEqual(self.auth.failures, {})
+        self.auth.login(client, 'user', 'wrong')
+        self.clock.advance(101)
+        self.auth.login('10.0.0.3', 'user', 'wrong')
+        self.assertEqual(list(self.auth.failures), ['10.0.0.3'])
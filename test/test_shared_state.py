@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import simRPi.GPIO as sim_gpio
+
+import shared_state
+from clock import VirtualClock
+from garage_controller import Controller
+
+from twisted.internet.testing import StringTransport
+
+
+class MockUpdateHandler(object):
+    calls = 0
+
+    def handle_updates(self):
+        self.calls += 1
+
+
+class StateTableTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        table = shared_state.StateTable(self.path, max_doors=4, create=True)
+        reader = shared_state.StateTable(self.path)
+        self.assertEqual(reader.read(), (0, 0, 0, []))
+
+        doors = [('left', 'Left', 'opening', 10.5, 'open', 10.0),
+                 ('right', 'Right', 'closed', 3.0, None, None)]
+        self.assertEqual(table.write(7, 1, doors), 2)
+        self.assertEqual(reader.max_doors, 4)
+        self.assertEqual(reader.read(), (2, 7, 1, doors))
+        self.assertRaises(ValueError, table.write, 8, 1, doors * 3)
+
+    def test_torn_read(self):
+        table = shared_state.StateTable(self.path, create=True)
+        table.write(1, 0, [('left', 'Left', 'open', 1.0, None, None)])
+        # A writer stopped in the middle of an update
+        shared_state.SEQUENCE.pack_into(table.map, 8, table.sequence() + 1)
+        self.assertEqual(shared_state.StateTable(self.path).read(), None)
+
+    def test_bad_door_count(self):
+        table = shared_state.StateTable(self.path, max_doors=2, create=True)
+        shared_state.HEADER.pack_into(table.map, 0, shared_state.MAGIC,
+                                      shared_state.LAYOUT_VERSION, 2, 1, 0, 3)
+        self.assertEqual(shared_state.StateTable(self.path).read(), None)
+
+    def test_sampler_restart(self):
+        table = shared_state.StateTable(self.path, max_doors=4, create=True)
+        table.write(1, 0, [('left', 'Left', 'open', 1.0, None, None)] * 4)
+        view = shared_state.SharedStateView(self.path, clock=VirtualClock(100.0))
+        self.assertTrue(view.refresh())
+        old_map = view.table.map
+
+        # A smaller table replaces the file, the old mapping stays readable
+        table = shared_state.StateTable(self.path, max_doors=2, create=True)
+        self.assertEqual(len(old_map[:]), view.table.file_id[1])
+        self.assertGreater(table.write(2, 0, [('right', 'Right', 'closed', 2.0, None, None)]), 2)
+        self.assertTrue(view.refresh())
+        self.assertEqual(view.table.max_doors, 2)
+        self.assertEqual([d.id for d in view.doors], ['right'])
+
+
+class TwoProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state')
+        with open('config.json') as config_file:
+            self.config = json.load(config_file)
+            self.config['config']['gpio_backend'] = 'sim'
+        self.clock = VirtualClock(100.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def connect(self, server_factory, client_factory):
+        server = server_factory.buildProtocol(None)
+        client = client_factory.buildProtocol(None)
+        server_transport, client_transport = StringTransport(), StringTransport()
+        server.makeConnection(server_transport)
+        client.makeConnection(client_transport)
+
+        def pump():
+            while server_transport.value() or client_transport.value():
+                to_client, to_server = server_transport.value(), client_transport.value()
+                server_transport.clear()
+                client_transport.clear()
+                client.dataReceived(to_client)
+                server.dataReceived(to_server)
+        return pump
+
+    def test_view_follows_sampler(self):
+        controller = Controller(self.config, self.clock)
+        table = shared_state.StateTable(self.path, create=True)
+        publisher = shared_state.StatePublisher(controller, table)
+        controller.set_update_handler(publisher)
+
+        view = shared_state.SharedStateView(self.path, clock=self.clock)
+        handler = MockUpdateHandler()
+        view.add_update_handler(handler)
+        pump = self.connect(shared_state.CommandServerFactory(controller, publisher),
+                            shared_state.CommandClientFactory(view))
+
+        controller.status_check()
+        pump()
+        self.assertEqual(sorted((d.id, d.last_state) for d in view.doors),
+                         sorted((d.id, d.last_state) for d in controller.doors))
+        self.assertEqual(handler.calls, 1)
+        version = view.version
+        self.assertFalse(view.refresh())
+
+        # Toggle from the web side, answered with the command
+        replies = []
+        view.submit_toggle('left').addCallback(replies.append)
+        pump()
+        self.assertEqual(replies[0][:2], [1, 'left'])
+        self.assertEqual(view.get_command_changes(version), [replies[0]])
+        self.assertEqual(view.toggle_count, 1)
+        self.assertEqual(view.registry.get('left').last_action, replies[0][2])
+
+        door = controller.registry.get('left')
+        sim_gpio.set_state(door.state_pin, 1 - door.state_pin_closed_value)
+        controller.status_check()
+        pump()
+        self.assertEqual(view.registry.get('left').last_state, door.last_state)
+        self.assertEqual(view.get_changes(version)[1][0][:2], ('left', door.last_state))
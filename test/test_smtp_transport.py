@@ -0,0 +1,65 @@
+import smtplib
+import unittest
+from unittest.mock import patch
+
+from smtp_transport import SMTPTransport
+
+
+def answering(server):
+    server.noop.return_value = (250, b'OK')
+    server.mail.return_value = (250, b'OK')
+    server.rcpt.return_value = (250, b'OK')
+    server.data.return_value = (250, b'OK')
+    return server
+
+
+class SMTPTransportTest(unittest.TestCase):
+    @patch("smtplib.SMTP", autospec=True)
+    def test_session_reused(self, mock_smtp):
+        server = answering(mock_smtp.return_value)
+
+        transport = SMTPTransport('host', 587, 'user', 'pass', use_tls=True)
+        transport.send('user', 'to', 'message 1')
+        transport.send('user', 'to', 'message 2')
+
+        self.assertEqual(mock_smtp.call_count, 1)
+        self.assertEqual(server.starttls.call_count, 1)
+        self.assertEqual(server.login.call_count, 1)
+        self.assertEqual(server.data.call_count, 2)
+        self.assertEqual(len(transport.latencies), 2)
+        self.assertGreaterEqual(transport.average_latency(), 0.0)
+
+    @patch("smtplib.SMTP", autospec=True)
+    def test_reconnect(self, mock_smtp):
+        server = answering(mock_smtp.return_value)
+
+        transport = SMTPTransport('host', 25, 'user', 'pass')
+        transport.send('user', 'to', 'message 1')
+
+        # NOOP fails on a dropped session
+        server.noop.side_effect = smtplib.SMTPServerDisconnected()
+        transport.send('user', 'to', 'message 2')
+        self.assertEqual(transport.connects, 2)
+
+        # Dropped between NOOP and MAIL FROM, nothing was handed over
+        server.noop.side_effect = None
+        server.mail.side_effect = [smtplib.SMTPServerDisconnected(), (250, b'OK')]
+        transport.send('user', 'to', 'message 3')
+        self.assertEqual(transport.connects, 3)
+        self.assertEqual(server.starttls.call_count, 0)
+
+    @patch("smtplib.SMTP", autospec=True)
+    def test_no_resend_after_data(self, mock_smtp):
+        server = answering(mock_smtp.return_value)
+        transport = SMTPTransport('host', 25, 'user', 'pass')
+
+        # The server may have accepted the message before dropping the session
+        server.data.side_effect = smtplib.SMTPServerDisconnected()
+        self.assertRaises(smtplib.SMTPServerDisconnected, transport.send, 'user', 'to', 'message')
+        self.assertEqual(server.data.call_count, 1)
+        self.assertEqual(transport.connects, 1)
+        self.assertIsNone(transport.server)
+
+        server.data.side_effect = [(554, b'rejected')]
+        self.assertRaises(smtplib.SMTPDataError, transport.send, 'user', 'to', 'message')
+        self.assertEqual(transport.connects, 2)
@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import simRPi.GPIO as sim_gpio
+
+import snapshot
+from clock import VirtualClock
+from garage_controller import Controller
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot.json')
+        with open('config.json') as config_file:
+            self.config = json.load(config_file)
+        self.config['config']['gpio_backend'] = 'sim'
+        self.config['config']['use_alerts'] = True
+        self.config['alerts']['time_to_wait'] = 60
+        self.config['alerts']['time_btw_alert_repeat'] = 300
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load_bad_files(self):
+        self.assertEqual(snapshot.load(self.path), None)
+        with open(self.path, 'w') as snapshot_file:
+            snapshot_file.write('{"format": 1, "doors": {"left"')
+        self.assertEqual(snapshot.load(self.path), None)
+        with open(self.path, 'w') as snapshot_file:
+            snapshot_file.write('{"format": 99, "doors": {}}')
+        self.assertEqual(snapshot.load(self.path), None)
+
+    def test_malformed_entries_skipped(self):
+        controller = Controller(self.config, VirtualClock(1000.0))
+        saved = {'state': 'open', 'state_time': 900.0, 'last_action': 'open',
+                 'last_action_time': 890.0, 'open_time': 900.0, 'alert_sent': False,
+                 'alert_sent_time': None, 'confirm_close': False}
+        broken = dict(saved)
+        del broken['open_time']
+        self.assertEqual(controller.restore_snapshot({'left': broken, 'right': saved}), 1)
+        self.assertEqual(controller.restore_snapshot({'left': None, 'right': saved}), 0)
+        self.assertEqual([d.last_state for d in controller.doors], ['unknown', 'open'])
+
+    @patch("garage_controller.Controller.send_alert", autospec=True)
+    @patch("garage_controller.Controller.notify_state_change", autospec=True)
+    def test_restart_resumes_doors(self, mock_notify, mock_alert):
+        clock = VirtualClock(1000.0)
+        controller = Controller(self.config, clock)
+        left, right = controller.doors
+        sim_gpio.set_state(left.state_pin, 1 - left.state_pin_closed_value)
+        sim_gpio.set_state(right.state_pin, right.state_pin_closed_value)
+        controller.status_check()
+        clock.advance(left.time_to_open + 60)
+        controller.status_check()
+        self.assertEqual(mock_alert.call_count, 1)
+
+        writer = snapshot.SnapshotWriter(controller, self.path)
+        self.assertTrue(writer.write())
+        self.assertFalse(writer.write())
+
+        # Restart 100 s later, the left door is still open, the right one opened
+        clock.advance(100)
+        mock_notify.reset_mock()
+        mock_alert.reset_mock()
+        restarted = Controller(self.config, clock)
+        sim_gpio.set_state(left.state_pin, 1 - left.state_pin_closed_value)
+        sim_gpio.set_state(right.state_pin, 1 - right.state_pin_closed_value)
+        self.assertEqual(restarted.restore_snapshot(snapshot.load(self.path)), 2)
+        restarted.status_check()
+        self.assertEqual([c[0][1].id for c in mock_notify.call_args_list], [right.id])
+        left = restarted.registry.get(left.id)
+        self.assertEqual(left.last_state_time, 1000.0)
+
+        # The left alert repeats 300 s after the one sent before the restart,
+        # the right door waits for its first alert
+        alert_sent_time = left.alert_sent_time
+        self.assertEqual(restarted.next_check_delay(), 60 + right.time_to_open)
+        clock.advance(200)
+        restarted.status_check()
+        self.assertEqual(sorted(c[0][1].id for c in mock_alert.call_args_list),
+                         [left.id, right.id])
+        self.assertEqual(left.alert_sent_time, alert_sent_time + 300)
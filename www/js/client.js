@@ -1,4 +1,5 @@
 var lastupdate = 0;
+var version = null;
 
 function formatState(state, time)
 {   
@@ -50,20 +51,51 @@ function uptime() {
 }
 
 
+function applyUpdates(update) {
+    for (var i = 0; i < update.length; i++) {
+	var id = update[i][0];
+	var state = update[i][1];
+	var time = update[i][2];
+	$("#" + id + " p").html(formatState(state, time));
+	$("#" + id  + " img").attr("src", "img/" + state + ".png")
+	$("#doorlist").listview('refresh');
+    }
+}
+
+function applyCommands(commands) {
+    // [id, door, action, status, merged requests]
+    for (var i = 0; commands && i < commands.length; i++) {
+	if (commands[i][3] == "failed") {
+	    $("#" + commands[i][1] + " p").append(" (the door did not respond)");
+	}
+    }
+}
+
+function stream() {
+    // The browser reconnects by itself, resuming with Last-Event-ID
+    var source = new EventSource("evt");
+    source.onmessage = function(event) {
+	var response = JSON.parse(event.data);
+	lastupdate = response.timestamp;
+	version = response.version;
+	applyUpdates(response.update);
+	applyCommands(response.commands);
+    };
+}
+
 function poll(){
+    var data = {'lastupdate': lastupdate };
+    if (version !== null) {
+	data['version'] = version;
+    }
     $.ajax({ 
     	url: "upd",
-    	data: {'lastupdate': lastupdate },
+    	data: data,
     	success: function(response, status) {
     	    lastupdate = response.timestamp;
-    	    for (var i = 0; i < response.update.length; i++) {
-    		var id = response.update[i][0];
-    		var state = response.update[i][1];
-    		var time = response.update[i][2];
-    		$("#" + id + " p").html(formatState(state, time));
-    		$("#" + id  + " img").attr("src", "img/" + state + ".png")
-    		$("#doorlist").listview('refresh');
-    	    }
+    	    version = response.version;
+    	    applyUpdates(response.update);
+    	    applyCommands(response.commands);
     	    setTimeout('poll()', 1000);
         },
         // handle error
@@ -79,7 +111,11 @@ function poll(){
 
 function init() {
     uptime()
-    poll()
+    if (window.EventSource) {
+	stream()
+    } else {
+	poll()
+    }
 }
 
 $(document).live('pageinit', init);